@@ -0,0 +1,351 @@
+import os
+import re
+import json
+import bisect
+import hashlib
+import tempfile
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+# === ログのインデックス ===
+# app.log (docker compose logs の出力) を毎回全部読まずに済ませるための索引。
+#   - 末尾の N 行はファイル末尾からブロック単位で逆向きに読む (tail_lines)
+#   - 1回だけ全体を走査して、行の先頭バイト位置を以下のキーごとに記録する
+#       時刻バケット (BUCKET_S 秒) / サービス (「xxx | 」の xxx) / HTTP ステータス / リクエストID
+#   - ログが追記されていれば、前回の末尾から先だけを追加で走査する
+# 索引は AGENT_CACHE_DIR/index/<ログ名>-<ディレクトリのハッシュ>.idx に保存する (JSON ヘッダ 1 行 + 配列のバイト列)。
+# logs/ はホストのバインドマウントなので、そこには書かない。
+
+INDEX_DIR = os.path.join(os.getenv("AGENT_CACHE_DIR", "/tmp/ai_agent_cache"), "index")  # ツールキャッシュと同じ場所に置く
+BUCKET_S = 10
+BLOCK = 1 << 16
+_VERSION = 1
+
+_TS_RE = re.compile(rb"(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:[.,](\d+))?(Z|[+-]\d{2}:?\d{2})?")
+_STATUS_RE = re.compile(rb"\bst=(\d{3})\b|\" (\d{3}) |Status:(\d{3})\b")
+_RID_RE = re.compile(rb"(?:MONITOR-)?[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+_SERVICE_RE = re.compile(rb"^([A-Za-z0-9_.-]+)\s+\| ")
+
+
+def _rid_hash(rid: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(rid, digest_size=8).digest(), "little")
+
+
+def parse_ts(text) -> Optional[float]:
+    """ISO 形式 (タイムゾーンなしは UTC とみなす) または epoch 秒を epoch 秒にする。"""
+    if text is None or text == "":
+        return None
+    if isinstance(text, (int, float)):
+        return float(text)
+    if isinstance(text, str):
+        try:
+            return float(text)
+        except ValueError:
+            pass
+        text = text.encode()
+    m = _TS_RE.search(text)
+    if not m:
+        return None
+    return _ts_from_match(m)
+
+
+_ts_cache: Dict[Tuple[bytes, bytes, Optional[bytes]], Optional[float]] = {}
+
+
+def _ts_from_match(m) -> Optional[float]:
+    # 秒単位までの変換結果をキャッシュする (同じ秒の行が大量に続くため)
+    date, hms, frac, tz = m.groups()
+    key = (date, hms, tz)
+    base = _ts_cache.get(key, -1.0)
+    if base == -1.0:
+        s = f"{date.decode()}T{hms.decode()}"
+        if tz and tz != b"Z":
+            t = tz.decode()
+            s += t if ":" in t else f"{t[:3]}:{t[3:]}"
+        try:
+            dt = datetime.fromisoformat(s)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            base = dt.timestamp()
+        except ValueError:
+            base = None
+        if len(_ts_cache) > 4096:
+            _ts_cache.clear()
+        _ts_cache[key] = base
+    if base is None:
+        return None
+    return base + float(b"0." + frac) if frac else base
+
+
+def tail_lines(path: str, n: int) -> List[str]:
+    """末尾から BLOCK ずつ逆に読み、最後の n 行だけを返す。"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        chunks: List[bytes] = []
+        newlines = 0
+        while pos > 0 and newlines <= n:
+            step = min(BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step)
+            chunks.append(chunk)
+            newlines += chunk.count(b"\n")
+    data = b"".join(reversed(chunks))
+    lines = data.splitlines()
+    return [ln.decode("utf-8", "ignore") for ln in lines[-n:]] if n > 0 else []
+
+
+class LogIndex:
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        self.path = path
+        self.index_path = index_path or self._default_index_path(path)
+        self.size = 0
+        self.head = ""
+        self.lines = 0
+        self.first_ts: Optional[float] = None
+        self.last_ts: Optional[float] = None
+        self._last_ts_seen: Optional[float] = None
+        # bucket 開始秒 -> [最初の行の位置, 最後の行の終わり, 行数]
+        self.buckets: Dict[int, List[int]] = {}
+        self.services: Dict[str, array] = {}
+        self.statuses: Dict[str, array] = {}
+        self.rid_hash = array("Q")
+        self.rid_off = array("Q")
+
+    @staticmethod
+    def _default_index_path(path: str) -> str:
+        d = INDEX_DIR
+        try:
+            os.makedirs(d, exist_ok=True)
+        except OSError:
+            d = tempfile.gettempdir()
+        # 別ディレクトリの同名ログと混ざらないよう、ディレクトリのハッシュを名前に入れる
+        tag = hashlib.blake2b(os.path.dirname(os.path.abspath(path)).encode(), digest_size=4).hexdigest()
+        return os.path.join(d, "%s-%s.idx" % (os.path.basename(path), tag))
+
+    # --- 構築 ---
+    def _head_hash(self, n: int) -> str:
+        # 同じファイルに追記されたのか、ローテーション等で別物になったのかを先頭で見分ける
+        with open(self.path, "rb") as f:
+            return hashlib.blake2b(f.read(min(n, 4096)), digest_size=8).hexdigest()
+
+    def refresh(self) -> "LogIndex":
+        """索引を読み込み、ログが伸びていれば差分だけ追加、別物になっていれば作り直す。"""
+        st = os.stat(self.path)
+        if not self.size and os.path.exists(self.index_path):
+            self._load()
+        if st.st_size < self.size or (self.size and self._head_hash(self.size) != self.head):
+            self.__init__(self.path, self.index_path)
+        if st.st_size > self.size:
+            self._scan(self.size, st.st_size)
+            self.head = self._head_hash(self.size)
+            self._save()
+        return self
+
+    def _scan(self, start: int, end: int):
+        rids: List[Tuple[int, int]] = []
+        off = start
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            rest = b""
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(BLOCK * 16, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                buf = rest + chunk
+                cut = buf.rfind(b"\n") + 1
+                for line in buf[:cut].split(b"\n")[:-1]:
+                    self._add_line(line, off, rids)
+                    off += len(line) + 1
+                rest = buf[cut:]
+        # 改行で終わっていない末尾の行は書きかけかもしれないので次回に回す
+        self.size = off
+        if rids:
+            pairs = sorted(list(zip(self.rid_hash, self.rid_off)) + rids)
+            self.rid_hash = array("Q", (h for h, _ in pairs))
+            self.rid_off = array("Q", (o for _, o in pairs))
+
+    def _add_line(self, line: bytes, off: int, rids: List[Tuple[int, int]]):
+        self.lines += 1
+        m = _SERVICE_RE.match(line)
+        svc = m.group(1).decode() if m else "-"
+        self.services.setdefault(svc, array("Q")).append(off)
+
+        tm = _TS_RE.search(line)
+        ts = _ts_from_match(tm) if tm else None
+        if ts is None:
+            ts = self._last_ts_seen  # 時刻のない行 (uvicorn のアクセスログ等) は直前の時刻に寄せる
+        else:
+            self._last_ts_seen = ts
+            if self.first_ts is None or ts < self.first_ts:
+                self.first_ts = ts
+            if self.last_ts is None or ts > self.last_ts:
+                self.last_ts = ts
+        if ts is not None:
+            b = int(ts) // BUCKET_S * BUCKET_S
+            e = self.buckets.get(b)
+            if e is None:
+                self.buckets[b] = [off, off + len(line) + 1, 1]
+            else:
+                e[0] = min(e[0], off)
+                e[1] = max(e[1], off + len(line) + 1)
+                e[2] += 1
+
+        sm = _STATUS_RE.search(line)
+        if sm:
+            code = (sm.group(1) or sm.group(2) or sm.group(3)).decode()
+            self.statuses.setdefault(code, array("Q")).append(off)
+
+        for rid in set(_RID_RE.findall(line)):
+            rids.append((_rid_hash(rid), off))
+
+    # --- 保存 / 読み込み ---
+    def _save(self):
+        arrays: List[array] = []
+        layout = {"services": {}, "statuses": {}}
+        for group in ("services", "statuses"):
+            for k, arr in getattr(self, group).items():
+                layout[group][k] = len(arrays)
+                arrays.append(arr)
+        layout["rid_hash"] = len(arrays); arrays.append(self.rid_hash)
+        layout["rid_off"] = len(arrays); arrays.append(self.rid_off)
+        header = {
+            "version": _VERSION, "size": self.size, "head": self.head, "lines": self.lines,
+            "first_ts": self.first_ts, "last_ts": self.last_ts, "last_ts_seen": self._last_ts_seen,
+            "bucket_s": BUCKET_S, "buckets": self.buckets, "layout": layout,
+            "lengths": [len(a) for a in arrays],
+        }
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(json.dumps(header, separators=(",", ":")).encode() + b"\n")
+                for a in arrays:
+                    a.tofile(f)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            pass  # 保存できなくてもメモリ上の索引で続行する
+
+    def _load(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                header = json.loads(f.readline())
+                if header.get("version") != _VERSION or header.get("bucket_s") != BUCKET_S:
+                    return
+                arrays = []
+                for n in header["lengths"]:
+                    a = array("Q")
+                    a.fromfile(f, n)
+                    arrays.append(a)
+        except (OSError, ValueError, EOFError):
+            return
+        lay = header["layout"]
+        self.size, self.head, self.lines = header["size"], header["head"], header["lines"]
+        self.first_ts, self.last_ts = header["first_ts"], header["last_ts"]
+        self._last_ts_seen = header["last_ts_seen"]
+        self.buckets = {int(k): v for k, v in header["buckets"].items()}
+        self.services = {k: arrays[i] for k, i in lay["services"].items()}
+        self.statuses = {k: arrays[i] for k, i in lay["statuses"].items()}
+        self.rid_hash, self.rid_off = arrays[lay["rid_hash"]], arrays[lay["rid_off"]]
+
+    # --- 検索 ---
+    def _read_at(self, f, off: int) -> bytes:
+        f.seek(off)
+        return f.readline()
+
+    def find_request(self, request_id: str, limit: int = 200) -> List[str]:
+        h = _rid_hash(request_id.encode())
+        i = bisect.bisect_left(self.rid_hash, h)
+        out = []
+        with open(self.path, "rb") as f:
+            while i < len(self.rid_hash) and self.rid_hash[i] == h and len(out) < limit:
+                line = self._read_at(f, self.rid_off[i])
+                if request_id.encode() in line:
+                    out.append(line.decode("utf-8", "ignore").rstrip("\n"))
+                i += 1
+        return out
+
+    def _time_range(self, since: Optional[float], until: Optional[float]) -> Tuple[int, int]:
+        if since is None and until is None:
+            return 0, self.size
+        lo, hi = None, None
+        for b, (first, end, _) in self.buckets.items():
+            if (since is None or b + BUCKET_S > since) and (until is None or b <= until):
+                lo = first if lo is None else min(lo, first)
+                hi = end if hi is None else max(hi, end)
+        return (lo, hi) if lo is not None else (0, 0)
+
+    def search(self, service: str = "", status: str = "", since=None, until=None,
+               contains: str = "", limit: int = 200) -> Tuple[List[str], int]:
+        """条件に合う行 (最大 limit 行) と、条件に合う行の総数を返す。"""
+        since_ts, until_ts = parse_ts(since), parse_ts(until)
+        lo, hi = self._time_range(since_ts, until_ts)
+        needle = contains.encode() if contains else b""
+
+        cands: Optional[List[int]] = None
+        for group, key in (("services", service), ("statuses", status)):
+            if not key:
+                continue
+            arr = getattr(self, group).get(key, array("Q"))
+            a, b = bisect.bisect_left(arr, lo), bisect.bisect_left(arr, hi)
+            part = arr[a:b]
+            cands = list(part) if cands is None else sorted(set(cands).intersection(part))
+
+        out: List[str] = []
+        total = 0
+        with open(self.path, "rb") as f:
+            lines = ((o, self._read_at(f, o)) for o in cands) if cands is not None else self._iter_range(f, lo, hi)
+            last_ts = None
+            for _, line in lines:
+                if since_ts is not None or until_ts is not None:
+                    tm = _TS_RE.search(line)
+                    ts = _ts_from_match(tm) if tm else last_ts
+                    last_ts = ts if ts is not None else last_ts
+                    if ts is not None and ((since_ts is not None and ts < since_ts)
+                                           or (until_ts is not None and ts > until_ts)):
+                        continue
+                if needle and needle not in line:
+                    continue
+                total += 1
+                if len(out) < limit:
+                    out.append(line.decode("utf-8", "ignore").rstrip("\n"))
+        return out, total
+
+    def _iter_range(self, f, lo: int, hi: int):
+        f.seek(lo)
+        off = lo
+        while off < hi:
+            line = f.readline()
+            if not line:
+                break
+            yield off, line
+            off += len(line)
+
+    def overview(self) -> dict:
+        def iso(ts):
+            return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts is not None else None
+        per_bucket = sorted((b, e[2]) for b, e in self.buckets.items())
+        return {
+            "bytes_indexed": self.size,
+            "lines": self.lines,
+            "first_ts": iso(self.first_ts),
+            "last_ts": iso(self.last_ts),
+            "services": {k: len(v) for k, v in sorted(self.services.items())},
+            "statuses": {k: len(v) for k, v in sorted(self.statuses.items())},
+            "request_ids_indexed": len(self.rid_hash),
+            f"lines_per_{BUCKET_S}s": [[iso(b), n] for b, n in per_bucket[-60:]],
+        }
+
+
+_indexes: Dict[str, LogIndex] = {}
+
+
+def get_index(path: str) -> LogIndex:
+    """パスごとに1つの索引を使い回し、呼ばれるたびに追記分だけ反映する。"""
+    idx = _indexes.get(path)
+    if idx is None:
+        idx = _indexes[path] = LogIndex(path)
+    return idx.refresh()
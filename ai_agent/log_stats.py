@@ -0,0 +1,307 @@
+import re
+import json
+import math
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+from log_index import _TS_RE, _ts_from_match
+
+try:
+    import numpy as np
+except ImportError:  # NumPy がなくても同じ結果を返す (遅いだけ)
+    np = None
+
+# === ログの事前集計 ===
+# app.log を1回ストリームで読み、行の種類ごとに列 (array) に詰めてから秒単位でまとめて集計する。
+#   nginx    : log_format main の st= / rt= / urt=
+#   cloud_api: uvicorn のアクセスログのステータス (時刻は直前の行から引き継ぐ)
+#   monitor  : [Monitor] の OK (秒) / ERROR Status:xxx (秒) / FAILED
+#   metrics  : /metrics の JSON (timestamp_epoch を含む行)
+# 生の行ではなく、秒ごとのレート・rt/urt のパーセンタイル・障害の始まった時刻だけをエージェントに渡す。
+
+BLOCK = 1 << 20
+PERCENTILES = (50, 90, 99)
+METRIC_KEYS = ("pending", "session_count", "session_waiters", "timeouts", "shed", "errors",
+               "recent_timeout_ratio", "downstream_limit", "rss_mb")
+
+_NGINX_RE = re.compile(rb" st=(\d{3}) rt=([\d.]+) urt=(\S+)")
+_UVICORN_RE = re.compile(rb"HTTP/1\.[01]\" (\d{3}) ")
+_MONITOR_RE = re.compile(rb"\[Monitor\].* - (?:OK \(([\d.]+)s\)|ERROR Status:(\d{3}) \(([\d.]+)s\)|FAILED: (\w+))")
+
+
+class _Columns:
+    def __init__(self, *spec):
+        self.cols = {name: array(code) for name, code in spec}
+
+    def add(self, **kw):
+        for k, v in kw.items():
+            self.cols[k].append(v)
+
+    def __len__(self):
+        return len(next(iter(self.cols.values())))
+
+    def get(self, name):
+        a = self.cols[name]
+        return np.frombuffer(a, dtype=a.typecode) if np is not None and len(a) else a
+
+
+def _urt(raw: bytes) -> float:
+    # "0.012" / "-" / "60.001, 0.002" (複数 upstream) → 最後の数値
+    for part in reversed(raw.replace(b":", b",").split(b",")):
+        part = part.strip()
+        if part and part != b"-":
+            try:
+                return float(part)
+            except ValueError:
+                pass
+    return math.nan
+
+
+def parse(path: str):
+    nginx = _Columns(("ts", "d"), ("st", "h"), ("rt", "f"), ("urt", "f"))
+    api = _Columns(("ts", "d"), ("st", "h"))
+    mon = _Columns(("ts", "d"), ("st", "h"), ("dur", "f"))  # st=0 は例外 (接続失敗等)
+    metrics: List[dict] = []
+    last_ts = None
+    with open(path, "rb") as f:
+        rest = b""
+        while True:
+            chunk = f.read(BLOCK)
+            if not chunk:
+                break
+            buf = rest + chunk
+            cut = buf.rfind(b"\n") + 1
+            rest = buf[cut:]
+            for line in buf[:cut].split(b"\n"):
+                if not line:
+                    continue
+                tm = _TS_RE.search(line)
+                if tm:
+                    ts = _ts_from_match(tm)
+                    if ts is not None:
+                        last_ts = ts
+                if last_ts is None:
+                    continue
+                if b" st=" in line:
+                    m = _NGINX_RE.search(line)
+                    if m:
+                        nginx.add(ts=last_ts, st=int(m.group(1)), rt=float(m.group(2)), urt=_urt(m.group(3)))
+                        continue
+                if b"[Monitor]" in line:
+                    m = _MONITOR_RE.search(line)
+                    if m:
+                        ok, st, dur, exc = m.groups()
+                        if ok is not None:
+                            mon.add(ts=last_ts, st=200, dur=float(ok))
+                        elif st is not None:
+                            mon.add(ts=last_ts, st=int(st), dur=float(dur))
+                        else:
+                            mon.add(ts=last_ts, st=0, dur=math.nan)
+                        continue
+                if b"HTTP/1." in line:
+                    m = _UVICORN_RE.search(line)
+                    if m:
+                        api.add(ts=last_ts, st=int(m.group(1)))
+                        continue
+                if b'"timestamp_epoch"' in line:
+                    try:
+                        d = json.loads(line[line.index(b"{"):].decode("utf-8", "ignore"))
+                        metrics.append({"ts": d["timestamp_epoch"], **{k: d[k] for k in METRIC_KEYS if k in d}})
+                    except (ValueError, KeyError):
+                        pass
+    return nginx, api, mon, metrics
+
+
+# --- 集計 (NumPy があればベクトル化) ---
+def _bincount(idx, n: int, weights=None):
+    if np is not None:
+        if not len(idx):
+            return np.zeros(n)
+        return np.bincount(idx, weights=weights, minlength=n)[:n]
+    out = [0.0] * n
+    for j, i in enumerate(idx):
+        out[i] += weights[j] if weights is not None else 1
+    return out
+
+
+def _percentiles(values, ps: Sequence[float]) -> List[Optional[float]]:
+    if np is not None:
+        v = np.asarray(values, dtype=float)
+        v = v[~np.isnan(v)]
+        return [round(float(x), 3) for x in np.percentile(v, ps)] if len(v) else [None] * len(ps)
+    v = sorted(x for x in values if not math.isnan(x))
+    if not v:
+        return [None] * len(ps)
+    return [round(v[min(len(v) - 1, max(0, math.ceil(p / 100 * len(v)) - 1))], 3) for p in ps]
+
+
+def _sec_index(ts, t0: float, n: int):
+    # 範囲外 (集計範囲の計算とずれた端数など) は両端の秒に寄せる
+    if np is not None:
+        return np.clip((np.asarray(ts) - t0).astype(np.int64), 0, n - 1)
+    return [min(n - 1, max(0, int(t - t0))) for t in ts]
+
+
+def _mask(values, pred):
+    if np is not None:
+        return pred(np.asarray(values)).astype(float)
+    return [1.0 if pred(v) else 0.0 for v in values]
+
+
+def _count_by(values) -> Dict[str, int]:
+    if np is not None:
+        keys, counts = np.unique(np.asarray(values), return_counts=True)
+        return {str(int(k)): int(c) for k, c in zip(keys, counts)}
+    out: Dict[str, int] = {}
+    for v in values:
+        out[str(v)] = out.get(str(v), 0) + 1
+    return out
+
+
+def _where(values, cond):
+    """cond(要素) が真の要素だけを返す (NumPy ならブールマスク)。"""
+    if np is not None:
+        v = np.asarray(values)
+        return v[cond(v)] if len(v) else v
+    return [x for x in values if cond(x)]
+
+
+def _first_ts(ts, values, cond) -> Optional[float]:
+    """cond(要素) が真の行のうち最も早い時刻 (なければ None)。"""
+    if np is not None:
+        m = cond(np.asarray(values))
+        return float(np.asarray(ts)[m].min()) if len(m) and m.any() else None
+    sel = [t for t, x in zip(ts, values) if cond(x)]
+    return min(sel) if sel else None
+
+
+def _lat_summary(rt, urt) -> dict:
+    keys = [f"p{p}" for p in PERCENTILES]
+    out = {"rt_s": dict(zip(keys, _percentiles(rt, PERCENTILES))),
+           "urt_s": dict(zip(keys, _percentiles(urt, PERCENTILES)))}
+    if np is not None:
+        gap = np.asarray(rt, dtype=float) - np.asarray(urt, dtype=float)
+    else:
+        gap = [a - b for a, b in zip(rt, urt)]
+    # rt - urt: nginx の中で (upstream を待つ前に) かかった時間
+    out["rt_minus_urt_s"] = dict(zip(keys, _percentiles(gap, PERCENTILES)))
+    return out
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds")
+
+
+def _runs(bad: List[bool], gap_s: int, min_s: int):
+    """bad な秒の連続 (gap_s 秒以下の切れ目はつなぐ) のうち min_s 秒以上のものを (開始, 終了) で返す。"""
+    runs, start, last = [], None, None
+    for i, b in enumerate(bad):
+        if not b:
+            continue
+        if start is None:
+            start = last = i
+        elif i - last > gap_s + 1:
+            if last - start + 1 >= min_s:
+                runs.append((start, last))
+            start = i
+        last = i
+    if start is not None and last - start + 1 >= min_s:
+        runs.append((start, last))
+    return runs
+
+
+def analyze(path: str, max_rows: int = 30, error_ratio: float = 0.5, gap_s: int = 5, min_s: int = 3) -> dict:
+    nginx, api, mon, metrics = parse(path)
+    # ログは到着順なので時刻が前後する。範囲は先頭・末尾の行ではなく全行の最小・最大で決め、
+    # 秒の区切りがずれないよう t0 は整数秒に切り下げる
+    metrics.sort(key=lambda m: m["ts"])
+    cols = [c.get("ts") for c in (nginx, api, mon) if len(c)]
+    starts = [min(ts) for ts in cols] + [m["ts"] for m in metrics[:1]]
+    ends = [max(ts) for ts in cols] + [m["ts"] for m in metrics[-1:]]
+    if not starts:
+        return {"error": "解析できる行がありません"}
+    t0, t1 = float(math.floor(min(starts))), float(max(ends))
+    n = int(t1 - t0) + 1
+
+    # 秒ごとの系列 (nginx を主、なければ cloud_api のアクセスログ)
+    src = nginx if len(nginx) else api
+    sec = _sec_index(src.get("ts"), t0, n)
+    st = src.get("st")
+    req = _bincount(sec, n)
+    err = _bincount(sec, n, _mask(st, lambda s: s >= 500))
+    to = _bincount(sec, n, _mask(st, lambda s: s == 504))
+    msec = _sec_index(mon.get("ts"), t0, n)
+    mon_fail = _bincount(msec, n, _mask(mon.get("st"), lambda s: s != 200))
+
+    bad = [(req[i] > 0 and err[i] / req[i] >= error_ratio) or mon_fail[i] > 0 for i in range(n)]
+    regimes = []
+    src_ts = src.get("ts")
+    for a, b in _runs(bad, gap_s, min_s):
+        # ログは到着順なので時刻が前後することがあり、範囲は位置ではなく値で選ぶ
+        if np is not None:
+            in_run = st[(sec >= a) & (sec <= b)]
+        else:
+            in_run = [s for s, i in zip(st, sec) if a <= i <= b]
+        by_status = _count_by(_where(in_run, lambda s: s >= 500))
+        r = {"start": _iso(t0 + a), "end": _iso(t0 + b), "duration_s": b - a + 1,
+             "requests": int(sum(req[a:b + 1])), "errors": int(sum(err[a:b + 1])),
+             "peak_errors_per_s": int(max(err[a:b + 1])), "errors_by_status": by_status,
+             "monitor_failures": int(sum(mon_fail[a:b + 1]))}
+        if metrics:
+            before = [m for m in metrics if m["ts"] <= t0 + a]
+            if before:
+                r["metrics_at_start"] = {k: v for k, v in before[-1].items() if k != "ts"}
+        regimes.append(r)
+
+    # 各ステータス・長時間応答の初出時刻
+    first = {}
+    for code in sorted(int(c) for c in _count_by(_where(st, lambda s: s >= 500))):
+        first[str(code)] = _iso(_first_ts(src_ts, st, lambda s, c=code: s == c))
+    if len(nginx):
+        t = _first_ts(nginx.get("ts"), nginx.get("rt"), lambda r: r >= 59)
+        if t is not None:
+            first["rt>=59s"] = _iso(t)
+    t = _first_ts(mon.get("ts"), mon.get("st"), lambda s: s != 200)
+    if t is not None:
+        first["monitor_failure"] = _iso(t)
+
+    # タイムラインは max_rows 行に間引く
+    width = max(1, math.ceil(n / max_rows))
+    timeline = []
+    for a in range(0, n, width):
+        b = min(n, a + width)
+        rq, er, tt, mf = sum(req[a:b]), sum(err[a:b]), sum(to[a:b]), sum(mon_fail[a:b])
+        timeline.append({"t": _iso(t0 + a), "req_per_s": round(rq / (b - a), 2), "5xx_per_s": round(er / (b - a), 2),
+                         "504_per_s": round(tt / (b - a), 2), "monitor_failures": int(mf)})
+
+    out = {
+        "range": {"start": _iso(t0), "end": _iso(t1), "seconds": n},
+        "source": "nginx" if len(nginx) else "cloud_api",
+        "counts": {"nginx": len(nginx), "cloud_api": len(api), "monitor": len(mon), "metrics_snapshots": len(metrics)},
+        "status": _count_by(st),
+        "peak_req_per_s": int(max(req)) if n else 0,
+        "peak_5xx_per_s": int(max(err)) if n else 0,
+        "first_seen": first,
+        "regimes": regimes,
+        "timeline": timeline,
+        "timeline_bin_s": width,
+        "numpy": np is not None,
+    }
+    if len(nginx):
+        rt, urt, nst = nginx.get("rt"), nginx.get("urt"), nginx.get("st")
+        out["latency"] = _lat_summary(rt, urt)
+        for code in sorted(int(c) for c in _count_by(nst)):
+            if np is not None:
+                m = nst == code
+                out["latency"][f"st_{code}"] = _lat_summary(rt[m], urt[m])
+            else:
+                sel = [i for i, s in enumerate(nst) if s == code]
+                out["latency"][f"st_{code}"] = _lat_summary([rt[i] for i in sel], [urt[i] for i in sel])
+    if len(mon):
+        out["monitor"] = {"probes": len(mon), "failures": int(sum(mon_fail)),
+                          "duration_s": dict(zip([f"p{p}" for p in PERCENTILES], _percentiles(mon.get("dur"), PERCENTILES)))}
+    if metrics:
+        out["metrics"] = {k: {"max": max(m[k] for m in metrics if k in m), "last": metrics[-1].get(k)}
+                          for k in METRIC_KEYS if any(k in m for m in metrics)}
+    return out
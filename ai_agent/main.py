@@ -1,14 +1,21 @@
 import os
-import glob
 from agents import Agent, function_tool, Runner
 import asyncio
 import openai
 from openai.types.responses import ResponseTextDeltaEvent
+from log_index import get_index, tail_lines
+from log_stats import analyze
+from tool_cache import ToolCache
 
 # --- 設定 ---
 # 修正対象のルートディレクトリ（docker-composeでマウントした場所）
 PROJECT_ROOT = "/app/source"
 
+# ツール結果のキャッシュ (パス + mtime + サイズがキー。実行をまたいで再利用する)
+CACHE_DIR = os.getenv("AGENT_CACHE_DIR", "/tmp/ai_agent_cache")  # compose の名前付きボリューム ai_agent_cache (/app/source はホストのリポジトリなので使わない)
+CACHE_MAX_MB = int(os.getenv("AGENT_CACHE_MAX_MB", "256"))
+cache = ToolCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
+
 # --- ツール定義 (分析用) ---
 ALLOWED_FILES = [
     "cloud_api/main.py",
@@ -16,36 +23,93 @@ ALLOWED_FILES = [
     "docker-compose.yaml"
 ]
 
+def _log_path(log_name: str) -> str:
+    return os.path.join(PROJECT_ROOT, "logs", os.path.basename(log_name))
+
+def _analyze(path: str) -> dict:
+    return cache.cached("analyze", path, lambda: analyze(path))
+
+def _overview(path: str) -> dict:
+    return cache.cached("overview", path, lambda: get_index(path).overview())
+
+def _read_file(relative_path: str) -> str:
+    return cache.read_text(os.path.join(PROJECT_ROOT, relative_path))
+
+def _list_files(directory: str) -> list[str]:
+    files = cache.list_files(os.path.normpath(os.path.join(PROJECT_ROOT, directory)))
+    # 相対パスに変換して返す
+    return [os.path.relpath(f, PROJECT_ROOT) for f in files]
+
 @function_tool
 def read_log_file(log_name: str) -> str:
-    """ログファイル(app.log, monitor.log)を読み取ります。"""
-    log_path = os.path.join(PROJECT_ROOT, "logs", log_name)
+    """ログファイル(app.log, monitor.log)の末尾400行を読み取ります。"""
     try:
-        with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
-            # 分析精度向上のため、直近400行を読み込む
-            return "".join(lines[-400:])
+        # ファイル全体は読まず、末尾からブロック単位で必要な分だけ読む
+        return "\n".join(tail_lines(_log_path(log_name), 400))
     except Exception as e:
         return f"ログ読み込みエラー: {e}"
 
+@function_tool
+def analyze_log(log_name: str) -> dict:
+    """
+    ログ全体を集計した統計を返します (生の行は返しません)。
+    nginx の st/rt/urt、cloud_api のアクセスログ、monitor の結果、/metrics のスナップショットから
+    秒ごとのリクエスト/5xx/504 レート、rt と urt のパーセンタイル (ステータス別)、
+    各エラーの初出時刻、障害区間 (regimes: 開始・終了・件数・開始時点のメトリクス) を出します。
+    """
+    try:
+        return _analyze(_log_path(log_name))
+    except Exception as e:
+        return {"error": f"ログ集計エラー: {e}"}
+
+@function_tool
+def log_overview(log_name: str) -> dict:
+    """ログ全体の概要 (行数、時刻範囲、サービス別・HTTPステータス別の行数、10秒ごとの行数) を返します。"""
+    try:
+        return _overview(_log_path(log_name))
+    except Exception as e:
+        return {"error": f"ログ索引エラー: {e}"}
+
+@function_tool
+def search_log(log_name: str, service: str = "", status: str = "", since: str = "", until: str = "",
+               contains: str = "", limit: int = 200) -> str:
+    """
+    条件に合うログ行だけを返します (条件は AND)。
+    service: 行頭のコンテナ名 (例: nginx_proxy, fastapi_app, car_client)
+    status: HTTPステータス (例: 504)
+    since / until: ISO 形式の時刻 (例: 2024-05-01T12:00:00, タイムゾーンなしはUTC)
+    contains: 行に含まれる文字列
+    """
+    try:
+        path = _log_path(log_name)
+        lines, total = cache.cached("search", path, lambda: get_index(path).search(service, status, since, until, contains, min(limit, 1000)),
+                                    service, status, since, until, contains, limit)
+        return f"[{total} lines matched, showing {len(lines)}]\n" + "\n".join(lines)
+    except Exception as e:
+        return f"ログ検索エラー: {e}"
+
+@function_tool
+def find_request(log_name: str, request_id: str) -> str:
+    """X-Request-ID (例: MONITOR-xxxx や UUID) を含むログ行をすべて返します。"""
+    try:
+        lines = get_index(_log_path(log_name)).find_request(request_id)
+        return "\n".join(lines) if lines else f"{request_id} を含む行はありません"
+    except Exception as e:
+        return f"ログ検索エラー: {e}"
+
 @function_tool
 def read_file(relative_path: str) -> str:
     """指定されたパスのソースコードを読み取ります。"""
-    target_path = os.path.join(PROJECT_ROOT, relative_path)
     try:
-        with open(target_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read()
+        return _read_file(relative_path)
     except Exception as e:
         return f"ファイル読み込みエラー: {e}"
 
 @function_tool
 def list_files(directory: str) -> list[str]:
-    """指定されたディレクトリ内のファイルをリスト化します。"""
-    target_dir = os.path.join(PROJECT_ROOT, directory)
+    """指定されたディレクトリ内のファイルをリスト化します (.git 等は除く)。"""
     try:
-        files = glob.glob(f"{target_dir}/**/*", recursive=True)
-        # 相対パスに変換して返す
-        return [f.replace(PROJECT_ROOT + "/", "") for f in files if os.path.isfile(f)]
+        return _list_files(directory)
     except Exception as e:
         return [f"エラー: {e}"]
 
@@ -92,10 +156,11 @@ repair_planning = Agent(
 # 1. 原因特定エージェント
 fault_localization = Agent(
     name="FaultLocalization",
-    tools=[read_log_file, list_files, read_file],
+    tools=[analyze_log, read_log_file, log_overview, search_log, find_request, list_files, read_file],
     instructions=(
         "You are a Senior SRE."
         "Analyze `app.log` and `monitor.log` to find the root cause of timeouts/errors."
+        "Start with `analyze_log` (statistics and failure regimes) and `log_overview`, then narrow down with `search_log` (time window, service, status) and `find_request`."
         "Principles:"
         "- Check for mismatch in timeouts between Nginx and App."
         "- Check for resource bottlenecks (memory, sessions)."
@@ -110,6 +175,16 @@ fault_localization = Agent(
 )
 
 
+async def prefetch():
+    # エージェントが最初に読むものを並行して用意しておく (失敗しても無視)
+    jobs = [(_list_files, "")] + [(_read_file, f) for f in ALLOWED_FILES]
+    for name in ("app.log", "monitor.log"):
+        path = _log_path(name)
+        if os.path.exists(path):
+            jobs += [(_overview, path), (_analyze, path)]
+    await asyncio.gather(*(asyncio.to_thread(fn, arg) for fn, arg in jobs), return_exceptions=True)
+    print(f"[Prefetch] {len(jobs)} items, cache: {cache.stats()}")
+
 async def main():
     if not os.environ.get("OPENAI_API_KEY"):
         print("エラー: 環境変数 OPENAI_API_KEY が設定されていません。")
@@ -118,6 +193,7 @@ async def main():
     print("\n" + "="*50)
     print("AIエージェントによるログ分析を開始します...")
     print("="*50)
+    await prefetch()
 
     initial_prompt = (
         "アプリケーションログ `app.log` とモニタリングログ `monitor.log` を分析し、"
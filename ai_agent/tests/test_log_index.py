@@ -0,0 +1,17 @@
+import os
+
+import log_index
+
+
+def test_index_is_kept_out_of_the_log_dir(tmp_path, monkeypatch):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "app.log").write_text("cloud_api | hello\n")
+    cache = tmp_path / "cache"
+    monkeypatch.setattr(log_index, "INDEX_DIR", str(cache))
+
+    idx = log_index.LogIndex(str(logs / "app.log")).refresh()
+
+    assert os.listdir(logs) == ["app.log"]
+    assert os.path.dirname(idx.index_path) == str(cache)
+    assert os.path.exists(idx.index_path)
@@ -0,0 +1,69 @@
+import pytest
+
+import log_stats
+
+
+@pytest.fixture(params=["numpy", "pure"])
+def impl(request, monkeypatch):
+    if request.param == "numpy":
+        if log_stats.np is None:
+            pytest.skip("numpy not installed")
+    else:
+        monkeypatch.setattr(log_stats, "np", None)
+    return request.param
+
+
+def _nginx(ts: str, st: int, rt: float = 0.01) -> str:
+    return f"nginx | {ts} \"POST /api/v1/vehicle/climate/start HTTP/1.1\" st={st} rt={rt:.3f} urt={rt:.3f}\n"
+
+
+def _write(tmp_path, lines):
+    p = tmp_path / "app.log"
+    p.write_text("".join(lines))
+    return str(p)
+
+
+def test_unsorted_lines_are_binned_by_time(tmp_path, impl):
+    path = _write(tmp_path, [
+        _nginx("2024-01-01T12:00:05+00:00", 200),
+        _nginx("2024-01-01T12:00:03.500+00:00", 200),  # 最も早い行が途中にあり、端数秒を持つ
+        _nginx("2024-01-01T12:00:07+00:00", 200),
+        _nginx("2024-01-01T12:00:04+00:00", 500),
+        _nginx("2024-01-01T12:00:06+00:00", 200),
+    ])
+    out = log_stats.analyze(path, max_rows=100)
+    assert out["range"]["start"] == "2024-01-01T12:00:03+00:00"
+    assert out["range"]["seconds"] == 5
+    tl = {row["t"]: row for row in out["timeline"]}
+    assert tl["2024-01-01T12:00:04+00:00"]["5xx_per_s"] == 1
+    assert tl["2024-01-01T12:00:03+00:00"]["5xx_per_s"] == 0
+    assert sum(row["req_per_s"] for row in out["timeline"]) == 5
+    assert out["first_seen"]["500"] == "2024-01-01T12:00:04+00:00"
+
+
+def test_first_seen_is_earliest_time_not_first_line(tmp_path, impl):
+    path = _write(tmp_path, [
+        _nginx("2024-01-01T12:00:06+00:00", 504, 60.0),
+        _nginx("2024-01-01T12:00:05+00:00", 504, 60.0),
+        _nginx("2024-01-01T12:00:01+00:00", 200),
+    ])
+    out = log_stats.analyze(path)
+    assert out["first_seen"]["504"] == "2024-01-01T12:00:05+00:00"
+    assert out["first_seen"]["rt>=59s"] == "2024-01-01T12:00:05+00:00"
+    assert out["status"] == {"200": 1, "504": 2}
+
+
+def test_error_regime(tmp_path, impl):
+    lines = [_nginx(f"2024-01-01T12:00:{s:02d}+00:00", 200) for s in range(0, 10)]
+    lines += [_nginx(f"2024-01-01T12:00:{s:02d}+00:00", 502) for s in range(10, 15)]
+    lines += [_nginx(f"2024-01-01T12:00:{s:02d}+00:00", 200) for s in range(15, 20)]
+    out = log_stats.analyze(_write(tmp_path, lines[::-1]), min_s=3)
+    assert len(out["regimes"]) == 1
+    r = out["regimes"][0]
+    assert r["start"] == "2024-01-01T12:00:10+00:00"
+    assert r["duration_s"] == 5
+    assert r["errors_by_status"] == {"502": 5}
+
+
+def test_no_parsable_lines(tmp_path, impl):
+    assert "error" in log_stats.analyze(_write(tmp_path, ["hello\n"]))
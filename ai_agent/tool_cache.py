@@ -0,0 +1,183 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# === ツール結果のキャッシュ (実行をまたいで再利用) ===
+# キーは「種類 + パス + mtime + サイズ (+ 引数)」。ファイルが変われば自然に別キーになるので無効化は不要。
+#   - 値は JSON で CACHE_DIR/<キーのハッシュ>.json に保存し、合計サイズが上限を超えたら古いものから消す (LRU)
+#   - ディレクトリ一覧はディレクトリごとに (mtime, ファイル名, サブディレクトリ名) を dirs.json に持ち、
+#     mtime が変わっていないディレクトリは読み直さずに stat だけで済ませる
+# .git などの重いディレクトリはそもそも辿らない。
+
+SKIP_DIRS = {".git", "__pycache__", ".index", ".cache", ".pytest_cache", ".mypy_cache", ".venv", "venv", "node_modules"}
+
+
+def file_key(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class ToolCache:
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[int]] = {}  # キー -> [サイズ, 最終使用 (ns)]
+        self._total = 0
+        self._dirs: Dict[str, list] = {}
+        self._dirs_dirty = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for name in os.listdir(cache_dir):
+                if name.endswith(".json") and name != "dirs.json":
+                    st = os.stat(os.path.join(cache_dir, name))
+                    self._entries[name[:-5]] = [st.st_size, st.st_mtime_ns]
+                    self._total += st.st_size
+            with open(os.path.join(cache_dir, "dirs.json")) as f:
+                self._dirs = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    # --- 汎用 ---
+    @staticmethod
+    def _digest(parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _get(self, key: str):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+        try:
+            with open(self._path(key)) as f:
+                value = json.load(f)
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            with self._lock:
+                self._drop(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries[key][1] = os.stat(self._path(key)).st_mtime_ns
+            self.hits += 1
+        return value
+
+    def _put(self, key: str, value):
+        data = json.dumps(value, ensure_ascii=False)
+        if len(data) > self.max_bytes // 4:
+            return  # 1件で上限の大半を占めるものは持たない
+        tmp = self._path(key) + f".{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+            st = os.stat(self._path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._drop(key, unlink=False)
+            self._entries[key] = [st.st_size, st.st_mtime_ns]
+            self._total += st.st_size
+            self._evict()
+
+    def _drop(self, key: str, unlink: bool = True):
+        e = self._entries.pop(key, None)
+        if e is not None:
+            self._total -= e[0]
+            if unlink:
+                try:
+                    os.unlink(self._path(key))
+                except OSError:
+                    pass
+
+    def _evict(self):
+        if self._total <= self.max_bytes:
+            return
+        for key, _ in sorted(self._entries.items(), key=lambda kv: kv[1][1]):
+            if self._total <= self.max_bytes * 0.9:
+                break
+            self._drop(key)
+
+    def cached(self, kind: str, path: str, fn: Callable[[], object], *args):
+        """path が前回と同じ (mtime, サイズ) なら保存済みの fn() の結果を返す。"""
+        fk = file_key(path)
+        if fk is None:
+            return fn()
+        key = self._digest([kind, os.path.abspath(path), fk, args])
+        value = self._get(key)
+        if value is None:
+            value = fn()
+            self._put(key, value)
+        return value
+
+    # --- ファイル内容 ---
+    def read_text(self, path: str) -> str:
+        def load():
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                return f.read()
+        return self.cached("file", path, load)
+
+    # --- ディレクトリ一覧 ---
+    def _dir_entries(self, d: str) -> Tuple[List[str], List[str]]:
+        st = os.stat(d)
+        with self._lock:
+            hit = self._dirs.get(d)
+        if hit and hit[0] == st.st_mtime_ns:
+            return hit[1], hit[2]
+        files, subdirs = [], []
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name not in SKIP_DIRS:
+                        subdirs.append(e.name)
+                elif e.is_file():
+                    files.append(e.name)
+        files.sort(); subdirs.sort()
+        with self._lock:
+            self._dirs[d] = [st.st_mtime_ns, files, subdirs]
+            self._dirs_dirty = True
+        return files, subdirs
+
+    def list_files(self, root: str) -> List[str]:
+        """root 以下のファイルを再帰的に列挙する (SKIP_DIRS は辿らない)。"""
+        out, stack = [], [root]
+        while stack:
+            d = stack.pop()
+            try:
+                files, subdirs = self._dir_entries(d)
+            except OSError:
+                continue
+            out.extend(os.path.join(d, f) for f in files)
+            stack.extend(os.path.join(d, s) for s in reversed(subdirs))
+        self.save_dirs()
+        return sorted(out)
+
+    def save_dirs(self):
+        with self._lock:
+            if not self._dirs_dirty:
+                return
+            data = json.dumps(self._dirs)
+            self._dirs_dirty = False
+        tmp = os.path.join(self.cache_dir, f"dirs.json.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(self.cache_dir, "dirs.json"))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total, "max_bytes": self.max_bytes,
+                    "dirs": len(self._dirs), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+# === Docker なしのベンチマーク ===
+# cloud_api と vehicle_simulator を1台の Linux 上で動かし、名前付きシナリオの負荷をかけて
+# スループット・レイテンシ・セッション待ち・fsync 回数を JSON で出す。
+#   --mode asgi   : 1プロセス内で両アプリを httpx.ASGITransport でつなぐ (ネットワークなし)
+#   --mode uvicorn: 両アプリを loopback の uvicorn サブプロセスとして起動する
+# アプリは import 時に環境変数を読むので、シナリオごとに子プロセスを分けて実行する。
+#
+#   python bench/bench.py                                   # 全シナリオ
+#   python bench/bench.py steady burst --out result.json
+#   python bench/bench.py --save-baseline bench/baseline.json
+#   python bench/bench.py --baseline bench/baseline.json    # 悪化があれば終了コード 1
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(ROOT, "cloud_api")
+SIM_DIR = os.path.join(ROOT, "vehicle_simulator")
+sys.path.insert(0, os.path.join(ROOT, "car_app"))
+from loadstats import LoadStats  # noqa: E402
+
+API_PATH = "/api/v1/vehicle/climate/start"
+
+# env    : cloud_api に渡す環境変数
+# sim_env: vehicle_simulator に渡す環境変数 (SIM_* で遅延・障害を注入)
+# phases : constant / poisson は rate (件/秒) と duration_s、burst は count 件を同時に
+# users  : ユーザー (= セッション) の数。MAX_SESSIONS を超えるとセッション待ちが発生する
+SCENARIOS = {
+    "steady": {
+        "users": 200,
+        "phases": [{"mode": "poisson", "rate": 50, "duration_s": 10}],
+    },
+    "burst": {
+        "users": 1000,
+        "phases": [{"mode": "constant", "rate": 20, "duration_s": 3},
+                   {"mode": "burst", "count": 400},
+                   {"mode": "constant", "rate": 20, "duration_s": 5}],
+    },
+    "slow_backend": {
+        "users": 200,
+        "sim_env": {"SIM_LATENCY": "lognormal:200:0.5", "SIM_MAX_CONCURRENT": "4"},
+        "phases": [{"mode": "poisson", "rate": 20, "duration_s": 10}],
+    },
+}
+
+# 比較する指標と向き (+1: 大きいほど良い / -1: 小さいほど良い)
+COMPARE = {
+    "throughput_per_s": +1,
+    "latency.p50_ms": -1,
+    "latency.p99_ms": -1,
+    "latency.p99.9_ms": -1,
+    "session_wait.p99_ms": -1,
+    "fsync_count": -1,
+    "error_ratio": -1,
+}
+
+
+# --- 負荷 ---
+async def drive(client, spec, stats):
+    rng = random.Random(spec.get("seed", 0))
+    users = spec.get("users", 200)
+    tasks = set()
+
+    async def one(intended):
+        i = rng.randrange(users)
+        actual = time.time()
+        stats.on_send(intended, actual)
+        try:
+            r = await client.post(
+                API_PATH,
+                json={"user_id": f"user-{i:06d}", "vehicle_id": f"vin-{i:06d}"},
+                headers={"X-Request-ID": str(uuid.uuid4()), "X-Proxy-Session": f"dev-{i:06d}"},
+            )
+            stats.on_done(intended, actual, time.time(), status=r.status_code)
+        except Exception as e:
+            stats.on_done(intended, actual, time.time(), error=type(e).__name__)
+
+    def fire(intended):
+        t = asyncio.create_task(one(intended))
+        tasks.add(t)
+        t.add_done_callback(tasks.discard)
+
+    t = time.time()
+    for ph in spec["phases"]:
+        if ph["mode"] == "burst":
+            for _ in range(ph["count"]):
+                fire(t)
+            t += ph.get("duration_s", 0)
+            continue
+        rate, end = ph["rate"], t + ph["duration_s"]
+        while t < end:
+            delay = t - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.time()
+            while t <= now and t < end:
+                fire(t)
+                t += rng.expovariate(rate) if ph["mode"] == "poisson" else 1.0 / rate
+        t = end
+    if tasks:
+        await asyncio.wait(list(tasks))
+
+
+def summarize(stats, metrics, elapsed):
+    snap = stats.snapshot()
+    lat = metrics.get("latency", {})
+    fsync = metrics.get("audit_commits", lat.get("fsync", {}).get("count", 0))
+    done = snap["completed"]
+    ok = snap["status"].get("200", 0)
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "sent": snap["sent"],
+        "completed": done,
+        "throughput_per_s": round(ok / elapsed, 2) if elapsed > 0 else 0.0,
+        "error_ratio": round(1 - ok / done, 4) if done else 0.0,
+        "status": snap["status"],
+        "errors": snap["errors"],
+        "latency": snap["latency"],
+        "session_wait": lat.get("session_wait", {}),
+        "downstream": lat.get("downstream", {}),
+        "fsync_count": fsync,
+        "records_per_fsync": round(done / fsync, 2) if fsync else 0.0,
+        "shed": metrics.get("shed", 0),
+        "timeouts": metrics.get("timeouts", 0),
+    }
+
+
+# --- 実行 (子プロセス内) ---
+def _base_env(spec, log_dir):
+    env = {"SYNC_LOG_PATH": os.path.join(log_dir, "proxy.log"), "SIM_LOG_SAMPLE": "0",
+           "TRACE_PATH": os.path.join(log_dir, "trace-cloud_api-{pid}.bin")}
+    env.update(spec.get("env", {}))
+    env.update(spec.get("sim_env", {}))
+    return env
+
+
+async def run_asgi(spec, log_dir):
+    os.environ.update(_base_env(spec, log_dir))
+    sys.path[:0] = [API_DIR, SIM_DIR]
+    import httpx
+    import main
+    import simulator
+
+    main.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=simulator.app), base_url="http://vehicle")
+    await simulator._startup()
+    await main._startup()
+    stats = LoadStats(0)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api",
+                                     timeout=None) as c:
+            t0 = time.time()
+            await drive(c, spec, stats)
+            elapsed = time.time() - t0
+            metrics = (await c.get("/metrics")).json()
+    finally:
+        await main._shutdown()
+        await simulator._shutdown()
+    return summarize(stats, metrics, elapsed)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_ready(client, url, timeout_s=20):
+    end = time.time() + timeout_s
+    while time.time() < end:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"not ready: {url}")
+
+
+async def run_uvicorn(spec, log_dir):
+    import httpx
+
+    sim_port, api_port = _free_port(), _free_port()
+    env = dict(os.environ, **_base_env(spec, log_dir))
+    env["VEHICLE_SIMULATOR_URL"] = f"http://127.0.0.1:{sim_port}"
+    uv = [sys.executable, "-m", "uvicorn", "--host", "127.0.0.1", "--log-level", "warning"]
+    procs = [
+        subprocess.Popen(uv + ["simulator:app", "--port", str(sim_port)], cwd=SIM_DIR, env=env),
+        subprocess.Popen(uv + ["main:app", "--port", str(api_port), "--backlog", "4096"], cwd=API_DIR, env=env),
+    ]
+    stats = LoadStats(0)
+    try:
+        limits = httpx.Limits(max_connections=5000, max_keepalive_connections=5000)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}", limits=limits, timeout=None) as c:
+            await _wait_ready(c, f"http://127.0.0.1:{sim_port}/status")
+            await _wait_ready(c, "/metrics")
+            t0 = time.time()
+            await drive(c, spec, stats)
+            elapsed = time.time() - t0
+            metrics = (await c.get("/metrics")).json()
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+    return summarize(stats, metrics, elapsed)
+
+
+def run_child(name, spec, mode, result_file):
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as log_dir:
+        runner = run_asgi if mode == "asgi" else run_uvicorn
+        result = asyncio.run(runner(spec, log_dir))
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+
+
+# --- 親プロセス ---
+def run_scenario(name, spec, mode):
+    fd, result_file = tempfile.mkstemp(prefix="bench-", suffix=".json")
+    os.close(fd)
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--mode", mode,
+               "--spec", json.dumps(spec), "--result-file", result_file]
+        subprocess.run(cmd, check=True)
+        with open(result_file) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_file)
+
+
+def _get(d, path):
+    for k in path.split("."):
+        if not isinstance(d, dict) or k not in d:
+            return None
+        d = d[k]
+    return d
+
+
+def compare(results, baseline, tolerance):
+    """基準値との差分。tolerance (比率) を超えて悪化した指標を regression とする。"""
+    out, regressions = {}, []
+    for name, res in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        rows = {}
+        for metric, sign in COMPARE.items():
+            cur, ref = _get(res, metric), _get(base, metric)
+            if cur is None or ref is None:
+                continue
+            change = (cur - ref) / ref if ref else (0.0 if cur == ref else float("inf"))
+            worse = -sign * change > tolerance
+            rows[metric] = {"baseline": ref, "current": cur, "change": round(change, 4), "regression": worse}
+            if worse:
+                regressions.append(f"{name}.{metric}")
+        out[name] = rows
+    return out, regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="cloud_api + vehicle_simulator benchmark (no Docker)")
+    ap.add_argument("scenarios", nargs="*", help=f"実行するシナリオ (既定: 全部) {list(SCENARIOS)}")
+    ap.add_argument("--mode", choices=("asgi", "uvicorn"), default="asgi")
+    ap.add_argument("--scenario-file", help="SCENARIOS を上書き・追加する JSON")
+    ap.add_argument("--out", help="結果 JSON の出力先 (既定: 標準出力)")
+    ap.add_argument("--baseline", help="比較する基準結果 JSON")
+    ap.add_argument("--save-baseline", help="今回の結果を基準として保存する")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="悪化とみなす変化率 (既定 0.10)")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--spec", help=argparse.SUPPRESS)
+    ap.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        run_child(args.child, json.loads(args.spec), args.mode, args.result_file)
+        return 0
+
+    scenarios = dict(SCENARIOS)
+    if args.scenario_file:
+        with open(args.scenario_file) as f:
+            scenarios.update(json.load(f))
+    names = args.scenarios or list(scenarios)
+    unknown = [n for n in names if n not in scenarios]
+    if unknown:
+        ap.error(f"unknown scenario: {unknown}")
+
+    results = {}
+    for name in names:
+        print(f"[bench] {name} ({args.mode}) ...", file=sys.stderr)
+        results[name] = run_scenario(name, scenarios[name], args.mode)
+        r = results[name]
+        print(f"[bench] {name}: tput={r['throughput_per_s']}/s p50={r['latency']['p50_ms']}ms "
+              f"p99={r['latency']['p99_ms']}ms fsync={r['fsync_count']} errors={r['error_ratio']}", file=sys.stderr)
+
+    report = {"mode": args.mode, "ts": round(time.time(), 3), "scenarios": results}
+    rc = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("mode") != args.mode:
+            print(f"[bench] warning: baseline mode is {baseline.get('mode')}, not {args.mode}", file=sys.stderr)
+        report["comparison"], regressions = compare(results, baseline, args.tolerance)
+        report["regressions"] = regressions
+        if regressions:
+            print(f"[bench] REGRESSION: {regressions}", file=sys.stderr)
+            rc = 1
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"mode": args.mode, "ts": report["ts"], "scenarios": results}, f, indent=1)
+
+    text = json.dumps(report, indent=1)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,89 +3,165 @@ import sys
 import time
 import signal
 import os
+import json
+import selectors
+from loadstats import ClusterStats
+
+# === シナリオ ===
+# SCENARIO_FILE (または第1引数) の JSON でプロセス数・フェーズ・ユーザーID範囲を指定する。
+#   processes        : 送信プロセス数 ("auto" で CPU コア数)
+#   users_per_process: 1プロセスあたりの担当ユーザー数 / user_id_base: ユーザー番号の開始値
+#   interval_s       : 子プロセスからの集計間隔 = タイムライン1行の幅
+#   phases           : [{"name", "mode": constant|poisson|burst|replay, "duration_s",
+#                        "rate" (全プロセス合計の件/秒) | "burst", "every_s", "stagger_s" (1プロセスあたり)
+#                        | "trace" (traffic.py 形式のトレース), "scale" (再生速度の倍率)}]
+#                      replay はトレースをセッション単位で全プロセスに分担する (duration_s 0 ならトレースの最後まで)
+#                      空なら従来どおり各プロセスが 60 秒周期のバーストを止まるまで続ける
+#   report           : 終了時に書くレポートのパス
+# 各子プロセスはパイプに区間集計を書き、ここで合算して全体のタイムラインを作る。
+DEFAULT_SCENARIO = {
+    "name": "default",
+    "processes": 12,
+    "users_per_process": 3000,
+    "user_id_base": 0,
+    "interval_s": 5,
+    "monitor": True,
+    "phases": [],
+}
+STATS_DIR = os.getenv("STATS_DIR", "stats")
+STOP_GRACE_S = 10  # 停止要求後、子プロセスの最終集計を待つ秒数
+
+def load_scenario():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.getenv("SCENARIO_FILE", "")
+    scenario = dict(DEFAULT_SCENARIO)
+    if path:
+        with open(path) as f:
+            scenario.update(json.load(f))
+    if scenario["processes"] == "auto":
+        scenario["processes"] = os.cpu_count() or 1
+    scenario["processes"] = int(scenario["processes"])
+    return scenario
+
+def child_phases(phases, n):
+    # rate は全体の値なので1プロセスあたりに割る
+    out = []
+    for ph in phases:
+        ph = dict(ph)
+        if "rate" in ph:
+            ph["rate"] = float(ph["rate"]) / n
+        out.append(ph)
+    return out
 
 processes = []
+stop_requested = 0.0
 
 def signal_handler(sig, frame):
+    global stop_requested
+    if stop_requested:
+        return
     print("\n[Launcher] Stopping all processes...")
+    stop_requested = time.time()
     for p in processes:
         p.terminate()
-    sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
-print("=== Starting 12 Load Generator Processes + 1 Monitor ===")
+scenario = load_scenario()
+n = scenario["processes"]
+interval_s = float(scenario["interval_s"])
+print(f"=== Scenario '{scenario['name']}': {n} Load Generator Processes"
+      f"{' + 1 Monitor' if scenario['monitor'] else ''} ===")
 
-# 1. 12個のリクエスト送信プロセスを起動
-for i in range(12):
+# 1. リクエスト送信プロセスを起動
+start_at = time.time() + 1.0  # 全プロセスのフェーズ開始をそろえる
+phases = json.dumps(child_phases(scenario["phases"], n))
+sel = selectors.DefaultSelector()
+for i in range(n):
     cmd = [sys.executable, "send_command.py"]
-    
+    r, w = os.pipe()
+
     # 環境変数をコピーして、PROCESS_IDをセット
     env = os.environ.copy()
     env["PROCESS_ID"] = str(i)
     env["PYTHONUNBUFFERED"] = "1"
+    env["USERS_PER_PROCESS"] = str(scenario["users_per_process"])
+    env["USER_ID_BASE"] = str(scenario["user_id_base"])
+    env["STATS_SNAPSHOT_S"] = str(interval_s)
+    env["STATS_FD"] = str(w)
+    env["LOAD_PHASES"] = phases
+    env["LOAD_START_AT"] = str(start_at)
+    env["LOAD_PROCESSES"] = str(n)
 
-    p = subprocess.Popen(cmd, env=env)
+    p = subprocess.Popen(cmd, env=env, pass_fds=(w,))
+    os.close(w)
+    sel.register(r, selectors.EVENT_READ, data=bytearray())
     processes.append(p)
     print(f"[Launcher] Started Requester Process-{i}")
 
-# 2. 監視用プロセスを別途起動 (send_command.pyに実装するより分離した方が良いが、今回は簡易的に同じスクリプトのモード違いと仮定するか、別途monitor専用スクリプトがあればそちらを呼ぶ)
-# 既存コードの構成上、Monitor用の関数を別ファイルに切り出すか、
-# ここでMonitor専用の小さなスクリプトを実行するのが綺麗です。
-# 今回は簡易的なMonitorをインラインで実行する別スクリプト(monitor_runner.py)を作って呼ぶ形にします。
+# 2. 監視用プロセス (1秒に1回の疎通確認)
+monitor = None
+if scenario["monitor"]:
+    monitor = subprocess.Popen([sys.executable, "monitor.py"], env=os.environ.copy())
+    processes.append(monitor)
+    print("[Launcher] Started Monitor Process")
 
-# 簡易Monitorスクリプトの生成（ファイルがなければ作る）
-monitor_script = """
-import asyncio
-import httpx
-import time
-import uuid
-import logging
-import os
-import uvloop
-
-logging.basicConfig(level=logging.INFO, format="[Monitor] %(asctime)s - %(message)s")
-logger = logging.getLogger("Monitor")
-API_URL = os.getenv("API_URL", "http://nginx:80/api/v1/vehicle/climate/start")
-TIMEOUT_S = float(os.getenv("CLIENT_TIMEOUT_S", "60"))
-
-async def run_monitor():
-    uvloop.install()
-    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10)
-    async with httpx.AsyncClient(limits=limits, timeout=TIMEOUT_S) as client:
-        logger.info("Started (1 probe/sec)")
+# 3. 子プロセスの区間集計を合算して表示 (全パイプが閉じるまで)
+cluster = ClusterStats()
+per_process = {}
+open_pipes = n
+next_row = time.time() + interval_s
+while open_pipes:
+    for key, _ in sel.select(max(0.0, next_row - time.time())):
+        chunk = os.read(key.fd, 1 << 16)
+        if not chunk:
+            sel.unregister(key.fd)
+            os.close(key.fd)
+            open_pipes -= 1
+            continue
+        buf = key.data
+        buf += chunk
         while True:
-            # MonitorはランダムなユーザーIDでOK
-            req_id = f"MONITOR-{uuid.uuid4()}"
-            start_ts = time.time()
+            nl = buf.find(b"\n")
+            if nl < 0:
+                break
+            line = bytes(buf[:nl])
+            del buf[:nl + 1]
             try:
-                resp = await client.post(
-                    API_URL,
-                    json={"user_id": "monitor-user", "vehicle_id": "monitor-vin"},
-                    headers={"X-Request-ID": req_id},
-                )
-                duration = time.time() - start_ts
-                if resp.status_code == 200:
-                    logger.info(f"OK ({duration:.2f}s)")
-                else:
-                    logger.error(f"ERROR Status:{resp.status_code} ({duration:.2f}s)")
-            except Exception as e:
-                logger.error(f"FAILED: {type(e).__name__}")
-            await asyncio.sleep(1)
-
-if __name__ == "__main__":
-    asyncio.run(run_monitor())
-"""
-
-with open("monitor_runner.py", "w") as f:
-    f.write(monitor_script)
-
-# Monitorプロセスの起動
-p_mon = subprocess.Popen([sys.executable, "monitor_runner.py"], env=os.environ.copy())
-processes.append(p_mon)
-print("[Launcher] Started Monitor Process")
-
-# プロセス終了待ち
+                w = json.loads(line)
+            except ValueError:
+                continue
+            cluster.add_window(w)
+            tot = per_process.setdefault(w["process_id"], {"sent": 0, "completed": 0})
+            tot["sent"] += w["sent"]
+            tot["completed"] += w["completed"]
+
+    if time.time() >= next_row:
+        row = cluster.flush_row()
+        next_row += interval_s
+        print(f"[Launcher] t={row['t']}s procs={row['processes']} sent={row['sent']} done={row['completed']} "
+              f"tput={row['throughput_per_s']}/s p50={row['p50_ms']}ms p99={row['p99_ms']}ms "
+              f"p99.9={row['p99.9_ms']}ms status={row['status']} errors={row['errors']}")
+
+    if stop_requested and time.time() - stop_requested > STOP_GRACE_S:
+        for p in processes:
+            p.kill()
+        break
+
+if cluster.pending:
+    cluster.flush_row()
+
+# 4. レポートを書いて終了
+if monitor is not None and monitor.poll() is None:
+    monitor.terminate()
 for p in processes:
     p.wait()
+
+report_path = scenario.get("report") or os.path.join(STATS_DIR, f"report-{time.strftime('%Y%m%d-%H%M%S')}.json")
+report = {"scenario": scenario, "per_process": per_process, **cluster.report()}
+os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+with open(report_path, "w") as f:
+    json.dump(report, f, indent=1)
+lat = report["latency"]
+print(f"[Launcher] Done: sent={report['sent']} done={report['completed']} tput={report['throughput_per_s']}/s "
+      f"p50={lat['p50_ms']}ms p99={lat['p99_ms']}ms p99.9={lat['p99.9_ms']}ms -> {report_path}")
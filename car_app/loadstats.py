@@ -0,0 +1,168 @@
+import os, sys, json, time
+from typing import Dict, List, Optional
+
+try:
+    from hdr_histogram import LatencyHistogram  # イメージ内ではビルド時に cloud_api からコピーされている
+except ImportError:  # リポジトリから直接動かすときは cloud_api の同じファイルを使う
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cloud_api"))
+    from hdr_histogram import LatencyHistogram
+
+# === 負荷生成側の集計 ===
+# LoadStats       : 1プロセス分のレイテンシ・ステータス・エラー種別の集計と、スナップショットの書き出し
+# ClusterStats    : launcher 側で子プロセスから届いた区間集計を足し合わせ、タイムラインを作る
+# スナップショットは「0 でないバケットだけ」を [添字, 件数] で持つので、複数プロセス分を足し合わせられる。
+
+
+def _add_counts(dst: Dict[str, int], src: Dict[str, int]):
+    for k, v in src.items():
+        dst[k] = dst.get(k, 0) + v
+
+
+class _Window:
+    # 前回 take_window() からの区間集計
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.sent = 0
+        self.completed = 0
+        self.status: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+
+
+class LoadStats:
+    def __init__(self, process_id: int):
+        self.process_id = process_id
+        self.started = time.time()
+        # latency: 予定送信時刻から完了まで (coordinated omission 補正済み)
+        # service: 実際に送った時刻から完了まで
+        self.latency = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.sent = 0
+        self.completed = 0
+        self.max_send_lag_s = 0.0  # 予定時刻からの送信遅れの最大 (生成側が追いついているかの目安)
+        self.status: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self._w = _Window()
+
+    def on_send(self, intended: float, actual: float):
+        self.sent += 1
+        self._w.sent += 1
+        lag = actual - intended
+        if lag > self.max_send_lag_s:
+            self.max_send_lag_s = lag
+
+    def on_done(self, intended: float, actual: float, done: float,
+                status: Optional[int] = None, error: Optional[str] = None):
+        w = self._w
+        for s in (self, w):
+            s.completed += 1
+            s.latency.record(done - intended)
+            s.service.record(done - actual)
+            if error is not None:
+                s.errors[error] = s.errors.get(error, 0) + 1
+            else:
+                k = str(status)
+                s.status[k] = s.status.get(k, 0) + 1
+
+    def take_window(self) -> dict:
+        """前回呼び出しからの区間集計を返してリセットする (launcher へ送る用)。"""
+        w, self._w = self._w, _Window()
+        return {
+            "process_id": self.process_id,
+            "ts": round(time.time(), 3),
+            "sent": w.sent,
+            "completed": w.completed,
+            "status": w.status,
+            "errors": w.errors,
+            "latency_hist": w.latency.to_compact(),
+            "service_hist": w.service.to_compact(),
+        }
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        elapsed = max(now - self.started, 1e-9)
+        return {
+            "process_id": self.process_id,
+            "ts": round(now, 3),
+            "elapsed_s": round(elapsed, 3),
+            "sent": self.sent,
+            "completed": self.completed,
+            "inflight": self.sent - self.completed,
+            "throughput_per_s": round(self.completed / elapsed, 2),
+            "max_send_lag_ms": round(self.max_send_lag_s * 1000, 3),
+            "status": dict(self.status),
+            "errors": dict(self.errors),
+            "latency": self.latency.summary(),
+            "service": self.service.summary(),
+            "latency_hist": self.latency.to_compact(),
+            "service_hist": self.service.to_compact(),
+        }
+
+    def write_snapshot(self, path: str) -> dict:
+        # 読み手が書きかけを見ないよう、一時ファイルに書いてから置き換える
+        snap = self.snapshot()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(snap, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        return snap
+
+
+class ClusterStats:
+    def __init__(self):
+        self.started = time.time()
+        self.latency = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.sent = 0
+        self.completed = 0
+        self.status: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.timeline: List[dict] = []
+        self.pending: List[dict] = []
+        self._last_row = self.started
+
+    def add_window(self, w: dict):
+        self.pending.append(w)
+        self.latency.merge_compact(w["latency_hist"])
+        self.service.merge_compact(w["service_hist"])
+        self.sent += w["sent"]
+        self.completed += w["completed"]
+        _add_counts(self.status, w["status"])
+        _add_counts(self.errors, w["errors"])
+
+    def flush_row(self) -> dict:
+        """前回の行以降に届いた区間集計をまとめてタイムラインに1行追加する。"""
+        now = time.time()
+        span = max(now - self._last_row, 1e-9)
+        self._last_row = now
+        lat = LatencyHistogram()
+        row = {"t": round(now - self.started, 1), "processes": len({w["process_id"] for w in self.pending}),
+               "sent": 0, "completed": 0, "status": {}, "errors": {}}
+        for w in self.pending:
+            lat.merge_compact(w["latency_hist"])
+            row["sent"] += w["sent"]
+            row["completed"] += w["completed"]
+            _add_counts(row["status"], w["status"])
+            _add_counts(row["errors"], w["errors"])
+        self.pending = []
+        row["throughput_per_s"] = round(row["completed"] / span, 2)
+        s = lat.summary()
+        row.update({k: s[k] for k in ("p50_ms", "p99_ms", "p99.9_ms", "max_ms")})
+        self.timeline.append(row)
+        return row
+
+    def report(self) -> dict:
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "sent": self.sent,
+            "completed": self.completed,
+            "throughput_per_s": round(self.completed / elapsed, 2),
+            "status": dict(self.status),
+            "errors": dict(self.errors),
+            "latency": self.latency.summary(),
+            "service": self.service.summary(),
+            "latency_hist": self.latency.to_compact(),
+            "timeline": self.timeline,
+        }
@@ -0,0 +1,38 @@
+import asyncio
+import httpx
+import time
+import uuid
+import logging
+import os
+import uvloop
+
+logging.basicConfig(level=logging.INFO, format="[Monitor] %(asctime)s - %(message)s")
+logger = logging.getLogger("Monitor")
+API_URL = os.getenv("API_URL", "http://nginx:80/api/v1/vehicle/climate/start")
+TIMEOUT_S = float(os.getenv("CLIENT_TIMEOUT_S", "60"))
+
+async def run_monitor():
+    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    async with httpx.AsyncClient(limits=limits, timeout=TIMEOUT_S) as client:
+        logger.info("Started (1 probe/sec)")
+        while True:
+            # MonitorはランダムなユーザーIDでOK
+            req_id = f"MONITOR-{uuid.uuid4()}"
+            start_ts = time.time()
+            try:
+                resp = await client.post(
+                    API_URL,
+                    json={"user_id": "monitor-user", "vehicle_id": "monitor-vin"},
+                    headers={"X-Request-ID": req_id},
+                )
+                duration = time.time() - start_ts
+                if resp.status_code == 200:
+                    logger.info(f"OK ({duration:.2f}s)")
+                else:
+                    logger.error(f"ERROR Status:{resp.status_code} ({duration:.2f}s)")
+            except Exception as e:
+                logger.error(f"FAILED: {type(e).__name__}")
+            await asyncio.sleep(1)
+
+if __name__ == "__main__":
+    uvloop.run(run_monitor())  # ループを作る前に uvloop を選ぶ (実行中のループ内で install しても効かない)
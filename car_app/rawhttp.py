@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+import itertools
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# === 軽量 HTTP/1.1 クライアント (負荷生成専用) ===
+# httpx の代わりに asyncio の Protocol で直接しゃべる。対象は POST /climate/start の1種類だけ。
+#   - リクエストは事前にエンコードしたテンプレートに ID 部分だけを差し込んで組み立てる
+#   - 接続は起動時に connections 本張って使い回す (keep-alive)。切れたら張り直す
+#   - 1接続あたり pipeline 件まで応答を待たずに送る (1ならパイプラインなし)
+#   - 応答はステータス行と Content-Length (または chunked) だけを見て読み飛ばす
+# 送信ごとにタスクは作らず Future を返す。空き接続がなければ待ち行列に積む。
+# 応答待ちが timeout 秒を超えた接続は切り、その接続で待っていたリクエストは TimeoutError になる。
+
+
+class _Conn(asyncio.Protocol):
+    def __init__(self, client: "RawClient"):
+        self.client = client
+        self.transport: Optional[asyncio.Transport] = None
+        self.pending: Deque[Tuple[asyncio.Future, float]] = deque()
+        self.buf = bytearray()
+        self.closed = False
+        self.timed_out = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, data: bytes, fut: asyncio.Future):
+        self.pending.append((fut, time.monotonic()))
+        self.transport.write(data)
+
+    def data_received(self, data: bytes):
+        self.buf += data
+        while self.pending:
+            n = self._parse_one()
+            if n is None:
+                return
+            status, close = n
+            fut, _ = self.pending.popleft()
+            if not fut.done():
+                fut.set_result(status)
+            if close:
+                self.transport.close()
+                return
+            self.client._on_free(self)
+
+    def _parse_one(self) -> Optional[Tuple[int, bool]]:
+        buf = self.buf
+        end = buf.find(b"\r\n\r\n")
+        if end < 0:
+            return None
+        head = bytes(buf[:end]).lower()
+        body = end + 4
+        i = head.find(b"\r\ncontent-length:")
+        if i >= 0:
+            j = head.find(b"\r\n", i + 2)
+            total = body + int(head[i + 17:j if j >= 0 else len(head)])
+        elif b"\r\ntransfer-encoding: chunked" in head:
+            total = self._chunked_end(body)
+            if total is None:
+                return None
+        else:
+            total = body
+        if len(buf) < total:
+            return None
+        status = int(buf[9:12])
+        del buf[:total]
+        return status, b"\r\nconnection: close" in head
+
+    def _chunked_end(self, pos: int) -> Optional[int]:
+        buf = self.buf
+        while True:
+            j = buf.find(b"\r\n", pos)
+            if j < 0:
+                return None
+            size = int(bytes(buf[pos:j]).split(b";")[0], 16)
+            pos = j + 2 + size + 2
+            if size == 0:
+                return pos if len(buf) >= pos else None
+
+    def connection_lost(self, exc):
+        self.closed = True
+        while self.pending:
+            fut, _ = self.pending.popleft()
+            if not fut.done():
+                fut.set_exception(TimeoutError() if self.timed_out else ConnectionError(str(exc or "connection closed")))
+        self.client._on_lost(self)
+
+
+class RawClient:
+    def __init__(self, url: str, connections: int = 256, pipeline: int = 1, timeout: float = 65.0,
+                 id_prefix: str = ""):
+        u = urlsplit(url)
+        self.host = u.hostname or "localhost"
+        self.port = u.port or 80
+        self.connections = max(1, connections)
+        self.pipeline = max(1, pipeline)
+        self.timeout = timeout
+        netloc = self.host if self.port == 80 else f"{self.host}:{self.port}"
+        self._head = (f"POST {u.path or '/'} HTTP/1.1\r\nHost: {netloc}\r\n"
+                      "Content-Type: application/json\r\nX-Request-ID: ").encode()
+        self._rid_prefix = (id_prefix or os.urandom(4).hex() + "-").encode()
+        self._seq = itertools.count(1)
+        self._conns: List[_Conn] = []
+        self._rr = 0
+        self._waiting: Deque[Tuple[bytes, asyncio.Future, float]] = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks = set()
+        self._closing = False
+        self.connects = 0
+        self.reconnects = 0
+
+    # --- 接続 ---
+    async def start(self):
+        # 接続が揃うまで (最大 timeout 秒) 待つ。相手が落ちていても張り直しは裏で続く
+        self._loop = asyncio.get_running_loop()
+        self._spawn(self._sweeper())
+        connecting = [self._spawn(self._connect()) for _ in range(self.connections)]
+        await asyncio.wait(connecting, timeout=self.timeout)
+
+    async def _connect(self):
+        delay = 0.05
+        while not self._closing:
+            try:
+                _, conn = await self._loop.create_connection(lambda: _Conn(self), self.host, self.port)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                continue
+            self.connects += 1
+            self._conns.append(conn)
+            self._on_free(conn)
+            return
+
+    def _spawn(self, coro):
+        t = self._loop.create_task(coro)
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+        return t
+
+    def _on_lost(self, conn: _Conn):
+        if conn in self._conns:
+            self._conns.remove(conn)
+        if not self._closing:
+            self.reconnects += 1
+            self._spawn(self._connect())
+
+    def _on_free(self, conn: _Conn):
+        while self._waiting and not conn.closed and len(conn.pending) < self.pipeline:
+            data, fut, _ = self._waiting.popleft()
+            conn.send(data, fut)
+
+    async def _sweeper(self):
+        # 応答が返ってこない接続と、空き接続を待ちすぎたリクエストを timeout で打ち切る
+        while True:
+            await asyncio.sleep(min(1.0, self.timeout / 4))
+            now = time.monotonic()
+            for conn in list(self._conns):
+                if conn.pending and now - conn.pending[0][1] > self.timeout:
+                    conn.timed_out = True
+                    conn.transport.abort()
+            while self._waiting and now - self._waiting[0][2] > self.timeout:
+                _, fut, _ = self._waiting.popleft()
+                if not fut.done():
+                    fut.set_exception(TimeoutError())
+
+    # --- 送信 ---
+    def build(self, user_json: bytes, vehicle_json: bytes, session: Optional[bytes],
+              extra_headers: bytes = b"", rid: Optional[bytes] = None) -> Tuple[bytes, bytes]:
+        """(リクエスト全体, X-Request-ID) を返す。user_json / vehicle_json は JSON 文字列 (引用符込み)。
+        extra_headers は b"Name: value\\r\\n" を連結したもの。rid を省略すると連番で振る。"""
+        rid = rid or self._rid_prefix + b"%x" % next(self._seq)
+        body = b'{"user_id":' + user_json + b',"vehicle_id":' + vehicle_json + b"}"
+        parts = [self._head, rid]
+        if session:
+            parts += (b"\r\nX-Proxy-Session: ", session)
+        parts += (b"\r\n", extra_headers, b"Content-Length: ", b"%d" % len(body), b"\r\n\r\n", body)
+        return b"".join(parts), rid
+
+    def submit(self, data: bytes) -> asyncio.Future:
+        """組み立て済みのリクエストを送り、ステータスコードを結果に持つ Future を返す。"""
+        fut = self._loop.create_future()
+        n = len(self._conns)
+        for k in range(n):
+            conn = self._conns[(self._rr + k) % n]
+            if len(conn.pending) < self.pipeline and not conn.closed:
+                self._rr = (self._rr + k + 1) % n
+                conn.send(data, fut)
+                return fut
+        self._waiting.append((data, fut, time.monotonic()))
+        return fut
+
+    def stats(self) -> dict:
+        return {
+            "raw_connections": len(self._conns),
+            "raw_inflight": sum(len(c.pending) for c in self._conns),
+            "raw_waiting": len(self._waiting),
+            "raw_connects": self.connects,
+            "raw_reconnects": self.reconnects,
+        }
+
+    # --- 終了 ---
+    async def close(self):
+        self._closing = True
+        for t in list(self._tasks):
+            t.cancel()
+        for conn in list(self._conns):
+            conn.transport.close()
+        while self._waiting:
+            _, fut, _ = self._waiting.popleft()
+            if not fut.done():
+                fut.set_exception(ConnectionError("client closed"))
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
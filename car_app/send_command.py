@@ -1,4 +1,5 @@
 import os
+import json
 import asyncio
 import uuid
 import logging
@@ -7,11 +8,15 @@ import httpx
 import time
 import sys
 import resource
+import signal
 import uvloop
+from loadstats import LoadStats
+from traffic import TraceReader, TraceWriter
+from rawhttp import RawClient
 
 # --- 設定 ---
 # 1プロセスあたりの担当ユーザー数 (3000人)
-USERS_PER_PROCESS = 3000
+USERS_PER_PROCESS = int(os.getenv("USERS_PER_PROCESS", "3000"))
 # 全体のサイクル秒数 (12プロセス × 5秒 = 60秒)
 TOTAL_CYCLE_SECONDS = 60
 
@@ -24,7 +29,7 @@ except ValueError:
 
 # このプロセスが担当するユーザーIDの開始番号
 # Proc 0: 0-2999, Proc 1: 3000-5999, ...
-USER_ID_OFFSET = PROCESS_ID * USERS_PER_PROCESS
+USER_ID_OFFSET = int(os.getenv("USER_ID_BASE", "0")) + PROCESS_ID * USERS_PER_PROCESS
 
 # ログ設定
 logging.basicConfig(level=logging.INFO, format=f"[Proc-{PROCESS_ID:02d}] %(asctime)s - %(message)s")
@@ -40,6 +45,47 @@ OVERLOAD_BURST = 270
 
 TIMEOUT_S = float(os.getenv("CLIENT_TIMEOUT_S", "65"))
 
+# 送信エンジン
+#   httpx: 従来どおり httpx.AsyncClient (1リクエスト1タスク)
+#   raw  : rawhttp.RawClient (テンプレート + keep-alive + パイプライン。1プロセスで高いレートを出す用)
+CLIENT_ENGINE = os.getenv("CLIENT_ENGINE", "httpx")
+RAW_CONNECTIONS = int(os.getenv("RAW_CONNECTIONS", "256"))  # raw: 張っておく接続数
+RAW_PIPELINE = int(os.getenv("RAW_PIPELINE", "1"))          # raw: 1接続あたり応答待ちにできる数 (1でパイプラインなし)
+
+# 送信モード
+#   burst   : 従来どおり 60 秒周期で NORMAL_BURST / OVERLOAD_BURST 件をまとめて投げる
+#   constant: LOAD_RATE 件/秒 を等間隔で投げる (オープンループ)
+#   poisson : LOAD_RATE 件/秒 を指数分布の間隔で投げる (オープンループ)
+#   replay  : REPLAY_PATH のトレース (traffic.py の形式) を記録時の間隔 / REPLAY_SCALE で再生する
+# どのモードでも応答を待たずに次を送り、レイテンシは「予定送信時刻」から測る (coordinated omission 補正)
+LOAD_MODE = os.getenv("LOAD_MODE", "burst")
+LOAD_RATE = float(os.getenv("LOAD_RATE", "10"))            # 1プロセスあたりの送信レート (件/秒)
+LOAD_DURATION_S = float(os.getenv("LOAD_DURATION_S", "0"))  # オープンループの実行秒数 (0で止めない)
+LOAD_SEED = int(os.getenv("LOAD_SEED", "0"))               # poisson 間隔の乱数シード (PROCESS_ID を足して使う)
+REPLAY_PATH = os.getenv("REPLAY_PATH", "")                 # 再生するトレース (glob / カンマ区切り可)
+REPLAY_SCALE = float(os.getenv("REPLAY_SCALE", "1"))       # 2 なら記録の2倍速で送る
+LOAD_PROCESSES = int(os.getenv("LOAD_PROCESSES", "1"))     # 再生を分担するプロセス数 (launcher が設定)
+
+# 送信したリクエストの記録 (空で無効)。{pid} は PROCESS_ID に置き換える
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")
+
+# 集計スナップショット (プロセスごとに1ファイル、STATS_SNAPSHOT_S 秒ごとに上書き)
+STATS_DIR = os.getenv("STATS_DIR", "stats")
+STATS_SNAPSHOT_S = float(os.getenv("STATS_SNAPSHOT_S", "5"))
+STATS_PATH = os.path.join(STATS_DIR, f"loadgen-{PROCESS_ID:02d}.json")
+
+# launcher から起動された場合 (シナリオ実行)
+#   LOAD_PHASES  : このプロセスが順に実行するフェーズの JSON 配列 (rate は1プロセスあたりに換算済み)
+#   LOAD_START_AT: 全プロセス共通のフェーズ開始時刻 (epoch 秒)
+#   STATS_FD     : 区間集計を1行1 JSON で書き込むパイプ
+LOAD_PHASES = json.loads(os.getenv("LOAD_PHASES", "[]"))
+LOAD_START_AT = float(os.getenv("LOAD_START_AT", "0"))
+STATS_FD = int(os.getenv("STATS_FD", "-1"))
+
+stats = LoadStats(PROCESS_ID)
+capture = TraceWriter(CAPTURE_PATH.format(pid=f"{PROCESS_ID:02d}")) if CAPTURE_PATH else None
+_tasks = set()  # 投げっぱなしのタスクが GC されないよう参照を持つ
+
 def maximize_fd_limit():
     try:
         soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -55,68 +101,267 @@ def pick_user_and_vehicle():
     proxy_session = f"dev-{i:06d}"
     return user_id, vehicle_id, proxy_session
 
-async def send_request(client):
-    user_id, vehicle_id, proxy_session = pick_user_and_vehicle()
-    request_id = str(uuid.uuid4())
+async def send_request(client, intended, rec=None):
+    # rec: 再生時はトレースの1行 (ID とヘッダを記録どおりに送る)
+    if rec is None:
+        user_id, vehicle_id, proxy_session = pick_user_and_vehicle()
+        headers = {"X-Request-ID": str(uuid.uuid4())}
+    else:
+        user_id, vehicle_id, proxy_session = rec.get("u"), rec.get("v"), rec.get("s")
+        headers = {"X-Request-ID": str(uuid.uuid4()), **rec.get("h", {})}
+    if proxy_session:
+        headers["X-Proxy-Session"] = proxy_session
+    actual = time.time()
+    stats.on_send(intended, actual)
+    if capture:
+        capture.write(actual, user_id, vehicle_id, proxy_session, headers)
     try:
-        await client.post(
+        resp = await client.post(
             API_URL,
             json={"user_id": user_id, "vehicle_id": vehicle_id},
-            headers={"X-Request-ID": request_id, "X-Proxy-Session": proxy_session},
+            headers=headers,
         )
-    except:
-        pass
+        stats.on_done(intended, actual, time.time(), status=resp.status_code)
+    except Exception as e:
+        stats.on_done(intended, actual, time.time(), error=type(e).__name__)
+
+def fire(client, intended, rec=None):
+    if isinstance(client, RawClient):
+        fire_raw(client, intended, rec)
+        return
+    t = asyncio.create_task(send_request(client, intended, rec))
+    _tasks.add(t)
+    t.add_done_callback(_tasks.discard)
+
+# raw エンジン用: 担当ユーザーの ID を JSON / ヘッダ用のバイト列にしておく (送信時は選ぶだけ)
+_raw_ids = []
+
+def _raw_pick():
+    if not _raw_ids:
+        for i in range(USER_ID_OFFSET, USER_ID_OFFSET + USERS_PER_PROCESS):
+            _raw_ids.append((f'"{USER_PREFIX}-{i:06d}"'.encode(), f'"vin-{i:06d}"'.encode(), f"dev-{i:06d}".encode()))
+    return _raw_ids[random.randrange(USERS_PER_PROCESS)]
+
+def _raw_from_record(rec):
+    h = dict(rec.get("h", {}))
+    rid = h.pop("X-Request-ID", None)
+    extra = "".join(f"{k}: {v}\r\n" for k, v in h.items()).encode()
+    s = rec.get("s")
+    return (json.dumps(rec.get("u")).encode(), json.dumps(rec.get("v")).encode(),
+            s.encode() if s else None, extra, rid.encode() if rid else None)
+
+def fire_raw(client, intended, rec=None):
+    # タスクを作らず、応答の Future に集計のコールバックを付けるだけ
+    if rec is None:
+        user_json, vehicle_json, session = _raw_pick()
+        data, rid = client.build(user_json, vehicle_json, session)
+    else:
+        user_json, vehicle_json, session, extra, rid = _raw_from_record(rec)
+        data, rid = client.build(user_json, vehicle_json, session, extra, rid)
+    actual = time.time()
+    stats.on_send(intended, actual)
+    if capture:
+        capture.write(actual, json.loads(user_json), json.loads(vehicle_json), session and session.decode(),
+                      {"X-Request-ID": rid.decode(), **(rec or {}).get("h", {})})
+    fut = client.submit(data)
+    _tasks.add(fut)
+    fut.add_done_callback(lambda f: _on_raw_done(f, intended, actual))
+
+def _on_raw_done(fut, intended, actual):
+    _tasks.discard(fut)
+    e = fut.exception()
+    if e is None:
+        stats.on_done(intended, actual, time.time(), status=fut.result())
+    else:
+        stats.on_done(intended, actual, time.time(), error=type(e).__name__)
 
 async def request_burst(client, n, batch_id):
     logger.info(f"Batch {batch_id} FIRE! ({n} reqs)")
+    # バースト内の全件は同じ時刻に送る予定だったものとして測る
+    intended = time.time()
     for _ in range(n):
-        asyncio.create_task(send_request(client))
+        fire(client, intended)
+
+async def sleep_until(t):
+    delay = t - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+async def run_open_loop(client, mode, rate, duration_s, start=None, rng=None):
+    # 予定送信時刻の列を先に決め、遅れたら遅れた分をまとめて送る (間引かない)
+    rng = rng or random.Random(LOAD_SEED + PROCESS_ID)
+    start = start or time.time()
+    end = start + duration_s if duration_s > 0 else float("inf")
+    logger.info(f"Open loop: mode={mode} rate={rate}/s duration={duration_s or 'inf'}s")
+    if rate <= 0:
+        await sleep_until(end)
+        return
+    intended = start
+    while intended < end:
+        await sleep_until(intended)
+        now = time.time()
+        while intended <= now and intended < end:
+            fire(client, intended)
+            if mode == "poisson":
+                intended += rng.expovariate(rate)
+            else:
+                intended += 1.0 / rate
+
+async def run_replay(client, path, scale, duration_s=0, start=None):
+    # トレースを1行ずつ読みながら送る。担当は PROCESS_ID / LOAD_PROCESSES で分ける
+    reader = TraceReader(path)
+    start = start or time.time()
+    end = start + duration_s if duration_s > 0 else float("inf")
+    scale = scale if scale > 0 else 1.0
+    logger.info(f"Replay: {len(reader.paths)} file(s) scale={scale}x shard={PROCESS_ID}/{LOAD_PROCESSES}")
+    if reader.t0 is None:
+        return
+    for rec in reader.records(PROCESS_ID, LOAD_PROCESSES):
+        intended = start + (rec["t"] - reader.t0) / scale
+        if intended >= end:
+            break
+        if intended > time.time():
+            await sleep_until(intended)
+        fire(client, intended, rec)
+
+async def run_burst_phase(client, burst, every_s, stagger_s, duration_s, start):
+    # every_s 秒ごとに burst 件。プロセスごとに stagger_s ずつずらす (従来の 0, 5, 10... 秒と同じ考え方)
+    end = start + duration_s
+    t = start + (PROCESS_ID * stagger_s) % every_s if every_s > 0 else start
+    batch_id = 0
+    while t < end:
+        await sleep_until(t)
+        batch_id += 1
+        await request_burst(client, burst, batch_id)
+        if every_s <= 0:
+            break
+        t += every_s
+
+async def run_phases(client, phases):
+    rng = random.Random(LOAD_SEED + PROCESS_ID)
+    t = LOAD_START_AT or time.time()
+    for ph in phases:
+        await sleep_until(t)
+        mode = ph.get("mode", "constant")
+        duration_s = float(ph.get("duration_s", 0))
+        logger.info(f"Phase '{ph.get('name', mode)}' start ({duration_s}s)")
+        if mode == "burst":
+            await run_burst_phase(client, int(ph.get("burst", OVERLOAD_BURST)), float(ph.get("every_s", TOTAL_CYCLE_SECONDS)),
+                                  float(ph.get("stagger_s", 0)), duration_s, t)
+        elif mode == "replay":
+            await run_replay(client, ph["trace"], float(ph.get("scale", 1)), duration_s, start=t)
+            if duration_s <= 0:
+                # 長さはトレース次第。次のフェーズは全プロセスで揃わないので各自の終了時刻から始める
+                t = time.time()
+                continue
+        else:
+            await run_open_loop(client, mode, float(ph.get("rate", 0)), duration_s, start=t, rng=rng)
+        t += duration_s
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(STATS_SNAPSHOT_S)
+        write_snapshot()
+
+def send_window(final=False):
+    if STATS_FD < 0:
+        return
+    msg = stats.take_window()
+    msg["final"] = final
+    try:
+        os.write(STATS_FD, (json.dumps(msg, separators=(",", ":")) + "\n").encode())
+    except OSError:
+        pass
+
+def write_snapshot(final=False):
+    send_window(final)
+    try:
+        snap = stats.write_snapshot(STATS_PATH)
+    except OSError as e:
+        logger.error(f"Snapshot write failed: {e}")
+        return
+    lat = snap["latency"]
+    logger.info(
+        f"sent={snap['sent']} done={snap['completed']} inflight={snap['inflight']} "
+        f"tput={snap['throughput_per_s']}/s p50={lat['p50_ms']}ms p99={lat['p99_ms']}ms "
+        f"p99.9={lat['p99.9_ms']}ms status={snap['status']} errors={snap['errors']}"
+    )
 
 async def run_requester():
-    uvloop.install()
     maximize_fd_limit()
+    # launcher からの SIGTERM でも最後の集計を送ってから終わる
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    if CLIENT_ENGINE == "raw":
+        logger.info(f"Engine: raw connections={RAW_CONNECTIONS} pipeline={RAW_PIPELINE}")
+        async with RawClient(API_URL, RAW_CONNECTIONS, RAW_PIPELINE, TIMEOUT_S, f"{os.urandom(3).hex()}-{PROCESS_ID:02d}-") as client:
+            await drive(client)
+        return
 
     limits = httpx.Limits(max_connections=5000, max_keepalive_connections=5000)
     timeout = httpx.Timeout(TIMEOUT_S)
 
     async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
-        # 基準となる開始時刻
-        base_start_time = time.time()
+        await drive(client)
+
+async def drive(client):
+    snap_task = asyncio.create_task(snapshot_loop())
+    try:
+        if LOAD_PHASES:
+            await run_phases(client, LOAD_PHASES)
+        elif LOAD_MODE == "replay":
+            await run_replay(client, REPLAY_PATH, REPLAY_SCALE, LOAD_DURATION_S)
+        elif LOAD_MODE in ("constant", "poisson"):
+            await run_open_loop(client, LOAD_MODE, LOAD_RATE, LOAD_DURATION_S)
+        else:
+            await run_bursts(client)
+        # 投げた分の応答 (またはタイムアウト) を待ってから終わる
+        if _tasks:
+            await asyncio.wait(list(_tasks))
+    finally:
+        snap_task.cancel()
+        write_snapshot(final=True)
+        if capture:
+            capture.close()
+
+async def run_bursts(client):
+    # 基準となる開始時刻
+    base_start_time = time.time()
+    
+    # 自分の最初の送信タイミングまで待機 (0, 5, 10... 55秒)
+    initial_delay = PROCESS_ID * 5
+    logger.info(f"Waiting {initial_delay}s to start first burst...")
+    await asyncio.sleep(initial_delay)
+
+    batch_id = 0
+    while True:
+        batch_id += 1
+        loop_start = time.time()
         
-        # 自分の最初の送信タイミングまで待機 (0, 5, 10... 55秒)
-        initial_delay = PROCESS_ID * 5
-        logger.info(f"Waiting {initial_delay}s to start first burst...")
-        await asyncio.sleep(initial_delay)
-
-        batch_id = 0
-        while True:
-            batch_id += 1
-            loop_start = time.time()
-            
-            # 経過時間（全体）
-            elapsed_total = loop_start - base_start_time
-
-            # 最初の20秒（全体時間での判断）はウォームアップ
-            if elapsed_total < 20 + initial_delay:
-                 burst_size = NORMAL_BURST
-            else:
-                 burst_size = OVERLOAD_BURST
+        # 経過時間（全体）
+        elapsed_total = loop_start - base_start_time
 
-            # バースト実行
-            asyncio.create_task(request_burst(client, burst_size, batch_id))
+        # 最初の20秒（全体時間での判断）はウォームアップ
+        if elapsed_total < 20 + initial_delay:
+             burst_size = NORMAL_BURST
+        else:
+             burst_size = OVERLOAD_BURST
 
-            # 次のサイクル (60秒後) まで待機
-            now = time.time()
-            sleep_duration = TOTAL_CYCLE_SECONDS - (now - loop_start)
-            
-            if sleep_duration > 0:
-                await asyncio.sleep(sleep_duration)
-            else:
-                await asyncio.sleep(0)
+        # バースト実行
+        asyncio.create_task(request_burst(client, burst_size, batch_id))
+
+        # 次のサイクル (60秒後) まで待機
+        now = time.time()
+        sleep_duration = TOTAL_CYCLE_SECONDS - (now - loop_start)
+        
+        if sleep_duration > 0:
+            await asyncio.sleep(sleep_duration)
+        else:
+            await asyncio.sleep(0)
 
 # Monitorプロセスは別途立ち上げるため、ここにはRequesterのみ記述
 if __name__ == "__main__":
     try:
-        asyncio.run(run_requester())
-    except KeyboardInterrupt:
+        uvloop.run(run_requester())  # ループを作る前に uvloop を選ぶ (実行中のループ内で install しても効かない)
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass
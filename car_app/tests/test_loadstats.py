@@ -0,0 +1,34 @@
+import pytest
+
+from loadstats import ClusterStats, LatencyHistogram, LoadStats
+
+
+def test_compact_round_trip_and_merge():
+    a, b = LatencyHistogram(), LatencyHistogram()
+    for i in range(1, 1001):
+        (a if i % 2 else b).record(i / 1000)
+    merged = LatencyHistogram.from_compact(a.to_compact())
+    merged.merge_compact(b.to_compact())
+    assert merged.count == 1000
+    assert merged.max_s == pytest.approx(1.0)
+    p50, p99 = merged.percentiles([50, 99])
+    assert p50 == pytest.approx(0.5, rel=0.02)
+    assert p99 == pytest.approx(0.99, rel=0.02)
+
+
+def test_windows_add_up_in_cluster_stats():
+    c = ClusterStats()
+    for pid in (1, 2):
+        s = LoadStats(pid)
+        for i in range(10):
+            s.on_send(100.0, 100.0)
+            s.on_done(100.0, 100.0, 100.0 + (i + 1) / 100, status=200 if i < 8 else 503)
+        s.on_send(100.0, 100.0)
+        s.on_done(100.0, 100.0, 100.5, error="ReadTimeout")
+        c.add_window(s.take_window())
+        assert s.take_window()["completed"] == 0
+    row = c.flush_row()
+    assert row["completed"] == 22 and row["processes"] == 2
+    assert c.status == {"200": 16, "503": 4}
+    assert c.errors == {"ReadTimeout": 2}
+    assert c.latency.count == 22
@@ -0,0 +1,82 @@
+import os
+import gzip
+import importlib.util
+
+import pytest
+
+from traffic import TraceReader, TraceWriter, record, shard_of
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_record_keeps_only_replay_headers():
+    rec = record(1000.0, "u", "v", "s", {"X-Request-ID": "r", "Authorization": "x", "X-Request-Deadline": "1010"})
+    assert rec == {"t": 1000.0, "u": "u", "v": "v", "s": "s", "h": {"X-Request-ID": "r", "X-Request-Deadline": "1010"}}
+    assert record(1_700_000_000.0, "u", "v", None, {"x-request-deadline": "1700000003"})["h"] == \
+        {"X-Request-Deadline": "3.0"}
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".jsonl.gz"])
+def test_files_are_merged_in_time_order(tmp_path, suffix):
+    a = TraceWriter(str(tmp_path / f"a{suffix}"))
+    b = TraceWriter(str(tmp_path / f"b{suffix}"))
+    for t in (1.0, 3.0, 5.0):
+        a.write(t, "ua", "v", None, {})
+    for t in (2.0, 4.0):
+        b.write(t, "ub", "v", None, {})
+    a.close()
+    b.close()
+    r = TraceReader(str(tmp_path / f"*{suffix}"))
+    assert r.t0 == 1.0
+    assert [x["t"] for x in r.records()] == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+
+def test_truncated_lines_are_skipped(tmp_path):
+    p = tmp_path / "t.jsonl"
+    p.write_text('{"t": 1, "u": "a"}\n\n{"t": 2, "u"\n')
+    assert [x["t"] for x in TraceReader(str(p)).records()] == [1]
+
+
+def test_truncated_gzip_is_read_up_to_the_cut(tmp_path):
+    p = tmp_path / "t.jsonl.gz"
+    with gzip.open(p, "wt") as f:
+        for i in range(200):
+            f.write(f'{{"t": {i}, "u": "u{i}"}}\n')
+    data = p.read_bytes()
+    p.write_bytes(data[:-8])  # 終端 (CRC/サイズ) がまだ書かれていない状態
+    assert len(list(TraceReader(str(p)).records())) == 200
+
+
+def test_shards_partition_records_and_keep_sessions_together(tmp_path):
+    w = TraceWriter(str(tmp_path / "t.jsonl"))
+    for i in range(100):
+        w.write(float(i), f"u{i % 7}", "v", f"s{i % 13}" if i % 2 else None, {})
+    w.close()
+    r = TraceReader(str(tmp_path / "t.jsonl"))
+    shards = [list(r.records(k, 4)) for k in range(4)]
+    assert sum(len(s) for s in shards) == 100
+    for k, recs in enumerate(shards):
+        assert all(shard_of(x, 4) == k for x in recs)
+        assert [x["t"] for x in recs] == sorted(x["t"] for x in recs)
+
+
+def test_missing_trace_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        TraceReader(str(tmp_path / "none-*.jsonl"))
+
+
+def test_cloud_api_capture_is_replayable(tmp_path):
+    # cloud_api の CAPTURE_PATH で記録したファイルをそのまま読めること
+    spec = importlib.util.spec_from_file_location(
+        "cloud_api_capture", os.path.join(HERE, "..", "..", "cloud_api", "capture.py"))
+    capture = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(capture)
+    path = str(tmp_path / "cap.jsonl")
+    cap = capture.TrafficCapture(path)
+    cap.open()
+    cap.record(10.0, {"user_id": "u", "vehicle_id": "v"}, {"x-proxy-session": "s", "x-request-id": "r"})
+    cap.record(11.0, {"user_id": "u2", "vehicle_id": "v2"}, {})
+    cap.close()
+    recs = list(TraceReader(path).records())
+    assert recs[0] == record(10.0, "u", "v", "s", {"X-Request-ID": "r"})
+    assert recs[1]["u"] == "u2"
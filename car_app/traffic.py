@@ -0,0 +1,102 @@
+import os
+import json
+import gzip
+import glob
+import heapq
+import zlib
+from typing import Dict, Iterator, List, Optional
+
+# === トラフィックの記録と再生 ===
+# 1リクエスト1行の JSONL (パスが .gz なら gzip)。キーは短くしてある:
+#   t: 到着 (送信) 時刻 epoch 秒 / u: user_id / v: vehicle_id / s: X-Proxy-Session
+#   h: 再現に必要なヘッダ (X-Request-ID, X-Request-Deadline は残り秒数に直して保存)
+# cloud_api 側 (CAPTURE_PATH) でも同じ形式で書く。
+#
+# 再生は行を1件ずつ読んで送るのでメモリはトレースの長さに比例しない。
+#   - 複数ファイル (ワーカーごとの記録など) は時刻順にマージしながら読む
+#   - 送信プロセス間では s (なければ u) のハッシュで分担し、同じセッションの順序を保つ
+#   - 時刻は全ファイルの先頭時刻 t0 からの経過を scale で割って予定送信時刻にする
+
+KEEP_HEADERS = ("X-Request-ID", "X-Request-Deadline")
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8", buffering=1 << 16)
+
+
+def record(t: float, user_id, vehicle_id, session, headers: Dict[str, str]) -> dict:
+    rec = {"t": round(t, 6), "u": user_id, "v": vehicle_id, "s": session}
+    h = {}
+    for k in KEEP_HEADERS:
+        v = headers.get(k) or headers.get(k.lower())
+        if v:
+            h[k] = v
+    d = h.get("X-Request-Deadline")
+    if d:
+        try:
+            f = float(d)
+            if f > 1e9:  # 絶対時刻で来た期限は、再生時にずれないよう残り秒数にする
+                h["X-Request-Deadline"] = str(round(f - t, 3))
+        except ValueError:
+            pass
+    if h:
+        rec["h"] = h
+    return rec
+
+
+class TraceWriter:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._f = _open(path, "a")
+        self.count = 0
+
+    def write(self, t: float, user_id, vehicle_id, session, headers: Dict[str, str]):
+        self._f.write(json.dumps(record(t, user_id, vehicle_id, session, headers), separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def close(self):
+        self._f.close()
+
+
+def _lines(path: str) -> Iterator[dict]:
+    with _open(path, "r") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # 書きかけの最終行など
+                if "t" in rec:
+                    yield rec
+        except EOFError:
+            return  # 記録中の .gz (終端マーカーがまだ無い)
+
+
+def shard_of(rec: dict, shards: int) -> int:
+    key = rec.get("s") or rec.get("u") or ""
+    return zlib.crc32(str(key).encode()) % shards
+
+
+class TraceReader:
+    def __init__(self, pattern: str):
+        # カンマ区切り / glob 可
+        self.paths: List[str] = sorted({p for pat in pattern.split(",") if pat for p in glob.glob(pat)})
+        if not self.paths:
+            raise FileNotFoundError(pattern)
+        firsts = [next(_lines(p), None) for p in self.paths]
+        ts = [r["t"] for r in firsts if r is not None]
+        self.t0: Optional[float] = min(ts) if ts else None
+
+    def records(self, shard: int = 0, shards: int = 1) -> Iterator[dict]:
+        """時刻順 (各ファイル内は記録順) に、この shard の担当分だけを返す。"""
+        streams = [_lines(p) for p in self.paths]
+        merged = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda r: r["t"])
+        for rec in merged:
+            if shards <= 1 or shard_of(rec, shards) == shard:
+                yield rec
@@ -0,0 +1,90 @@
+import math, time
+from typing import Mapping, Optional
+
+# === 期限付きアドミッション制御 ===
+# リクエストごとの期限 (X-Request-Deadline もしくはプロキシのタイムアウト) と
+# 現在の処理レートから待ち時間を見積もり、期限内に終わらないものは入口で即 503 にする。
+#   X-Request-Deadline: エポック秒 (例 1700000000.5) もしくは残り秒数 (例 30)
+# 起動直後やアイドル明けで実測がないときは service_prior_s (1件の処理時間の事前値) で見積もる。
+
+
+class AdmissionController:
+    def __init__(self, default_budget_s: float, margin_s: float = 0.5, alpha: float = 0.3,
+                 service_prior_s: float = 0.1):
+        self.default_budget_s = default_budget_s
+        self.margin_s = margin_s
+        self.alpha = alpha
+        self.service_prior_s = service_prior_s
+        self._svc_ewma: Optional[float] = None  # セッション確保後の処理時間 (fsync + 下流)
+        self._rate_ewma = 0.0                   # 新規セッションの確保レート (件/秒)
+        self._bucket_t = int(time.monotonic())
+        self._bucket_n = 0
+        self.queued = 0  # 受け付け済みでセッション確保待ちの数 (ensure 到達前も含む)
+
+    # --- 期限 ---
+    def deadline_from(self, headers: Mapping[str, str], now: float) -> float:
+        v = headers.get("x-request-deadline")
+        if v:
+            try:
+                f = float(v)
+                return f if f > 1e9 else now + f
+            except ValueError:
+                pass
+        return now + self.default_budget_s
+
+    # --- 観測 ---
+    def _roll(self):
+        t = int(time.monotonic())
+        if t == self._bucket_t:
+            return
+        a = self.alpha
+        self._rate_ewma = a * self._bucket_n + (1 - a) * self._rate_ewma
+        # 空だった秒の分だけ減衰させる
+        idle = min(t - self._bucket_t - 1, 60)
+        if idle > 0:
+            self._rate_ewma *= (1 - a) ** idle
+        self._bucket_t = t
+        self._bucket_n = 0
+
+    def on_admit(self):
+        self._roll()
+        self._bucket_n += 1
+
+    def on_service(self, dt: float):
+        s = self._svc_ewma
+        self._svc_ewma = dt if s is None else self.alpha * dt + (1 - self.alpha) * s
+
+    def admit_rate(self) -> float:
+        self._roll()
+        return self._rate_ewma
+
+    @property
+    def service_s(self) -> float:
+        return self._svc_ewma if self._svc_ewma is not None else self.service_prior_s
+
+    # --- 判定 ---
+    def estimate_wait(self, known: bool, free: int) -> float:
+        """セッション確保までの待ち時間の見積もり。確保レートが未観測なら前の要求が1件ずつ処理される前提で見積もる。"""
+        ahead = self.queued
+        if known or free > ahead:
+            return 0.0
+        r = self.admit_rate()
+        if r <= 0:
+            return (ahead - free + 1) * self.service_s
+        return (ahead - free + 1) / r
+
+    def check(self, deadline: float, now: float, est_wait: Optional[float]):
+        """(admit, 残り予算秒, Retry-After秒) を返す。"""
+        remaining = deadline - now - self.margin_s
+        need = (est_wait or 0.0) + self.service_s
+        if remaining <= 0 or need > remaining:
+            retry = max(1, math.ceil(est_wait if est_wait is not None else self.service_s))
+            return False, remaining, retry
+        return True, remaining, 0
+
+    def stats(self) -> dict:
+        return {
+            "admission_rate_per_s": round(self.admit_rate(), 2),
+            "admission_service_ewma_s": round(self.service_s, 4),
+            "admission_queued": self.queued,
+        }
@@ -0,0 +1,182 @@
+import os, time, asyncio, threading
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+# === 監査ログ: グループコミット ===
+# 1本の常駐 fd に対し、複数リクエストのレコードをまとめて write + fsync 1回で永続化する。
+# append() が返す Future は「自分のレコードが fsync 済み」になって初めて完了する
+# (= 従来の 1req/1fsync と同じ耐久性の約束を維持する)。
+
+_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _resolve(fut: asyncio.Future, exc: Optional[BaseException]):
+    # リクエスト側がキャンセル済みなら何もしない
+    if fut.done():
+        return
+    if exc is None:
+        fut.set_result(None)
+    else:
+        fut.set_exception(exc)
+
+
+class GroupCommitLog:
+    def __init__(self, path: str, chunk_kb: int, max_batch: int = 256, max_linger_s: float = 0.002):
+        self.path = path
+        self.max_batch = max(1, max_batch)
+        self.max_linger_s = max(0.0, max_linger_s)
+        self._pad = b"x" * (chunk_kb * 1024) if chunk_kb > 0 else b""
+        self._fd: Optional[int] = None
+        self._q: Deque[Tuple[bytes, asyncio.Future, asyncio.AbstractEventLoop, float]] = deque()
+        self._cv = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+        # 統計 (writer スレッドのみが更新、読み出しは _st_lock 下)
+        self._st_lock = threading.Lock()
+        self._commits = 0
+        self._records = 0
+        self._bytes = 0
+        self._last_batch = 0
+        self._max_batch_seen = 0
+        self._batch_hist = [0] * len(_BATCH_BUCKETS)
+        self._fsync_total_s = 0.0
+        self._fsync_max_s = 0.0
+        self._durable_total_s = 0.0
+        self._durable_max_s = 0.0
+        self._failures = 0
+
+    # --- lifecycle ---
+    def open(self):
+        if self._fd is not None:
+            return
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._fd = os.open(self.path, os.O_CREAT | os.O_APPEND | os.O_WRONLY, 0o644)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: float = 5.0):
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    # --- API ---
+    def append(self, line: str) -> asyncio.Future:
+        """レコードを投入し、fsync 完了で解決される Future を返す。"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        rec = (line + "\n").encode() + self._pad
+        with self._cv:
+            if self._closed or self._fd is None:
+                raise RuntimeError("audit log is not open")
+            self._q.append((rec, fut, loop, time.monotonic()))
+            self._cv.notify()
+        return fut
+
+    def pending(self) -> int:
+        with self._cv:
+            return len(self._q)
+
+    # --- writer thread ---
+    def _take_batch(self) -> List[Tuple[bytes, asyncio.Future, asyncio.AbstractEventLoop, float]]:
+        with self._cv:
+            while not self._q and not self._closed:
+                self._cv.wait()
+            if not self._q:
+                return []
+            # 先頭が来たら max_linger だけ後続を待つ (max_batch に達したら即コミット)
+            if self.max_linger_s > 0:
+                deadline = time.monotonic() + self.max_linger_s
+                while len(self._q) < self.max_batch and not self._closed:
+                    rem = deadline - time.monotonic()
+                    if rem <= 0:
+                        break
+                    self._cv.wait(rem)
+            n = min(len(self._q), self.max_batch)
+            return [self._q.popleft() for _ in range(n)]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._commit(batch)
+
+    def _commit(self, batch):
+        buf = b"".join(r[0] for r in batch)
+        exc: Optional[BaseException] = None
+        t0 = time.monotonic()
+        try:
+            mv = memoryview(buf)
+            while mv:
+                n = os.write(self._fd, mv)
+                mv = mv[n:]
+            os.fsync(self._fd)
+        except BaseException as e:  # 失敗はバッチ全員に伝播させる
+            exc = e
+        t1 = time.monotonic()
+
+        for _, fut, loop, _ in batch:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut, exc)
+            except RuntimeError:
+                pass  # ループ終了済み
+
+        n = len(batch)
+        oldest = min(r[3] for r in batch)
+        with self._st_lock:
+            if exc is not None:
+                self._failures += 1
+                return
+            self._commits += 1
+            self._records += n
+            self._bytes += len(buf)
+            self._last_batch = n
+            if n > self._max_batch_seen:
+                self._max_batch_seen = n
+            for i, ub in enumerate(_BATCH_BUCKETS):
+                if n <= ub:
+                    self._batch_hist[i] += 1
+                    break
+            else:
+                self._batch_hist[-1] += 1
+            fs = t1 - t0
+            self._fsync_total_s += fs
+            if fs > self._fsync_max_s:
+                self._fsync_max_s = fs
+            dl = t1 - oldest
+            self._durable_total_s += dl
+            if dl > self._durable_max_s:
+                self._durable_max_s = dl
+
+    # --- metrics ---
+    def stats(self) -> dict:
+        q = self.pending()
+        with self._st_lock:
+            c = self._commits
+            return {
+                "audit_commits": c,
+                "audit_records": self._records,
+                "audit_bytes": self._bytes,
+                "audit_failures": self._failures,
+                "audit_queue_depth": q,
+                "audit_records_per_fsync": round(self._records / c, 2) if c else 0.0,
+                "audit_last_batch": self._last_batch,
+                "audit_max_batch_seen": self._max_batch_seen,
+                "audit_batch_hist": {f"le_{ub}": v for ub, v in zip(_BATCH_BUCKETS, self._batch_hist)},
+                "audit_fsync_avg_ms": round(self._fsync_total_s / c * 1000, 3) if c else 0.0,
+                "audit_fsync_max_ms": round(self._fsync_max_s * 1000, 3),
+                "audit_commit_latency_avg_ms": round(self._durable_total_s / c * 1000, 3) if c else 0.0,
+                "audit_commit_latency_max_ms": round(self._durable_max_s * 1000, 3),
+                "audit_max_batch": self.max_batch,
+                "audit_max_linger_ms": round(self.max_linger_s * 1000, 3),
+            }
@@ -0,0 +1,99 @@
+import time, asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+# === 下流コマンドのマイクロバッチ ===
+# 同時に来たコマンドを最大 max_items 件 / max_linger_s 秒まで溜めて1回の下流リクエストにまとめ、
+# 結果 (入力と同じ順序のリスト) を各呼び出し元の Future に配り直す。
+# 接続プールの大きさはそのままで、1往復あたりのコマンド数を増やすのが目的。
+
+_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+_LINGER_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100)
+
+SendFn = Callable[[List[dict]], Awaitable[List[dict]]]
+
+
+def _bucket(hist: List[int], bounds, v):
+    for i, ub in enumerate(bounds):
+        if v <= ub:
+            hist[i] += 1
+            return
+    hist[-1] += 1
+
+
+class MicroBatcher:
+    def __init__(self, send: SendFn, max_items: int = 32, max_linger_s: float = 0.002):
+        self._send = send
+        self.max_items = max(1, max_items)
+        self.max_linger_s = max(0.0, max_linger_s)
+        self._items: List[Tuple[dict, asyncio.Future]] = []
+        self._first_t = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+        self.batches = 0
+        self.items = 0
+        self.failures = 0
+        self._size_hist = [0] * len(_SIZE_BUCKETS)
+        self._linger_hist = [0] * len(_LINGER_BUCKETS_MS)
+
+    def submit(self, item: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        if not self._items:
+            self._first_t = time.monotonic()
+        self._items.append((item, fut))
+        if len(self._items) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_linger_s, self._flush)
+        return fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._items:
+            return
+        batch, self._items = self._items, []
+        _bucket(self._size_hist, _SIZE_BUCKETS, len(batch))
+        _bucket(self._linger_hist, _LINGER_BUCKETS_MS, (time.monotonic() - self._first_t) * 1000)
+        t = asyncio.ensure_future(self._dispatch(batch))
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: List[Tuple[dict, asyncio.Future]]):
+        # 全員キャンセル済みなら下流に送らない
+        live = [(it, f) for it, f in batch if not f.done()]
+        if not live:
+            return
+        try:
+            results = await self._send([it for it, _ in live])
+            if len(results) != len(live):
+                raise RuntimeError(f"batch result size mismatch: {len(results)} != {len(live)}")
+        except BaseException as e:
+            self.failures += 1
+            for _, f in live:
+                if not f.done():
+                    f.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        self.batches += 1
+        self.items += len(live)
+        for (_, f), r in zip(live, results):
+            if not f.done():
+                f.set_result(r)
+
+    def stats(self) -> dict:
+        b = self.batches
+        return {
+            "batch_count": b,
+            "batch_items": self.items,
+            "batch_failures": self.failures,
+            "batch_avg_size": round(self.items / b, 2) if b else 0.0,
+            "batch_size_hist": {f"le_{ub}": v for ub, v in zip(_SIZE_BUCKETS, self._size_hist)},
+            "batch_linger_ms_hist": {f"le_{ub}": v for ub, v in zip(_LINGER_BUCKETS_MS, self._linger_hist)},
+            "batch_inflight": len(self._tasks),
+            "batch_max_items": self.max_items,
+            "batch_max_linger_ms": round(self.max_linger_s * 1000, 3),
+        }
@@ -0,0 +1,106 @@
+import time
+from typing import Callable, Dict, Tuple
+
+# === 下流 (vehicle) 向けサーキットブレーカー ===
+#   closed   : 通常。直近窓のタイムアウト率が閾値を超えたら open へ
+#   open     : セッション確保も fsync もせず即失敗させる。open_s 経過で half_open へ
+#   half_open: probes 件だけ通して様子を見る。close_after 回成功で closed、タイムアウトで open に戻る
+# タイムアウト率は main の _recent() (直近 METRICS_WINDOW_S 秒) をそのまま使う。
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+RatioFn = Callable[[], Tuple[int, float]]  # (直近の到着数, タイムアウト率)
+
+
+class CircuitBreaker:
+    def __init__(self, ratio_fn: RatioFn, ratio_threshold: float = 0.5, min_requests: int = 20,
+                 open_s: float = 5.0, probes: int = 1, close_after: int = 3,
+                 grace_s: float = 5.0, eval_interval_s: float = 0.2):
+        self._ratio_fn = ratio_fn
+        self.ratio_threshold = ratio_threshold
+        self.min_requests = min_requests
+        self.open_s = open_s
+        self.probes = max(1, probes)
+        self.close_after = max(1, close_after)
+        self.grace_s = grace_s  # closed に戻った直後は古い窓の比率で再び開かない
+        self.eval_interval_s = eval_interval_s
+
+        self.state = CLOSED
+        self._since = time.monotonic()
+        self._open_until = 0.0
+        self._probing = 0
+        self._probe_ok = 0
+        self._next_eval = 0.0
+        self._last_ratio = 0.0
+        self.rejected = 0
+        self.transitions: Dict[str, int] = {}
+
+    def _to(self, state: str, now: float):
+        key = f"{self.state}->{state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.state = state
+        self._since = now
+        self._probing = 0
+        self._probe_ok = 0
+        if state == OPEN:
+            self._open_until = now + self.open_s
+
+    def allow(self) -> Tuple[bool, bool]:
+        """(通してよいか, half_open の試験リクエストか) を返す。"""
+        now = time.monotonic()
+        if self.state == CLOSED:
+            if now >= self._next_eval:
+                self._next_eval = now + self.eval_interval_s
+                n, ratio = self._ratio_fn()
+                self._last_ratio = ratio
+                if (n >= self.min_requests and ratio >= self.ratio_threshold
+                        and now - self._since >= self.grace_s):
+                    self._to(OPEN, now)
+                    self.rejected += 1
+                    return False, False
+            return True, False
+        if self.state == OPEN:
+            if now < self._open_until:
+                self.rejected += 1
+                return False, False
+            self._to(HALF_OPEN, now)
+        # HALF_OPEN
+        if now - self._since > self.open_s:
+            # 結果が返らないまま消えた試験リクエストがあっても詰まらないようにする
+            self._since = now
+            self._probing = 0
+        if self._probing < self.probes:
+            self._probing += 1
+            return True, True
+        self.rejected += 1
+        return False, False
+
+    def retry_after_s(self) -> int:
+        return max(1, int(self._open_until - time.monotonic() + 0.999)) if self.state == OPEN else 1
+
+    # --- 結果の報告 (試験リクエストのみ状態を動かす) ---
+    def on_success(self, probe: bool):
+        if not probe or self.state != HALF_OPEN:
+            return
+        self._probing = max(0, self._probing - 1)
+        self._probe_ok += 1
+        if self._probe_ok >= self.close_after:
+            self._to(CLOSED, time.monotonic())
+
+    def on_timeout(self, probe: bool):
+        if self.state == HALF_OPEN and probe:
+            self._to(OPEN, time.monotonic())
+
+    def on_abort(self, probe: bool):
+        # 下流に到達しなかった試験リクエスト
+        if probe and self.state == HALF_OPEN and self._probing > 0:
+            self._probing -= 1
+
+    def stats(self) -> dict:
+        return {
+            "breaker_state": self.state,
+            "breaker_state_age_s": round(time.monotonic() - self._since, 2),
+            "breaker_rejected": self.rejected,
+            "breaker_last_ratio": self._last_ratio,
+            "breaker_transitions": dict(self.transitions),
+        }
@@ -0,0 +1,77 @@
+import os, gzip, json, asyncio
+from typing import List, Mapping
+
+# === 到着リクエストの記録 (car_app/traffic.py と同じ JSONL 形式) ===
+#   t: 到着時刻 / u: user_id / v: vehicle_id / s: X-Proxy-Session / h: X-Request-ID, X-Request-Deadline (残り秒数)
+# car_app の LOAD_MODE=replay でそのまま再生できる。
+# 行はメモリに溜め、flusher がまとめてスレッドで書く (リクエスト処理でファイル I/O を待たない)。
+# 溜まった行が max_pending を超えたら新しい行を捨てて dropped に数える。
+
+KEEP_HEADERS = ("X-Request-ID", "X-Request-Deadline")
+
+
+class TrafficCapture:
+    def __init__(self, path: str, flush_s: float = 0.5, max_pending: int = 100000):
+        self.path = path
+        self.flush_s = flush_s
+        self.max_pending = max_pending
+        self._pending: List[str] = []
+        self._f = None
+        self.captured = 0
+        self.dropped = 0
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if self.path.endswith(".gz"):
+            self._f = gzip.open(self.path, "at", encoding="utf-8")
+        else:
+            self._f = open(self.path, "a", encoding="utf-8")
+
+    def record(self, t: float, data: dict, headers: Mapping[str, str]):
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        rec = {"t": round(t, 6), "u": data.get("user_id"), "v": data.get("vehicle_id"),
+               "s": headers.get("x-proxy-session")}
+        h = {}
+        for k in KEEP_HEADERS:
+            v = headers.get(k.lower())
+            if v:
+                h[k] = v
+        d = h.get("X-Request-Deadline")
+        if d:
+            try:
+                f = float(d)
+                if f > 1e9:
+                    h["X-Request-Deadline"] = str(round(f - t, 3))
+            except ValueError:
+                pass
+        if h:
+            rec["h"] = h
+        self._pending.append(json.dumps(rec, separators=(",", ":")))
+        self.captured += 1
+
+    def _write(self, lines: List[str]):
+        self._f.write("\n".join(lines) + "\n")
+        self._f.flush()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_s)
+            if self._pending:
+                lines, self._pending = self._pending, []
+                await loop.run_in_executor(None, self._write, lines)
+
+    def close(self):
+        if self._f is None:
+            return
+        if self._pending:
+            self._write(self._pending)
+            self._pending = []
+        self._f.close()
+        self._f = None
+
+    def stats(self) -> dict:
+        return {"capture_records": self.captured, "capture_dropped": self.dropped,
+                "capture_pending": len(self._pending)}
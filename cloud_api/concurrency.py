@@ -0,0 +1,114 @@
+import time, asyncio
+from collections import deque
+from typing import Deque, Optional
+
+# === 下流呼び出しの適応的同時実行数制御 (AIMD + レイテンシ基準) ===
+# - 無負荷時 RTT (一定サンプル数ごとに取り直す窓付き最小値) を基準にする
+# - RTT が基準 * tolerance 以内で、枠を使い切りかけているときだけ limit を加算的に増やす
+# - RTT が膨らんだら乗算的に減らし、タイムアウトしたら大きく減らす
+# 接続プールは上限 (max_limit) で作っておき、実際の同時実行数はこの limit で絞る。
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 64,
+                 tolerance: float = 2.0, backoff: float = 0.9, timeout_backoff: float = 0.5,
+                 baseline_window: int = 500):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.timeout_backoff = timeout_backoff
+        self.baseline_window = max(1, baseline_window)
+        self.inflight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+        self._baseline = 0.0   # 現在の基準 RTT
+        self._win_min = 0.0    # 取り直し中の窓内最小値
+        self._win_n = 0
+        self._last_rtt = 0.0
+        self._qdelay_ewma = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.timeouts = 0
+
+    # --- permit ---
+    async def acquire(self):
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 枠を受け取った直後に諦めた
+                self.inflight -= 1
+                self._wake()
+            raise
+
+    def _wake(self):
+        while self._waiters and self.inflight < int(self.limit):
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.inflight += 1
+            fut.set_result(None)
+
+    def release(self, rtt: Optional[float] = None, timed_out: bool = False):
+        self.inflight -= 1
+        if timed_out:
+            self.timeouts += 1
+            self._set_limit(self.limit * self.timeout_backoff)
+        elif rtt is not None:
+            self._sample(rtt)
+        self._wake()
+
+    # --- 制御 ---
+    def set_limit(self, v: float):
+        """limit を外から置き換える (以降はこの値から自動調整を続ける)。"""
+        self._set_limit(v)
+        self._wake()
+
+    def _set_limit(self, v: float):
+        v = min(max(v, float(self.min_limit)), float(self.max_limit))
+        if int(v) > int(self.limit):
+            self.increases += 1
+        elif int(v) < int(self.limit):
+            self.decreases += 1
+        self.limit = v
+
+    def _sample(self, rtt: float):
+        self._last_rtt = rtt
+        if self._win_n == 0 or rtt < self._win_min:
+            self._win_min = rtt
+        self._win_n += 1
+        if self._baseline == 0.0 or rtt < self._baseline:
+            self._baseline = rtt
+        if self._win_n >= self.baseline_window:
+            # 窓ごとに基準を取り直し、環境の変化に追従する
+            self._baseline = self._win_min
+            self._win_n = 0
+        q = max(0.0, rtt - self._baseline)
+        self._qdelay_ewma = 0.2 * q + 0.8 * self._qdelay_ewma
+
+        if rtt > self._baseline * self.tolerance:
+            self._set_limit(self.limit * self.backoff)
+        elif self.inflight + 1 >= self.limit / 2:
+            self._set_limit(self.limit + 1.0 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            "downstream_limit": int(self.limit),
+            "downstream_inflight": self.inflight,
+            "downstream_waiting": sum(1 for f in self._waiters if not f.done()),
+            "downstream_rtt_baseline_ms": round(self._baseline * 1000, 3),
+            "downstream_rtt_last_ms": round(self._last_rtt * 1000, 3),
+            "downstream_queue_delay_ms": round(self._qdelay_ewma * 1000, 3),
+            "downstream_limit_increases": self.increases,
+            "downstream_limit_decreases": self.decreases,
+            "downstream_timeouts": self.timeouts,
+            "downstream_min_limit": self.min_limit,
+            "downstream_max_limit": self.max_limit,
+        }
@@ -0,0 +1,101 @@
+import math
+from array import array
+from typing import Dict, Iterable, List, Sequence
+
+# === HDR 風のレイテンシヒストグラム ===
+# 対数線形バケット: 0..127us はそのまま、それ以上は2のべき乗ごとに64分割 (相対誤差 ~1.6%)。
+# 記録 O(1)、パーセンタイルは1回の走査。0 でないバケットだけを [添字, 件数] で直列化でき、足し合わせられる。
+#
+# car_app (負荷生成側) もこのファイルを使う。car_app のイメージには docker-compose.yaml の
+# additional_contexts でビルド時にコピーし、リポジトリから直接動かすときは loadstats.py がここを import する。
+
+_SUB_BITS = 6
+_SUB = 1 << _SUB_BITS          # 64
+_LINEAR = _SUB * 2             # 0..127us はそのまま
+_MAX_MAG = 36                  # 2^42us (~50日) まで
+
+
+def _index(v: int) -> int:
+    if v < _LINEAR:
+        return v
+    m = v.bit_length() - (_SUB_BITS + 1)
+    return _LINEAR + (m - 1) * _SUB + ((v >> m) - _SUB)
+
+
+def _upper(idx: int) -> int:
+    if idx < _LINEAR:
+        return idx
+    m = (idx - _LINEAR) // _SUB + 1
+    sub = (idx - _LINEAR) % _SUB + _SUB
+    return ((sub + 1) << m) - 1
+
+
+class LatencyHistogram:
+    _N = _LINEAR + _MAX_MAG * _SUB
+
+    def __init__(self):
+        self._counts = array("q", [0] * self._N)
+        self.count = 0
+        self.sum_s = 0.0
+        self.max_s = 0.0
+
+    def record(self, seconds: float):
+        if seconds < 0:
+            seconds = 0.0
+        idx = _index(int(seconds * 1_000_000))
+        if idx >= self._N:
+            idx = self._N - 1
+        self._counts[idx] += 1
+        self.count += 1
+        self.sum_s += seconds
+        if seconds > self.max_s:
+            self.max_s = seconds
+
+    def percentiles(self, ps: Sequence[float]) -> List[float]:
+        """ps (0-100) に対応する値 (秒) を1回の走査で求める。"""
+        out = [0.0] * len(ps)
+        if not self.count:
+            return out
+        order = sorted(range(len(ps)), key=lambda i: ps[i])
+        targets = [max(1, math.ceil(ps[i] / 100.0 * self.count)) for i in order]
+        k, acc = 0, 0
+        for idx, c in enumerate(self._counts):
+            if not c:
+                continue
+            acc += c
+            while k < len(order) and acc >= targets[k]:
+                out[order[k]] = min(_upper(idx) / 1_000_000, self.max_s)
+                k += 1
+            if k == len(order):
+                break
+        return out
+
+    def summary(self, ps: Iterable[float] = (50, 90, 99, 99.9)) -> Dict[str, float]:
+        ps = list(ps)
+        vals = self.percentiles(ps)
+        out = {f"p{p:g}_ms": round(v * 1000, 3) for p, v in zip(ps, vals)}
+        out["max_ms"] = round(self.max_s * 1000, 3)
+        out["avg_ms"] = round(self.sum_s / self.count * 1000, 3) if self.count else 0.0
+        out["count"] = self.count
+        return out
+
+    # --- 直列化 / 合算 ---
+    def to_compact(self) -> dict:
+        return {
+            "b": [[i, c] for i, c in enumerate(self._counts) if c],
+            "n": self.count, "sum_s": round(self.sum_s, 6), "max_s": round(self.max_s, 6),
+        }
+
+    def merge_compact(self, d: dict):
+        for i, c in d.get("b", []):
+            if 0 <= i < self._N:
+                self._counts[i] += c
+        self.count += d.get("n", 0)
+        self.sum_s += d.get("sum_s", 0.0)
+        self.max_s = max(self.max_s, d.get("max_s", 0.0))
+
+    @classmethod
+    def from_compact(cls, d: dict) -> "LatencyHistogram":
+        h = cls()
+        h.merge_compact(d)
+        return h
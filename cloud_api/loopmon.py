@@ -0,0 +1,156 @@
+import os, sys, time, asyncio, threading
+from collections import Counter
+from typing import Dict, Optional
+from metrics import LatencyHistogram
+
+# === イベントループの詰まりの計測 ===
+# LoopMonitor:
+#   - ticker: interval 秒ごとに起きるタスク。予定時刻と実際に起きた時刻の差 (lag) をヒストグラムに記録し、
+#             起きるたびに beat を更新する
+#   - watchdog スレッド: beat が slow_s 以上止まったら「ループが塞がっている」とみなし、その時点の
+#             ループスレッドのスタックと実行中タスク (コルーチン名) を記録する。止まっていた時間は beat の再開時に確定する
+#     asyncio の Handle を差し替える方式は uvloop では効かないため、外から覗く方式にしている
+#     (PYTHONASYNCIODEBUG=1 ならタスクの生成箇所も付く)
+# sample_stacks: 指定秒数だけ hz 回/秒で全スレッド (またはループスレッドのみ) のスタックを取り、
+#   flamegraph.pl / speedscope がそのまま読める collapsed 形式 ("a;b;c 件数") で返す。
+
+MAX_SITES = 256   # 記録する詰まり箇所の種類の上限 (超えた分は <other> にまとめる)
+SITE_DEPTH = 8    # 詰まり箇所として残すスタックの深さ (内側から)
+
+
+def _label(code, lineno: Optional[int] = None) -> str:
+    name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+    return f"{name}:{lineno}" if lineno is not None else name
+
+
+def _stack(frame, depth: int = 0, lines: bool = False) -> list:
+    # 外側 -> 内側の順
+    out = []
+    while frame is not None:
+        out.append(_label(frame.f_code, frame.f_lineno if lines else None))
+        frame = frame.f_back
+        if depth and len(out) >= depth:
+            break
+    out.reverse()
+    return out
+
+
+class LoopMonitor:
+    def __init__(self, interval_s: float = 0.02, slow_s: float = 0.05):
+        self.interval_s = interval_s
+        self.slow_s = slow_s
+        self.lag = LatencyHistogram()
+        self._beat = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._sites: Dict[str, list] = {}  # 箇所 -> [回数, 合計秒, 最大秒]
+        self._stall: Optional[tuple] = None  # (箇所, 止まり始めた beat)
+        self.stalls = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._loop.create_task(self._ticker())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def thread_id(self) -> int:
+        return self._thread_id
+
+    async def _ticker(self):
+        loop = self._loop
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval_s)
+            self.lag.record(max(0.0, loop.time() - t - self.interval_s))
+            self._beat = time.monotonic()
+
+    # --- watchdog (別スレッド) ---
+    def _site(self) -> str:
+        frame = sys._current_frames().get(self._thread_id)
+        stack = _stack(frame, SITE_DEPTH, lines=True) if frame is not None else ["<unknown>"]
+        task = None
+        try:
+            task = asyncio.current_task(self._loop)
+        except Exception:
+            pass  # 別スレッドから覗けない実装 (バージョン差) ならタスク名なしで記録する
+        head = "<callback>"
+        if task is not None:
+            coro = task.get_coro()
+            head = f"task:{getattr(coro, '__qualname__', task.get_name())}"
+            tb = getattr(task, "_source_traceback", None)
+            if tb:
+                f = tb[-1]
+                head += f"@{os.path.basename(f.filename)}:{f.lineno}"
+        return ";".join([head] + stack)
+
+    def _watchdog(self):
+        period = max(0.002, self.slow_s / 4)
+        limit = self.interval_s + self.slow_s
+        while not self._stop.wait(period):
+            beat = self._beat
+            stalled = time.monotonic() - beat > limit
+            if self._stall is None:
+                if stalled:
+                    self._stall = (self._site(), beat)
+            elif beat != self._stall[1]:
+                # ループが動き出した: 止まっていた時間を確定する
+                site, b0 = self._stall
+                self._stall = None
+                self._record(site, max(0.0, beat - b0 - self.interval_s))
+
+    def _record(self, site: str, dur: float):
+        with self._lock:
+            self.stalls += 1
+            if site not in self._sites and len(self._sites) >= MAX_SITES:
+                site = "<other>"
+            e = self._sites.setdefault(site, [0, 0.0, 0.0])
+            e[0] += 1
+            e[1] += dur
+            e[2] = max(e[2], dur)
+
+    # --- 読み出し ---
+    def slow_sites(self, top: int = 20) -> list:
+        with self._lock:
+            items = sorted(self._sites.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        return [{"site": k, "count": c, "total_ms": round(s * 1000, 3), "max_ms": round(m * 1000, 3)}
+                for k, (c, s, m) in items]
+
+    def stats(self) -> dict:
+        out = {f"loop_lag_{k}": v for k, v in self.lag.summary((50, 99, 99.9)).items()}
+        out["loop_stalls"] = self.stalls
+        out["loop_stall_sites"] = len(self._sites)
+        out["loop_stalled_now"] = self._stall is not None
+        return out
+
+
+_profiling = threading.Lock()
+
+
+def sample_stacks(seconds: float, hz: float, thread_id: Optional[int] = None) -> Optional[str]:
+    """seconds 秒間スタックを取り、collapsed 形式の文字列を返す。別のサンプリング中なら None。"""
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts: Counter = Counter()
+        period = 1.0 / hz
+        end = time.monotonic() + seconds
+        nxt = time.monotonic()
+        while nxt < end:
+            for tid, frame in sys._current_frames().items():
+                if tid == me or (thread_id is not None and tid != thread_id):
+                    continue
+                counts[";".join([names.get(tid, str(tid))] + _stack(frame))] += 1
+            nxt += period
+            time.sleep(max(0.0, nxt - time.monotonic()))
+        return "".join(f"{k} {v}\n" for k, v in counts.most_common())
+    finally:
+        _profiling.release()
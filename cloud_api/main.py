@@ -1,73 +1,214 @@
-import os, time, uuid, asyncio, threading
-from collections import deque
-from typing import Dict, Deque, Tuple
+import os, time, uuid, asyncio, threading, heapq, itertools
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import httpx, os as _os
+from audit_log import GroupCommitLog
+from session_arena import SessionArena
+from admission import AdmissionController
+from batcher import MicroBatcher
+from singleflight import SingleFlight
+from concurrency import AdaptiveLimiter
+from breaker import CircuitBreaker
+from metrics import RollingCounter, LatencyHistogram, MetricsHistory, prometheus_text
+from shared_sessions import SharedSessionTable
+from wait_queue import SlotWaitQueue, parse_weights, PRIO_PROBE, PRIO_REFRESH, PRIO_NEW
+from tracing import TraceRing
+from tuning import TuningRegistry
+from capture import TrafficCapture
+from loopmon import LoopMonitor, sample_stacks
 
 # === Tunables (env) ===
 VEHICLE_BASE = os.getenv("VEHICLE_SIMULATOR_URL", "http://vehicle:8001")
 HTTPX_MAX = int(os.getenv("HTTPX_MAX", "2"))           # 下流は直列寄り (変更可)
 REQ_TIMEOUT = int(os.getenv("REQ_TIMEOUT", "60"))      # 下流タイムアウト (変更可)
+ADAPTIVE_LIMIT = int(os.getenv("ADAPTIVE_LIMIT", "1"))                # 1: HTTPX_MAX を初期値に同時実行数を自動調整
+ADAPTIVE_MIN = int(os.getenv("ADAPTIVE_MIN", "1"))
+ADAPTIVE_MAX = int(os.getenv("ADAPTIVE_MAX", "64"))                  # 接続プールはこの数で作る
+ADAPTIVE_TOLERANCE = float(os.getenv("ADAPTIVE_TOLERANCE", "2.0"))   # RTTが基準の何倍を超えたら絞るか
+DOWNSTREAM_BATCH = int(os.getenv("DOWNSTREAM_BATCH", "1"))            # 1: /command/batch にまとめて送る
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "32"))             # 1バッチの最大コマンド数 (変更可)
+BATCH_MAX_LINGER_MS = float(os.getenv("BATCH_MAX_LINGER_MS", "2"))    # 後続コマンドを待つ最大時間 (変更可)
+SINGLEFLIGHT_COMMANDS = {c for c in os.getenv("SINGLEFLIGHT_COMMANDS", "START_CLIMATE").split(",") if c}  # 冪等なコマンドのみ
+RESULT_CACHE_TTL_MS = float(os.getenv("RESULT_CACHE_TTL_MS", "1000"))   # 完了結果を再利用する時間 (0で無効)
+RESULT_CACHE_MAX = int(os.getenv("RESULT_CACHE_MAX", "10000"))          # 結果キャッシュの最大件数 (LRU)
 
 PER_SESSION_BYTES = int(os.getenv("PER_SESSION_BYTES", str(1 * 1024 * 1024)))  # 1MB/セッション (変更不可)
 MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "240"))    # 同時保持上限（≒上限メモリ） (変更不可)
 SESSION_TTL = int(os.getenv("SESSION_TTL", "10"))       # アイドルTTLで解放 (変更可)
 APP_QUEUE_TIMEOUT_S = int(os.getenv("APP_QUEUE_TIMEOUT_S", "60"))  # メモリ確保待ちの上限 (変更不可)
+SESSION_ARENA_LAZY = int(os.getenv("SESSION_ARENA_LAZY", "0"))  # 1: 書き込まれるまでページに触れない (変更可)
+# 1: uvicorn --workers N のワーカー間でセッション台帳を共有し MAX_SESSIONS を全体で守る
+#    (既定は WEB_CONCURRENCY > 1 のとき有効。共有時はアリーナを lazy にしてメモリ予算を全体で揃える)
+SESSION_SHARED = int(os.getenv("SESSION_SHARED", "1" if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else "0"))
+SESSION_SHM_NAME = os.getenv("SESSION_SHM_NAME", "cloud_api_sessions")
 
 LOG_PATH = os.getenv("SYNC_LOG_PATH", "/data/proxy.log")
 LOG_CHUNK_KB = int(os.getenv("LOG_CHUNK_KB", "1"))   # 1KB/req を同期書き込み (変更不可)
 LOG_WORKERS = int(os.getenv("LOG_WORKERS", "1"))  # 実運用で「監査ログは安全のため直列寄り」みたいなのがありがち
 _log_exec = ThreadPoolExecutor(max_workers=LOG_WORKERS)
+AUDIT_GROUP_COMMIT = int(os.getenv("AUDIT_GROUP_COMMIT", "1"))  # 1: グループコミット / 0: 従来の1req/1fsync
+AUDIT_MAX_BATCH = int(os.getenv("AUDIT_MAX_BATCH", "256"))      # 1回のfsyncでまとめる最大件数 (変更可)
+AUDIT_MAX_LINGER_MS = float(os.getenv("AUDIT_MAX_LINGER_MS", "2"))  # 後続レコードを待つ最大時間 (変更可)
+_audit = GroupCommitLog(LOG_PATH, LOG_CHUNK_KB, AUDIT_MAX_BATCH, AUDIT_MAX_LINGER_MS / 1000.0)
 
 METRICS_WINDOW_S = int(os.getenv("METRICS_WINDOW_S", "5"))  # 直近窓 (変更不可)
+METRICS_SAMPLE_S = float(os.getenv("METRICS_SAMPLE_S", "1"))        # 時系列の記録間隔 (0で記録しない)
+METRICS_HISTORY_S = int(os.getenv("METRICS_HISTORY_S", "3600"))     # 時系列を何秒分残すか
+METRICS_STREAM_HEARTBEAT_S = float(os.getenv("METRICS_STREAM_HEARTBEAT_S", "15"))  # SSE の keepalive 間隔
 
 STICKY_ON_TIMEOUT_S = int(os.getenv("STICKY_ON_TIMEOUT_S", "10"))
+STICKY_MAX_SIDS = int(os.getenv("STICKY_MAX_SIDS", str(max(4 * MAX_SESSIONS, 1024))))  # sticky記録の保持上限
+
+ADMISSION_CONTROL = int(os.getenv("ADMISSION_CONTROL", "1"))        # 1: 期限に間に合わない要求を入口で503
+PROXY_TIMEOUT_S = float(os.getenv("PROXY_TIMEOUT_S", "60"))         # nginx proxy_read_timeout と揃える
+ADMISSION_MARGIN_S = float(os.getenv("ADMISSION_MARGIN_S", "0.5"))  # 期限に対する安全マージン
+ADMISSION_SERVICE_PRIOR_S = float(os.getenv("ADMISSION_SERVICE_PRIOR_S", "0.1"))  # 実測前の1件あたり処理時間
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_S", "0.5"))    # クライアント切断の検知間隔 (0で無効)
+BREAKER_ENABLED = int(os.getenv("BREAKER_ENABLED", "1"))               # 1: 下流タイムアウト多発時に即失敗させる
+BREAKER_TIMEOUT_RATIO = float(os.getenv("BREAKER_TIMEOUT_RATIO", "0.5"))  # recent_timeout_ratio がこれ以上で open
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "20"))      # 判定に必要な直近到着数
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "5"))                 # open を維持する時間
+BREAKER_PROBES = int(os.getenv("BREAKER_PROBES", "1"))                   # half_open で同時に通す数
+BREAKER_CLOSE_AFTER = int(os.getenv("BREAKER_CLOSE_AFTER", "3"))         # closed に戻すまでの成功数
+WAITQ_WEIGHTS = parse_weights(os.getenv("WAITQ_WEIGHTS", "probe:16,refresh:4,new:1"))  # 空き待ちの優先度クラスと重み
+PROBE_ID_PREFIX = os.getenv("PROBE_ID_PREFIX", "MONITOR-")           # この X-Request-ID 接頭辞を監視プローブとみなす
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0.01"))               # request id 単位でステージ別スパンを残す割合 (0で無効)
+TRACE_PATH = os.getenv("TRACE_PATH", os.path.join(os.path.dirname(LOG_PATH) or ".", "trace-cloud_api-{pid}.bin"))  # ワーカーごとに別ファイル (既定は監査ログと同じ場所)
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", "65536"))                # メモリ上に溜めるスパン数 (溢れた分は捨てる)
+TUNING_HISTORY = int(os.getenv("TUNING_HISTORY", "100"))              # /metrics に残す実行中の設定変更の件数
+LOOP_MONITOR = int(os.getenv("LOOP_MONITOR", "1"))                    # 1: イベントループの遅れと詰まり箇所を計測
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", "20"))  # 遅れを測る間隔
+LOOP_SLOW_MS = float(os.getenv("LOOP_SLOW_MS", "50"))                  # これ以上ループが止まったら詰まりとして箇所を記録
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")  # 到着リクエストを car_app で再生できる形式で記録 (例 /data/capture-{pid}.jsonl.gz)
 START_TIME = time.time()
 # === App / Client ===
 app = FastAPI()
-limits = httpx.Limits(max_connections=HTTPX_MAX, max_keepalive_connections=HTTPX_MAX)
-client = httpx.AsyncClient(base_url=VEHICLE_BASE, timeout=REQ_TIMEOUT, limits=limits)
+_pool_size = max(HTTPX_MAX, ADAPTIVE_MAX) if ADAPTIVE_LIMIT else HTTPX_MAX
+
+def _make_client(pool_size: int) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    return httpx.AsyncClient(base_url=VEHICLE_BASE, timeout=REQ_TIMEOUT, limits=limits)
+
+client = _make_client(_pool_size)
+_limiter = AdaptiveLimiter(HTTPX_MAX, ADAPTIVE_MIN, ADAPTIVE_MAX, ADAPTIVE_TOLERANCE)
+# クライアントごとの実行中リクエスト数。差し替えで退役したクライアントは 0 になった時点で閉じる
+_client_users: Dict[httpx.AsyncClient, int] = {}
+
+async def _client_post(path: str, payload: dict, headers: Optional[dict]) -> httpx.Response:
+    # 呼び出し時点の client と REQ_TIMEOUT で最後まで処理する (途中で差し替えられても影響しない)
+    c = client
+    _client_users[c] = _client_users.get(c, 0) + 1
+    try:
+        return await c.post(path, json=payload, headers=headers, timeout=REQ_TIMEOUT)
+    finally:
+        n = _client_users.pop(c) - 1
+        if n:
+            _client_users[c] = n
+        elif c is not client:
+            asyncio.ensure_future(c.aclose())
+
+async def _post(path: str, payload: dict, headers: Optional[dict] = None,
+                timeout: Optional[float] = None) -> httpx.Response:
+    # 下流呼び出しは全てここを通し、同時実行数を _limiter の limit に絞る
+    # timeout は呼び出し元の期限の残り。枠待ちも含めてここで打ち切り、送信中に切れたら limiter にタイムアウトとして伝える
+    if not ADAPTIVE_LIMIT:
+        r = await asyncio.wait_for(_client_post(path, payload, headers), timeout)
+        r.raise_for_status()
+        return r
+    t_end = None if timeout is None else time.monotonic() + timeout
+    await asyncio.wait_for(_limiter.acquire(), timeout)
+    t0 = time.monotonic()
+    try:
+        r = await asyncio.wait_for(_client_post(path, payload, headers), None if t_end is None else t_end - t0)
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        _limiter.release(timed_out=True)
+        raise
+    except BaseException:
+        _limiter.release()
+        raise
+    _limiter.release(time.monotonic() - t0)
+    r.raise_for_status()
+    return r
+
+async def _send_batch(commands: List[dict]) -> List[dict]:
+    r = await _post("/command/batch", {"commands": commands})
+    return r.json()["results"]
+
+_batcher = MicroBatcher(_send_batch, BATCH_MAX_ITEMS, BATCH_MAX_LINGER_MS / 1000.0)
+_sf = SingleFlight(RESULT_CACHE_TTL_MS / 1000.0, RESULT_CACHE_MAX)
+
+async def _send_command(cmd: dict, timeout: Optional[float] = None) -> dict:
+    if DOWNSTREAM_BATCH:
+        res = await asyncio.wait_for(_batcher.submit(cmd), timeout)
+        # バッチ内の個別失敗は単発呼び出しの HTTP エラーと同じく例外にする
+        if res.get("status") == "error":
+            raise RuntimeError(res.get("error", "vehicle error"))
+        return res
+    r = await _post("/command", cmd, {"X-Request-ID": cmd["request_id"]} if "request_id" in cmd else None, timeout)
+    return r.json()
 
 # === Metrics ===
-_metrics = {"pending": 0, "done": 0, "timeouts": 0, "errors": 0, "arrived_total": 0}
+_metrics = {"pending": 0, "done": 0, "timeouts": 0, "errors": 0, "arrived_total": 0,
+            "shed": 0, "client_disconnects": 0, "breaker_fast_fail": 0}
 _met_lock = threading.Lock()
-_arrivals: Deque[Tuple[float, int]] = deque()
-_timeouts: Deque[Tuple[float, int]] = deque()
+_arrivals = RollingCounter(METRICS_WINDOW_S)
+_timeouts = RollingCounter(METRICS_WINDOW_S)
+# ステージ別レイテンシ: session_wait / fsync / downstream / total
+_stage_hist: Dict[str, LatencyHistogram] = {k: LatencyHistogram() for k in ("session_wait", "fsync", "downstream", "total")}
+STAGE_PERCENTILES = (50, 90, 99)
+
+# サンプルされたリクエストだけステージ別スパンをファイルに残す (tracing.py)
+_trace = TraceRing(TRACE_PATH.format(pid=os.getpid()), 1, TRACE_SAMPLE, TRACE_BUFFER)
+_capture = TrafficCapture(CAPTURE_PATH.format(pid=os.getpid())) if CAPTURE_PATH else None
+_loopmon = LoopMonitor(LOOP_LAG_INTERVAL_MS / 1000.0, LOOP_SLOW_MS / 1000.0)
+
+# /metrics の数値項目の時系列。サンプラー1本が記録し、/metrics/stream の購読者全員に同じ差分を配る
+_history = MetricsHistory(max(1, int(METRICS_HISTORY_S / METRICS_SAMPLE_S)) if METRICS_SAMPLE_S > 0 else 1)
+
+_metric_keys = list(_metrics)
+_metric_idx = {k: i for i, k in enumerate(_metric_keys)}
+_shm: Optional[SharedSessionTable] = None  # SESSION_SHARED のとき startup で接続
 
 def _inc(k, d=1):
     with _met_lock:
         _metrics[k] += d
+        if _shm is not None:
+            _shm.add(_metric_idx[k], d)
 
 def _snap():
+    if _shm is not None:
+        tot, workers = _shm.sum_counters(len(_metric_keys))
+        return {**dict(zip(_metric_keys, tot)), "workers": workers}
     with _met_lock:
         return dict(_metrics)
 
 def _rec_arrival():
-    now = time.time()
-    _arrivals.append((now, 1))
+    _arrivals.add()
     _inc("arrived_total", +1)
-    while _arrivals and now - _arrivals[0][0] > METRICS_WINDOW_S:
-        _arrivals.popleft()
 
 def _rec_timeout():
-    now = time.time()
-    _timeouts.append((now, 1))
-    while _timeouts and now - _timeouts[0][0] > METRICS_WINDOW_S:
-        _timeouts.popleft()
+    _timeouts.add()
+
+def _rec_stage(stage: str, t0: float):
+    _stage_hist[stage].record(time.monotonic() - t0)
 
 def _recent():
     now = time.time()
-    while _arrivals and now - _arrivals[0][0] > METRICS_WINDOW_S:
-        _arrivals.popleft()
-    while _timeouts and now - _timeouts[0][0] > METRICS_WINDOW_S:
-        _timeouts.popleft()
-    a = sum(v for _, v in _arrivals)
-    t = sum(v for _, v in _timeouts)
+    a = _arrivals.sum(now)
+    t = _timeouts.sum(now)
     return {"recent_arrivals": a, "recent_timeouts": t, "recent_timeout_ratio": round((t / a) if a else 0.0, 3)}
 
+def _recent_ratio():
+    r = _recent()
+    return r["recent_arrivals"], r["recent_timeout_ratio"]
+
+_breaker = CircuitBreaker(_recent_ratio, BREAKER_TIMEOUT_RATIO, BREAKER_MIN_REQUESTS, BREAKER_OPEN_S,
+                          BREAKER_PROBES, BREAKER_CLOSE_AFTER, grace_s=METRICS_WINDOW_S)
+
 # === sync I/O (fsync) ===
 def sync_append_kb(path: str, kb: int, line: str):
     fd = _os.open(path, _os.O_CREAT | _os.O_APPEND | _os.O_WRONLY, 0o644)
@@ -80,173 +221,600 @@ def sync_append_kb(path: str, kb: int, line: str):
         _os.close(fd)
 
 # === Session Manager: 上限付きオンデマンド確保 ===
+_gen = itertools.count()
+
 class _Entry:
-    __slots__ = ("buf", "last_used")
-    def __init__(self):
-        self.buf = bytearray(PER_SESSION_BYTES)
+    __slots__ = ("gen", "slot", "buf", "last_used")
+    def __init__(self, slot: int, buf: memoryview):
+        self.gen = next(_gen)  # 期限ヒープ上の古いエントリを見分けるための世代番号
+        self.slot = slot
+        self.buf = buf  # アリーナの固定長スロット (ゼロ埋めなし)
         self.last_used = time.time()
     def touch(self):
         self.last_used = time.time()
 
-_timedout_sids: Dict[str, float] = {}
+# sid -> タイムアウト時刻。記録順 (=期限順) に並ぶので先頭から刈り取れる
+_timedout_sids: "OrderedDict[str, float]" = OrderedDict()
 _timedout_lock = threading.Lock()
 
 def _mark_sid_timed_out(sid: str):
     if STICKY_ON_TIMEOUT_S > 0:
         with _timedout_lock:
+            _timedout_sids.pop(sid, None)
             _timedout_sids[sid] = time.time()
+            while len(_timedout_sids) > STICKY_MAX_SIDS:
+                _timedout_sids.popitem(last=False)
+        if _shm is not None:
+            _shm.mark_sticky(sid, time.time())
+
+def _prune_sticky(now: float):
+    with _timedout_lock:
+        while _timedout_sids:
+            sid, ts = next(iter(_timedout_sids.items()))
+            if now - ts < STICKY_ON_TIMEOUT_S:
+                break
+            _timedout_sids.popitem(last=False)
+
+def _expiry_of(sid: str, e: "_Entry") -> float:
+    # TTL期限と sticky期限の遅い方
+    last_used = e.last_used
+    with _timedout_lock:
+        ts = _timedout_sids.get(sid)
+    if _shm is not None:
+        # 他ワーカーでの touch / タイムアウトも反映する
+        t = _shm.times(sid)
+        if t:
+            last_used = max(last_used, t[0])
+            ts = max(ts or 0.0, t[1]) or None
+    d = last_used + SESSION_TTL
+    if STICKY_ON_TIMEOUT_S > 0 and ts:
+        d = max(d, ts + STICKY_ON_TIMEOUT_S)
+    return d
 
 class SessionManager:
     def __init__(self):
         self._lock = asyncio.Lock()
-        self._cv = asyncio.Condition(self._lock)
         self._tbl: Dict[str, _Entry] = {}
-
-    async def ensure(self, sid: str, timeout_s: int):
+        self._arena = SessionArena(MAX_SESSIONS, PER_SESSION_BYTES, lazy=bool(SESSION_ARENA_LAZY or SESSION_SHARED))
+        # 期限順の min-heap: (deadline, gen, sid)。touch ではヒープを触らず、
+        # 取り出した時点で実際の期限を再計算して未到来なら積み直す (lazy invalidation)
+        self._expiry: List[Tuple[float, int, str]] = []
+        # 空き待ち: 解放された枠の数だけ待機者を起こす。起こした分は _reserved で枠を予約
+        self._waitq = SlotWaitQueue(WAITQ_WEIGHTS)
+        self._reserved = 0
+        # 最近GCされたsid (再来時に refresh クラスで扱う)
+        self._evicted: "OrderedDict[str, None]" = OrderedDict()
+
+    def _admit(self, sid: str):
+        # 呼び出し側で枠 (共有時は共有台帳の count) を確保済みであること
+        if _shm is not None and not _shm.insert_reserved(sid, time.time(), os.getpid()):
+            return  # 他ワーカーが同じ sid を先に登録した (予約は返却済み)
+        slot, buf = self._arena.acquire()
+        e = _Entry(slot, buf)
+        self._tbl[sid] = e
+        heapq.heappush(self._expiry, (e.last_used + SESSION_TTL, e.gen, sid))
+        _admission.on_admit()
+
+    def _try_take(self) -> bool:
+        # 待機者がいなければ空き枠を1つ取る (共有時は全ワーカー合計で判定)
+        if self._waitq:
+            return False
+        if _shm is not None:
+            return _shm.try_reserve(1) == 1
+        return len(self._tbl) + self._reserved < MAX_SESSIONS
+
+    def _unreserve(self):
+        self._reserved -= 1
+        if _shm is not None:
+            _shm.unreserve(1)
+
+    def _grant(self):
+        if not self._waitq:
+            return
+        if _shm is not None:
+            free = _shm.try_reserve(len(self._waitq))
+            g = self._waitq.wake(free)
+            _shm.unreserve(free - g)
+            self._reserved += g
+            return
+        free = MAX_SESSIONS - len(self._tbl) - self._reserved
+        if free > 0:
+            self._reserved += self._waitq.wake(free)
+
+    def poll(self):
+        # 共有時: 他ワーカーが解放した枠を待機者に回す
+        self._grant()
+
+    def classify(self, sid: str, req_id: str) -> str:
+        if req_id.startswith(PROBE_ID_PREFIX):
+            return PRIO_PROBE
+        if sid in self._evicted or sid in _timedout_sids:
+            return PRIO_REFRESH
+        return PRIO_NEW
+
+    async def ensure(self, sid: str, timeout_s: float, prio: str = PRIO_NEW, caller: str = ""):
         async with self._lock:
             e = self._tbl.get(sid)
             if e:
                 e.touch()
+                if _shm is not None:
+                    _shm.touch(sid, e.last_used)
                 return
-            async def wait_slot():
-                while len(self._tbl) >= MAX_SESSIONS:
-                    await self._cv.wait()
-            try:
-                await asyncio.wait_for(wait_slot(), timeout=timeout_s)
-            except asyncio.TimeoutError:
-                raise
-            self._tbl[sid] = _Entry()
+            if _shm is not None and _shm.touch(sid, time.time()):
+                return  # 他ワーカーが保持しているセッション
+            if self._try_take():
+                self._admit(sid)
+                return
+            fut = self._waitq.enqueue(prio, caller or sid)
+        try:
+            await asyncio.wait_for(fut, timeout=timeout_s)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 枠を渡された直後に諦めた: 予約を次の待機者へ回す
+                self._unreserve()
+                self._grant()
+            else:
+                self._waitq.abandon(prio, caller or sid, fut)
+            raise
+        # 予約済みの枠を使う (ここから先に await はないので割り込まれない)
+        e = self._tbl.get(sid)
+        if e:
+            # 同じ sid の別リクエストが先に確保していた
+            self._unreserve()
+            e.touch()
+            self._grant()
+            return
+        self._reserved -= 1
+        self._admit(sid)
+
+    def reindex_expiry(self):
+        # TTL / sticky 期間を変えたとき、既存セッションの期限を新しい値で積み直す
+        # (延長は lazy invalidation で拾えるが、短縮はヒープの先頭に出てこないため)
+        self._expiry[:] = [(_expiry_of(sid, e), e.gen, sid) for sid, e in self._tbl.items()]
+        heapq.heapify(self._expiry)
+
+    def queue_state(self, sid: str) -> Tuple[bool, int]:
+        # ロックなしの概算: (既存セッションか, 空きスロット数)
+        used = _shm.count if _shm is not None else len(self._tbl)
+        return sid in self._tbl, MAX_SESSIONS - used
 
     async def gc(self):
+        # 1tickのコストは O(期限切れ候補) で、セッション総数に比例しない
         now = time.time()
         async with self._lock:
-            dead = []
-            for k, e in list(self._tbl.items()):
-                # sticky期間中ならGC対象から外す
-                if STICKY_ON_TIMEOUT_S > 0:
-                    with _timedout_lock:
-                        ts = _timedout_sids.get(k)
-                    if ts and (now - ts) < STICKY_ON_TIMEOUT_S:
-                        continue
-
-                    # sticky期間が過ぎていたら記録を消して通常のTTL判定へ
-                    if ts and (now - ts) >= STICKY_ON_TIMEOUT_S:
-                        with _timedout_lock:
-                            _timedout_sids.pop(k, None)
-
-                # 通常のTTL判定
-                if now - e.last_used > SESSION_TTL:
-                    dead.append(k)
-
-            for k in dead:
-                del self._tbl[k]
+            dead = 0
+            heap = self._expiry
+            while heap and heap[0][0] < now:
+                _, gen, sid = heapq.heappop(heap)
+                e = self._tbl.get(sid)
+                if e is None or e.gen != gen:
+                    continue  # 既に解放済み / 再確保された別世代
+                # sticky期間中 or TTL延長済みなら実際の期限で積み直す
+                d = _expiry_of(sid, e)
+                if d >= now:
+                    heapq.heappush(heap, (d, gen, sid))
+                    continue
+                del self._tbl[sid]
+                self._arena.release(e.slot, e.buf)
+                if _shm is not None:
+                    _shm.remove(sid)
+                self._evicted[sid] = None
+                dead += 1
+            while len(self._evicted) > STICKY_MAX_SIDS:
+                self._evicted.popitem(last=False)
             if dead:
-                self._cv.notify_all()
+                self._grant()
+        if STICKY_ON_TIMEOUT_S > 0:
+            _prune_sticky(now)
 
     # async def drop(self, sid: str):
     #     """例外時などにセッションを即時解放する"""
     #     async with self._lock:
-    #         if sid in self._tbl:
-    #             del self._tbl[sid]
-    #             self._cv.notify_all()
+    #         e = self._tbl.pop(sid, None)
+    #         if e:
+    #             self._arena.release(e.slot, e.buf)
+    #             self._grant()
     #     with _timedout_lock:
     #         _timedout_sids.pop(sid, None)
 
     async def stats(self):
-        async with self._lock:
-            n = len(self._tbl)
-            return {"session_count": n, "reserved_mb": (n * PER_SESSION_BYTES) // (1024 * 1024)}
-
+        # イベントループ上の同期的な読み出しなのでロック不要 (ensure と競合させない)
+        n = len(self._tbl)
+        shared = {}
+        if _shm is not None:
+            shared = {"session_count_local": n, **_shm.stats()}
+            n = _shm.count
+        return {
+            "session_count": n,
+            "session_waiters": len(self._waitq),
+            "session_reserved": self._reserved,
+            "reserved_mb": (n * PER_SESSION_BYTES) // (1024 * 1024),
+            "expiry_index_size": len(self._expiry),
+            "sticky_sids": len(_timedout_sids),
+            **self._arena.stats(),
+            **self._waitq.stats(),
+            **shared,
+        }
+
+_admission = AdmissionController(PROXY_TIMEOUT_S, ADMISSION_MARGIN_S, service_prior_s=ADMISSION_SERVICE_PRIOR_S)
 sess = SessionManager()
 
+GC_SUBTICKS = 20 if SESSION_SHARED else 1   # 共有時は他ワーカーの解放を 50ms ごとに拾う
+REAP_EVERY_S = 10
+
 async def _gc_loop():
+    n = 0
     while True:
-        await sess.gc()
-        await asyncio.sleep(1)
+        if n % GC_SUBTICKS == 0:
+            await sess.gc()
+            if _shm is not None and n % (GC_SUBTICKS * REAP_EVERY_S) == 0:
+                if _shm.reap_dead_owners():
+                    sess.poll()
+        else:
+            sess.poll()
+        if _shm is not None:
+            _shm.compact()
+        n += 1
+        await asyncio.sleep(1 / GC_SUBTICKS)
+
+# === Runtime tuning (/admin/tunables) ===
+# 実行中のリクエストは開始時点の設定のまま終わる:
+#   REQ_TIMEOUT は下流呼び出しの直前に読む (呼び出し中の分は開始時の値)。接続は呼び出し時に _client_post で固定される
+#   接続プール / ログ用スレッドプールは新しく作って差し替え、旧い方は処理中の分が終わってから閉じる
+def _set_httpx_max(v: int):
+    global HTTPX_MAX, client, _pool_size
+    HTTPX_MAX = v
+    if ADAPTIVE_LIMIT:
+        _limiter.set_limit(v)  # プールは ADAPTIVE_MAX で作ってあるので limit だけ動かす
+        return
+    old, _pool_size = client, v
+    client = _make_client(v)
+    if old not in _client_users:
+        asyncio.ensure_future(old.aclose())
+
+def _set_req_timeout(v: int):
+    global REQ_TIMEOUT
+    REQ_TIMEOUT = v
+
+def _set_session_ttl(v: int):
+    global SESSION_TTL
+    SESSION_TTL = v
+    sess.reindex_expiry()
+
+def _set_sticky(v: int):
+    global STICKY_ON_TIMEOUT_S
+    STICKY_ON_TIMEOUT_S = v
+    sess.reindex_expiry()
+
+def _set_log_workers(v: int):
+    global LOG_WORKERS, _log_exec
+    old = _log_exec
+    LOG_WORKERS = v
+    _log_exec = ThreadPoolExecutor(max_workers=v)
+    old.shutdown(wait=False)  # 投入済みの書き込みは旧プールで最後まで走る
+
+_tuning = TuningRegistry(TUNING_HISTORY)
+_tuning.register("HTTPX_MAX", lambda: HTTPX_MAX, _set_httpx_max, 1, ADAPTIVE_MAX if ADAPTIVE_LIMIT else 1024)
+_tuning.register("REQ_TIMEOUT", lambda: REQ_TIMEOUT, _set_req_timeout, 1, 3600)
+_tuning.register("SESSION_TTL", lambda: SESSION_TTL, _set_session_ttl, 1, 3600)
+_tuning.register("STICKY_ON_TIMEOUT_S", lambda: STICKY_ON_TIMEOUT_S, _set_sticky, 0, 3600)
+if not AUDIT_GROUP_COMMIT:  # グループコミット時は _log_exec を使わないので変えても効かない
+    _tuning.register("LOG_WORKERS", lambda: LOG_WORKERS, _set_log_workers, 1, 64)
 
 # === Handler ===
+async def _run_until_disconnect(request: Request, coro):
+    # 処理をタスクとして走らせ、クライアント切断を検知したら途中でキャンセルする
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_S)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                _inc("client_disconnects", +1)
+                task.cancel()
+                try:
+                    await task
+                except BaseException:
+                    pass
+                raise HTTPException(499, "client closed request")
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
 @app.post("/api/v1/vehicle/climate/start")
 async def start_climate(data: dict, request: Request):
     _rec_arrival()
-    _inc("pending", +1)
+    if _capture:
+        _capture.record(time.time(), data, request.headers)
     req_id = request.headers.get("X-Request-ID") or str(uuid.uuid4())
     sid = request.headers.get("X-Proxy-Session") or str(uuid.uuid4())
 
+    # 0) サーキットブレーカー: open 中はセッションも fsync も使わず即失敗
+    probe = False
+    if BREAKER_ENABLED:
+        allowed, probe = _breaker.allow()
+        if not allowed:
+            _inc("breaker_fast_fail", +1)
+            raise HTTPException(503, "vehicle backend unavailable (circuit open)",
+                                headers={"Retry-After": str(_breaker.retry_after_s())})
+
+    # 0') アドミッション制御: 期限内に終わらない見込みなら何も確保せず即503
+    queue_timeout = APP_QUEUE_TIMEOUT_S
+    deadline = None
+    count_queued = False
+    if ADMISSION_CONTROL:
+        now = time.time()
+        deadline = _admission.deadline_from(request.headers, now)
+        known, free = sess.queue_state(sid)
+        est_wait = _admission.estimate_wait(known, free)
+        ok, remaining, retry_after = _admission.check(deadline, now, est_wait)
+        if not ok:
+            _inc("shed", +1)
+            _breaker.on_abort(probe)
+            raise HTTPException(503, "deadline cannot be met", headers={"Retry-After": str(retry_after)})
+        queue_timeout = min(APP_QUEUE_TIMEOUT_S, max(0.0, remaining - _admission.service_s))
+        # 待ち行列の人数は _start_climate の中で増減する (開始前にキャンセルされても数がずれない)
+        count_queued = not known
+
+    prio = sess.classify(sid, req_id)
+    caller = str(data.get("user_id") or sid)
+    pipeline = _start_climate(data, req_id, sid, queue_timeout, deadline, count_queued, prio, caller, probe)
+    if DISCONNECT_POLL_S > 0:
+        return await _run_until_disconnect(request, pipeline)
+    return await pipeline
+
+async def _start_climate(data: dict, req_id: str, sid: str, queue_timeout: float, deadline: Optional[float] = None,
+                         count_queued: bool = False, prio: str = PRIO_NEW, caller: str = "", probe: bool = False):
+    _inc("pending", +1)
+    t_start = time.monotonic()
+    traced = _trace.want(req_id)
+    status = 500
     try:
-        # 1) セッション確保 / 空き待ち（最大60s）
+        # 1) セッション確保 / 空き待ち（最大60s、期限があればそれ以内）
         try:
-            await sess.ensure(sid, APP_QUEUE_TIMEOUT_S)
+            if count_queued:
+                _admission.queued += 1
+            try:
+                await sess.ensure(sid, queue_timeout, prio, caller)
+            finally:
+                _rec_stage("session_wait", t_start)
+                if traced:
+                    _trace.span_since(req_id, "admission", t_start)
+                if count_queued:
+                    _admission.queued -= 1
         except asyncio.TimeoutError:
             _inc("timeouts", +1); _rec_timeout()
             _mark_sid_timed_out(sid)
-            await sess.drop(sid)
-            raise HTTPException(503, "queued > 60s: session memory not available")
-
-        # 2) 実I/Oでサービス時間を確保（同期fsyncログを小さなスレッドプールに投げる）
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            _log_exec,
-            sync_append_kb,
-            LOG_PATH,
-            LOG_CHUNK_KB,
-            f"{time.time()} {req_id} {sid}",
-        )
-
-        # 3) 下流は接続プール小さめで直列化
-        r = await client.post("/command", json={"command": "START_CLIMATE", **data})
-        r.raise_for_status()
+            raise HTTPException(503, f"queued > {queue_timeout:.0f}s: session memory not available")
+        t0 = time.monotonic()
 
+        # 2) 監査ログ: fsync 完了まで待つ（グループコミットで複数リクエストを1回のfsyncに集約）
+        line = f"{time.time()} {req_id} {sid}"
+        try:
+            if AUDIT_GROUP_COMMIT:
+                await _audit.append(line)
+            else:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(_log_exec, sync_append_kb, LOG_PATH, LOG_CHUNK_KB, line)
+        finally:
+            _rec_stage("fsync", t0)
+            if traced:
+                _trace.span_since(req_id, "fsync", t0)
+
+        # 3) 下流は接続プール小さめ。同時に来たコマンドはバッチにまとめて1往復で送る
+        #    同じ車両への重複コマンドは1回の下流呼び出しに相乗りする
+        #    タイムアウトは空き待ち・fsync で使った分を差し引いた期限の残り (期限切れなら呼ばずに504)
+        req_timeout = REQ_TIMEOUT
+        if deadline is not None:
+            req_timeout = min(REQ_TIMEOUT, deadline - _admission.margin_s - time.time())
+            if req_timeout <= 0:
+                _inc("timeouts", +1); _rec_timeout()
+                raise HTTPException(504, "deadline exceeded before downstream call")
+        cmd = {"command": "START_CLIMATE", **data, "request_id": req_id}
+        # ブレーカーの half-open 試行は相乗り・結果キャッシュを使わず必ず下流を呼ぶ (他人の結果で close しない)
+        if not probe and cmd["command"] in SINGLEFLIGHT_COMMANDS and isinstance(cmd.get("vehicle_id"), str):
+            call = asyncio.wait_for(_sf.do((cmd["command"], cmd["vehicle_id"]), lambda: _send_command(cmd)),
+                                    timeout=req_timeout)
+        else:
+            # 単発呼び出しは期限を _post まで渡す (期限切れが limiter にもタイムアウトとして届く)
+            call = _send_command(cmd, req_timeout)
+        t1 = time.monotonic()
+        try:
+            await call
+        finally:
+            _rec_stage("downstream", t1)
+            if traced:
+                _trace.span_since(req_id, "downstream", t1)
+        _breaker.on_success(probe); probe = False
+
+        _admission.on_service(time.monotonic() - t0)
         _inc("done", +1)
+        status = 200
         return {"ok": True, "request_id": req_id, "proxy_session": sid}
 
-    except httpx.ReadTimeout:
+    except (httpx.ReadTimeout, asyncio.TimeoutError):
+        status = 504
         _inc("timeouts", +1); _rec_timeout()
+        _breaker.on_timeout(probe); probe = False
         _mark_sid_timed_out(sid)
         # await sess.drop(sid)
         raise HTTPException(504, "vehicle timeout")
     except asyncio.CancelledError:
+        status = 499
         _inc("timeouts", +1); _rec_timeout()
         _mark_sid_timed_out(sid)
         # await sess.drop(sid)
         raise
-    except HTTPException:
+    except HTTPException as e:
+        status = e.status_code
         # await sess.drop(sid)
         raise
     except Exception as e:
+        status = 502
         _inc("errors", +1)
         # await sess.drop(sid)
         raise HTTPException(502, str(e))
     finally:
+        _breaker.on_abort(probe)
+        _rec_stage("total", t_start)
+        if traced:
+            _trace.span_since(req_id, "total", t_start, status)
         _inc("pending", -1)
 
-@app.get("/metrics")
-async def metrics():
+async def _metrics_payload() -> dict:
     now_epoch = time.time()
     now_iso = datetime.now(timezone.utc).isoformat()
     uptime_s = round(now_epoch - START_TIME, 2)
 
     m = _snap(); s = await sess.stats(); r = _recent()
-    return JSONResponse({
+    a = _audit.stats() if AUDIT_GROUP_COMMIT else {}
+    ad = _admission.stats() if ADMISSION_CONTROL else {}
+    b = _batcher.stats() if DOWNSTREAM_BATCH else {}
+    sf = _sf.stats() if SINGLEFLIGHT_COMMANDS else {}
+    lim = _limiter.stats() if ADAPTIVE_LIMIT else {}
+    br = _breaker.stats() if BREAKER_ENABLED else {}
+    tr = _trace.stats() if _trace.enabled else {}
+    tu = _tuning.stats()
+    hi = _history.stats() if METRICS_SAMPLE_S > 0 else {}
+    cp = _capture.stats() if _capture else {}
+    lm = _loopmon.stats() if LOOP_MONITOR else {}
+    return {
         "timestamp_epoch": now_epoch,
         "timestamp_iso": now_iso,
         "uptime_s": uptime_s,
-        **m, **s, **r,
+        **m, **s, **r, **a, **ad, **b, **sf, **lim, **br, **tr, **tu, **hi, **cp, **lm,
         "per_session_bytes": PER_SESSION_BYTES,
         "max_sessions": MAX_SESSIONS,
         "session_ttl": SESSION_TTL,
         "app_queue_timeout_s": APP_QUEUE_TIMEOUT_S,
         "log_chunk_kb": LOG_CHUNK_KB,
         "httpx_max": HTTPX_MAX,
-        "sticky_on_timeout_s": STICKY_ON_TIMEOUT_S
-    })
+        "req_timeout": REQ_TIMEOUT,
+        "log_workers": LOG_WORKERS,
+        "sticky_on_timeout_s": STICKY_ON_TIMEOUT_S,
+        "audit_group_commit": bool(AUDIT_GROUP_COMMIT),
+        "admission_control": bool(ADMISSION_CONTROL),
+        "proxy_timeout_s": PROXY_TIMEOUT_S,
+        "downstream_batch": bool(DOWNSTREAM_BATCH),
+        "adaptive_limit": bool(ADAPTIVE_LIMIT),
+        "session_shared": bool(SESSION_SHARED),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    out = await _metrics_payload()
+    out["latency"] = {k: h.summary(STAGE_PERCENTILES) for k, h in _stage_hist.items()}
+    if LOOP_MONITOR:
+        out["loop_slow_sites"] = _loopmon.slow_sites(10)
+    return JSONResponse(out)
+
+@app.get("/metrics/prometheus")
+async def metrics_prometheus():
+    out = await _metrics_payload()
+    return PlainTextResponse(prometheus_text("cloud_api", out, _stage_hist),
+                             media_type="text/plain; version=0.0.4")
+async def _history_loop():
+    # 記録時刻を間隔の境界に揃える (複数ワーカーの時系列を突き合わせやすくする)
+    nxt = (time.time() // METRICS_SAMPLE_S + 1) * METRICS_SAMPLE_S
+    while True:
+        await asyncio.sleep(max(0.0, nxt - time.time()))
+        out = await _metrics_payload()
+        _history.record(out["timestamp_epoch"], out)
+        nxt = max(nxt + METRICS_SAMPLE_S, (time.time() // METRICS_SAMPLE_S) * METRICS_SAMPLE_S)
+
+def _fields_param(fields: Optional[str]) -> Optional[List[str]]:
+    return [f for f in fields.split(",") if f] if fields else None
+
+@app.get("/metrics/history")
+async def metrics_history(since: Optional[float] = None, until: Optional[float] = None, last: Optional[float] = None,
+                          fields: Optional[str] = None, step: int = 1):
+    # since / until は epoch 秒、last は直近何秒か。fields はカンマ区切り (省略時は全項目)
+    if last is not None:
+        since = time.time() - last
+    return JSONResponse(_history.query(since, until, _fields_param(fields), step))
+
+@app.get("/metrics/stream")
+async def metrics_stream(fields: Optional[str] = None):
+    # Server-Sent Events: 最初に全項目、以降は記録ごとに変化した項目だけを送る
+    sub = _history.subscribe(_fields_param(fields))
+
+    async def events():
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(sub.queue.get(), METRICS_STREAM_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {data}\n\n"
+        finally:
+            _history.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/admin/tunables")
+async def get_tunables():
+    return {"pid": os.getpid(), "values": _tuning.values(), "limits": _tuning.limits(), **_tuning.stats()}
+
+@app.put("/admin/tunables")
+async def put_tunables(changes: dict, request: Request):
+    # 指定した項目だけ変更する。1つでも不正なら 400 で何も変えない (ワーカーごとの設定)
+    try:
+        diff = _tuning.apply(changes, source=request.client.host if request.client else "")
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"pid": os.getpid(), "changed": diff, "values": _tuning.values(), "generation": _tuning.generation}
+
+@app.get("/admin/loop")
+async def loop_status(top: int = 50):
+    # イベントループを LOOP_SLOW_MS 以上止めた箇所 (合計時間の長い順)
+    return {"pid": os.getpid(), **_loopmon.stats(), "slow_sites": _loopmon.slow_sites(top)}
+
+@app.get("/admin/profiler")
+async def profiler(seconds: float = 5, hz: float = 100, loop_only: int = 0):
+    # スタックのサンプリング結果を collapsed 形式で返す (flamegraph.pl / speedscope にそのまま渡せる)
+    if not (0 < seconds <= 60 and 1 <= hz <= 1000):
+        raise HTTPException(400, "seconds must be in (0, 60] and hz in [1, 1000]")
+    tid = (_loopmon.thread_id or None) if loop_only else None
+    out = await asyncio.to_thread(sample_stacks, seconds, hz, tid)
+    if out is None:
+        raise HTTPException(409, "profiler is already running")
+    return PlainTextResponse(out)
 
 
 @app.on_event("startup")
 async def _startup():
     _os.makedirs(_os.path.dirname(LOG_PATH), exist_ok=True)
+    if AUDIT_GROUP_COMMIT:
+        _audit.open()
+    if SESSION_SHARED:
+        global _shm
+        t = SharedSessionTable(SESSION_SHM_NAME, MAX_SESSIONS)
+        t.claim_row(os.getpid())
+        _shm = t
     asyncio.create_task(_gc_loop())
+    if LOOP_MONITOR:
+        _loopmon.start()
+    if METRICS_SAMPLE_S > 0:
+        asyncio.create_task(_history_loop())
+    if _trace.enabled:
+        _trace.open()
+        asyncio.create_task(_trace.run())
+    if _capture:
+        _capture.open()
+        asyncio.create_task(_capture.run())
 
 @app.on_event("shutdown")
 async def _shutdown():
+    global _shm
+    _loopmon.stop()
     await client.aclose()
+    _audit.close()
+    _trace.close()
+    if _capture:
+        _capture.close()
+    if _shm is not None:
+        t, _shm = _shm, None
+        t.close()  # 最後のワーカーなら共有メモリと lock ファイルも消す
     _log_exec.shutdown(wait=False)
\ No newline at end of file
@@ -0,0 +1,165 @@
+import math, time, json, asyncio
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Optional, Sequence, Set
+
+from hdr_histogram import LatencyHistogram
+
+# === メトリクス部品 ===
+# RollingCounter : 1秒ごとのリングバケット。記録 O(1)、窓の読み出し O(窓秒数)
+# LatencyHistogram: HDR 風の対数線形バケット (hdr_histogram.py。ここから再エクスポートしている)
+# MetricsHistory  : 1秒ごとのスナップショットを項目別の固定長配列に持つリング + SSE 購読者への差分配信
+# どちらもイベントループのスレッドからのみ触る前提でロックを取らない。
+
+
+class RollingCounter:
+    def __init__(self, window_s: int):
+        self.window_s = max(1, window_s)
+        n = self.window_s + 1
+        self._counts = array("q", [0] * n)
+        self._stamps = array("q", [-1] * n)
+        self.total = 0
+
+    def add(self, v: int = 1, now: Optional[float] = None):
+        sec = int(now if now is not None else time.time())
+        i = sec % len(self._counts)
+        if self._stamps[i] != sec:
+            self._stamps[i] = sec
+            self._counts[i] = 0
+        self._counts[i] += v
+        self.total += v
+
+    def sum(self, now: Optional[float] = None) -> int:
+        # 直近 window_s 秒 (現在の秒を含む) の合計
+        sec = int(now if now is not None else time.time())
+        lo = sec - self.window_s
+        s = 0
+        for st, c in zip(self._stamps, self._counts):
+            if lo < st <= sec:
+                s += c
+        return s
+
+
+class _Subscriber:
+    def __init__(self, fields: Optional[Set[str]], maxsize: int):
+        self.fields = fields
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize)
+        self.resync = False  # 取りこぼした差分があるので次は全項目を送る
+
+
+class MetricsHistory:
+    """数値メトリクスの時系列 (直近 capacity 件)。記録は1つのサンプラーからのみ行う。"""
+
+    def __init__(self, capacity: int, queue_size: int = 64):
+        self.capacity = max(1, capacity)
+        self.queue_size = max(1, queue_size)
+        self._ts = array("d", [0.0] * self.capacity)
+        self._cols: Dict[str, array] = {}  # 項目 -> 値 (未記録は nan)。項目は初出時に確保する
+        self._w = 0  # 記録した件数 (累計)
+        self._last: Dict[str, float] = {}
+        self._subs: Set[_Subscriber] = set()
+        self.dropped_events = 0
+
+    def __len__(self) -> int:
+        return min(self._w, self.capacity)
+
+    def record(self, ts: float, flat: Dict[str, object]):
+        vals = {}
+        for k, v in flat.items():
+            if isinstance(v, bool):
+                v = int(v)
+            if isinstance(v, (int, float)):
+                vals[k] = float(v)
+        i = self._w % self.capacity
+        self._ts[i] = ts
+        for k, col in self._cols.items():
+            col[i] = vals.get(k, math.nan)
+        for k in vals.keys() - self._cols.keys():
+            col = self._cols[k] = array("d", [math.nan] * self.capacity)
+            col[i] = vals[k]
+        self._w += 1
+        delta = {k: v for k, v in vals.items() if self._last.get(k) != v}
+        self._last = vals
+        self._publish(ts, delta)
+
+    # --- 範囲読み出し ---
+    def _pos(self, j: int) -> int:
+        # 古い順に数えた j 番目のリング上の位置
+        return (self._w - len(self) + j) % self.capacity
+
+    def query(self, since: Optional[float] = None, until: Optional[float] = None,
+              fields: Optional[Iterable[str]] = None, step: int = 1) -> dict:
+        n = len(self)
+        ts = [self._ts[self._pos(j)] for j in range(n)]  # 記録は時刻順
+        lo = bisect_left(ts, since) if since is not None else 0
+        hi = bisect_right(ts, until) if until is not None else n
+        idx = [self._pos(j) for j in range(lo, hi, max(1, step))]
+        names = [k for k in (fields if fields is not None else sorted(self._cols)) if k in self._cols]
+        out = {"t": [self._ts[i] for i in idx]}
+        for k in names:
+            col = self._cols[k]
+            out[k] = [None if math.isnan(col[i]) else col[i] for i in idx]
+        return out
+
+    # --- 差分配信 (SSE) ---
+    def subscribe(self, fields: Optional[Iterable[str]] = None) -> _Subscriber:
+        sub = _Subscriber(set(fields) if fields is not None else None, self.queue_size)
+        sub.resync = True  # 最初は現在値を全項目送る
+        self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber):
+        self._subs.discard(sub)
+
+    def _publish(self, ts: float, delta: Dict[str, float]):
+        if not self._subs:
+            return
+        shared = None  # 項目指定なしの購読者には同じ文字列を使い回す
+        for sub in self._subs:
+            if sub.queue.full():
+                # 読み出しが追いつかない購読者: 溜まった差分を捨て、次は全項目で送り直す
+                while not sub.queue.empty():
+                    sub.queue.get_nowait()
+                    self.dropped_events += 1
+                sub.resync = True
+            if sub.resync:
+                body = self._last if sub.fields is None else {k: v for k, v in self._last.items() if k in sub.fields}
+                sub.queue.put_nowait(json.dumps({"t": ts, "full": True, "values": body}))
+                sub.resync = False
+            elif sub.fields is None:
+                if shared is None:
+                    shared = json.dumps({"t": ts, "values": delta})
+                sub.queue.put_nowait(shared)
+            else:
+                d = {k: v for k, v in delta.items() if k in sub.fields}
+                sub.queue.put_nowait(json.dumps({"t": ts, "values": d}))
+
+    def stats(self) -> dict:
+        return {
+            "history_samples": len(self),
+            "history_fields": len(self._cols),
+            "history_subscribers": len(self._subs),
+            "history_dropped_events": self.dropped_events,
+        }
+
+
+def prometheus_text(prefix: str, flat: Dict[str, object], hists: Dict[str, LatencyHistogram],
+                    quantiles: Sequence[float] = (0.5, 0.9, 0.99)) -> str:
+    """数値メトリクスを gauge、ステージ別ヒストグラムを summary として出力する。"""
+    lines = []
+    for k, v in flat.items():
+        if isinstance(v, bool):
+            v = int(v)
+        if not isinstance(v, (int, float)):
+            continue
+        name = f"{prefix}_{k}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {v}")
+    name = f"{prefix}_stage_latency_seconds"
+    lines.append(f"# TYPE {name} summary")
+    for stage, h in hists.items():
+        for q, v in zip(quantiles, h.percentiles([q * 100 for q in quantiles])):
+            lines.append(f'{name}{{stage="{stage}",quantile="{q:g}"}} {v:.6f}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum_s:.6f}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+    return "\n".join(lines) + "\n"
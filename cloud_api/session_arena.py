@@ -0,0 +1,85 @@
+import mmap, resource
+from typing import List, Optional, Tuple
+
+# === セッションバッファ用アリーナ ===
+# MAX_SESSIONS * PER_SESSION_BYTES を起動時に mmap で一括確保し、固定長スロットを
+# フリーリストから貸し出す。セッション確保は O(1)（確保・ゼロ埋めなし）、解放は
+# フリーリストに戻すだけなのでヒープが断片化しない。
+#   lazy=False: 起動時に全ページに触れて常駐させる（メモリ上限が起動時点で確定する）
+#   lazy=True : セッションが実際に書き込むまでページに触れない。解放時は
+#               MADV_DONTNEED でページをカーネルに返す
+
+_PAGE = mmap.PAGESIZE
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE
+    except (OSError, ValueError, IndexError):
+        # Linux 以外: ru_maxrss (KB) で近似
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SessionArena:
+    def __init__(self, slots: int, slot_bytes: int, lazy: bool = False):
+        self.slots = max(1, slots)
+        self.slot_bytes = max(1, slot_bytes)
+        self.lazy = lazy
+        self.size = self.slots * self.slot_bytes
+        self._mm = mmap.mmap(-1, self.size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+        self._view = memoryview(self._mm)
+        # 低いインデックスから再利用されるよう逆順に積む
+        self._free: List[int] = list(range(self.slots - 1, -1, -1))
+        self._peak = 0
+        if not lazy:
+            self._prefault()
+
+    def _prefault(self):
+        mm = self._mm
+        for off in range(0, self.size, _PAGE):
+            mm[off] = 0
+
+    def acquire(self) -> Tuple[int, memoryview]:
+        """空きスロットを1つ取り出す。空きがなければ IndexError。"""
+        idx = self._free.pop()
+        used = self.slots - len(self._free)
+        if used > self._peak:
+            self._peak = used
+        off = idx * self.slot_bytes
+        return idx, self._view[off:off + self.slot_bytes]
+
+    def release(self, idx: int, buf: Optional[memoryview] = None):
+        if buf is not None:
+            buf.release()
+        if self.lazy and hasattr(self._mm, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+            off = idx * self.slot_bytes
+            # madvise はページ境界が必要。slot_bytes がページ倍数でない場合は諦める
+            if off % _PAGE == 0 and self.slot_bytes % _PAGE == 0:
+                self._mm.madvise(mmap.MADV_DONTNEED, off, self.slot_bytes)
+        self._free.append(idx)
+
+    @property
+    def free(self) -> int:
+        return len(self._free)
+
+    @property
+    def used(self) -> int:
+        return self.slots - len(self._free)
+
+    def stats(self) -> dict:
+        used = self.used
+        return {
+            "arena_slots": self.slots,
+            "arena_used": used,
+            "arena_free": self.slots - used,
+            "arena_peak": self._peak,
+            "arena_occupancy": round(used / self.slots, 3),
+            "arena_bytes": self.size,
+            "arena_lazy": self.lazy,
+            "rss_mb": round(rss_bytes() / (1024 * 1024), 1),
+        }
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
@@ -0,0 +1,413 @@
+import os, time, fcntl, struct, hashlib, tempfile
+from multiprocessing import shared_memory, resource_tracker
+from typing import Dict, List, Optional, Tuple
+
+# === ワーカー間共有のセッション台帳 ===
+# uvicorn --workers N で動かしても MAX_SESSIONS を全体で守るための共有メモリ上のハッシュ表。
+#   - 固定長スロットのオープンアドレス法 (線形探索 + tombstone)
+#   - count には「確保済みセッション + 起床待ちへの予約」を含め、MAX_SESSIONS を超えない
+#   - プロセス間の排他は lock ファイルへの flock。呼び出し元はイベントループのスレッドなので、
+#     ロックを持つ区間は O(1) に限る (ハッシュ表の1回の探索とヘッダの読み書き。負荷率は 1/2 以下)。
+#     O(capacity) の処理 (tombstone の掃除・落ちたワーカーの回収) は gc ループから呼び、
+#     走査はロックの外で行い、ロックが取れなければその周期は諦める
+#   - ロック待ちはブロックする flock ではなく LOCK_NB の再試行 (間隔を倍々に伸ばす) で、待った回数と最大時間を stats に出す
+#   - カウンタはワーカーごとの行に各自が書き込み、読む側が合計する (書き込みはロック不要)
+# セッションのバッファ自体は各ワーカーのアリーナにあり、ここでは sid と時刻だけを共有する。
+# 最後に抜けるワーカーが close() で共有メモリと lock ファイルを消す。
+
+_MAGIC = 0x53455353  # "SESS"
+_VERSION = 1
+_HDR = struct.Struct("<IIIIqqqq")  # magic, version, capacity, max_sessions, count, boot, live, tombstones
+_HDR_SIZE = 64
+_SLOT = struct.Struct("<BxxxiQdd56s")  # state, owner pid, key hash, last_used, sticky_ts, key
+_EMPTY, _USED, _TOMB = 0, 1, 2
+_KEY_BYTES = 56
+
+LOCK_SPIN_S = 20e-6      # ロック再試行の初回間隔
+LOCK_BACKOFF_MAX_S = 1e-3  # ロック再試行の間隔の上限
+
+MAX_WORKERS = 64
+ROW_COUNTERS = 16
+_ROW = struct.Struct("<q" + "q" * ROW_COUNTERS)  # pid, counters...
+
+
+def _hash(key: bytes) -> int:
+    # hash() はプロセスごとにランダム化されるので使えない
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _alive(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedSessionTable:
+    def __init__(self, name: str, max_sessions: int, boot: Optional[int] = None):
+        self.name = name
+        self.max_sessions = max_sessions
+        cap = 1
+        while cap < max_sessions * 2:
+            cap <<= 1
+        self.capacity = cap
+        self._mask = cap - 1
+        self._slots_off = _HDR_SIZE
+        self._rows_off = _HDR_SIZE + cap * _SLOT.size
+        size = self._rows_off + MAX_WORKERS * _ROW.size
+        self.boot = os.getppid() if boot is None else boot
+
+        lock_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self._lock_path = os.path.join(lock_dir, f"{name}.lock")
+        self.lock_waits = 0
+        self.lock_wait_max_s = 0.0
+        self._lock_fd = self._open_lock()
+        try:
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                self._init()
+            except FileExistsError:
+                self._shm = shared_memory.SharedMemory(name=name)
+                magic, ver, c, m, _, b, _, _ = _HDR.unpack_from(self._shm.buf, 0)
+                # 前回起動の残骸 (親プロセスが違う / レイアウトが違う) なら作り直す
+                if (magic, ver, c, m, b) != (_MAGIC, _VERSION, cap, max_sessions, self.boot) or self._shm.size < size:
+                    if self._shm.size < size:
+                        self._shm.close()
+                        self._shm.unlink()
+                        self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                    self._init()
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        # resource_tracker はどれか1プロセスの終了時に共有メモリを unlink してしまうので外す。
+        # 登録は POSIX の共有メモリ名 ("/" 始まり) で行われるが、SharedMemory.name は "/" を除いた名前を返す
+        self._tracked = "/" + self._shm.name.lstrip("/")
+        try:
+            resource_tracker.unregister(self._tracked, "shared_memory")
+        except Exception:
+            pass
+        self._buf = self._shm.buf
+        self._row = -1
+
+    def _init(self):
+        buf = self._shm.buf
+        buf[:self._rows_off + MAX_WORKERS * _ROW.size] = bytes(self._rows_off + MAX_WORKERS * _ROW.size)
+        _HDR.pack_into(buf, 0, _MAGIC, _VERSION, self.capacity, self.max_sessions, 0, self.boot, 0, 0)
+
+    # --- lock ---
+    def _open_lock(self) -> int:
+        # 最後のワーカーが lock ファイルを消した直後に開いた場合に備え、ロックを取った後で
+        # パスが同じファイルを指しているか確かめる (違えば開き直す)。返すときはロックを持っている
+        while True:
+            fd = os.open(self._lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+            self._acquire(fd)
+            try:
+                if os.stat(self._lock_path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _acquire(self, fd: int, blocking: bool = True) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if not blocking:
+                return False
+        # 相手の臨界区間は O(1) なので、短い間隔から倍々に伸ばして取り直す
+        self.lock_waits += 1
+        t0 = time.monotonic()
+        delay = LOCK_SPIN_S
+        while True:
+            time.sleep(delay)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                delay = min(delay * 2, LOCK_BACKOFF_MAX_S)
+        self.lock_wait_max_s = max(self.lock_wait_max_s, time.monotonic() - t0)
+        return True
+
+    def try_lock(self) -> bool:
+        """ロックが空いていれば取って True (解放は __exit__)。"""
+        return self._acquire(self._lock_fd, blocking=False)
+
+    def __enter__(self):
+        self._acquire(self._lock_fd)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # --- header ---
+    def _hdr(self) -> list:
+        return list(_HDR.unpack_from(self._buf, 0))
+
+    def _set_hdr(self, h: list):
+        _HDR.pack_into(self._buf, 0, *h)
+
+    @property
+    def count(self) -> int:
+        return _HDR.unpack_from(self._buf, 0)[4]
+
+    # --- slots ---
+    def _slot_off(self, i: int) -> int:
+        return self._slots_off + i * _SLOT.size
+
+    def _find(self, key: bytes, h: int) -> Tuple[int, int]:
+        """(見つかった位置 or -1, 挿入に使える位置) を返す。"""
+        i = h & self._mask
+        first_free = -1
+        for _ in range(self.capacity):
+            st, _, hh, _, _, kk = _SLOT.unpack_from(self._buf, self._slot_off(i))
+            if st == _EMPTY:
+                return -1, (first_free if first_free >= 0 else i)
+            if st == _TOMB:
+                if first_free < 0:
+                    first_free = i
+            elif hh == h and kk.rstrip(b"\0") == key:
+                return i, i
+            i = (i + 1) & self._mask
+        return -1, first_free
+
+    @staticmethod
+    def _key(sid: str) -> bytes:
+        return sid.encode()[:_KEY_BYTES]
+
+    def _put(self, key: bytes, h: int, now: float, owner: int) -> bool:
+        found, pos = self._find(key, h)
+        if found >= 0:
+            return False
+        if pos < 0:
+            return False
+        off = self._slot_off(pos)
+        was_tomb = self._buf[off] == _TOMB
+        _SLOT.pack_into(self._buf, off, _USED, owner, h, now, 0.0, key)
+        hd = self._hdr()
+        hd[6] += 1
+        if was_tomb:
+            hd[7] -= 1
+        self._set_hdr(hd)
+        return True
+
+    def _rebuild_if_needed(self, limit: int):
+        # 表を詰め直す (O(capacity))。通常は gc ループの compact() が capacity/4 で行い、
+        # 挿入側はそれが追いつかなかったとき (capacity/2) だけ行う
+        hd = self._hdr()
+        if hd[7] <= limit:
+            return
+        live = []
+        for i in range(self.capacity):
+            off = self._slot_off(i)
+            rec = _SLOT.unpack_from(self._buf, off)
+            if rec[0] == _USED:
+                live.append(rec)
+            self._buf[off:off + _SLOT.size] = bytes(_SLOT.size)
+        hd[6], hd[7] = 0, 0
+        self._set_hdr(hd)
+        for st, owner, h, lu, sticky, key in live:
+            _, pos = self._find(key.rstrip(b"\0"), h)
+            _SLOT.pack_into(self._buf, self._slot_off(pos), st, owner, h, lu, sticky, key)
+        hd = self._hdr()
+        hd[6] = len(live)
+        self._set_hdr(hd)
+
+    # --- public (全てロックを取る) ---
+    def touch(self, sid: str, now: float) -> bool:
+        key = self._key(sid); h = _hash(key)
+        with self:
+            i, _ = self._find(key, h)
+            if i < 0:
+                return False
+            struct.pack_into("<d", self._buf, self._slot_off(i) + 16, now)
+            return True
+
+    def try_insert(self, sid: str, now: float, owner: int) -> bool:
+        key = self._key(sid); h = _hash(key)
+        with self:
+            hd = self._hdr()
+            if hd[4] >= self.max_sessions:
+                return False
+            self._rebuild_if_needed(self.capacity // 2)
+            if not self._put(key, h, now, owner):
+                return False
+            hd = self._hdr(); hd[4] += 1; self._set_hdr(hd)
+            return True
+
+    def try_reserve(self, n: int) -> int:
+        if n <= 0:
+            return 0
+        with self:
+            hd = self._hdr()
+            k = max(0, min(n, self.max_sessions - hd[4]))
+            hd[4] += k
+            self._set_hdr(hd)
+            return k
+
+    def unreserve(self, n: int = 1):
+        if n <= 0:
+            return
+        with self:
+            hd = self._hdr(); hd[4] = max(0, hd[4] - n); self._set_hdr(hd)
+
+    def insert_reserved(self, sid: str, now: float, owner: int) -> bool:
+        """予約済みの枠を sid に割り当てる。既に登録済みなら予約を返して False。"""
+        key = self._key(sid); h = _hash(key)
+        with self:
+            self._rebuild_if_needed(self.capacity // 2)
+            if self._put(key, h, now, owner):
+                return True
+            hd = self._hdr(); hd[4] = max(0, hd[4] - 1); self._set_hdr(hd)
+            return False
+
+    def remove(self, sid: str) -> bool:
+        key = self._key(sid); h = _hash(key)
+        with self:
+            i, _ = self._find(key, h)
+            if i < 0:
+                return False
+            self._buf[self._slot_off(i)] = _TOMB
+            hd = self._hdr()
+            hd[4] = max(0, hd[4] - 1); hd[6] -= 1; hd[7] += 1
+            self._set_hdr(hd)
+            return True
+
+    def times(self, sid: str) -> Optional[Tuple[float, float]]:
+        key = self._key(sid); h = _hash(key)
+        with self:
+            i, _ = self._find(key, h)
+            if i < 0:
+                return None
+            _, _, _, lu, sticky, _ = _SLOT.unpack_from(self._buf, self._slot_off(i))
+            return lu, sticky
+
+    def mark_sticky(self, sid: str, now: float):
+        key = self._key(sid); h = _hash(key)
+        with self:
+            i, _ = self._find(key, h)
+            if i >= 0:
+                struct.pack_into("<d", self._buf, self._slot_off(i) + 24, now)
+
+    # --- 保守 (gc ループから。ロックが取れなければ何もしない) ---
+    def compact(self) -> bool:
+        if _HDR.unpack_from(self._buf, 0)[7] <= self.capacity // 4:
+            return False
+        if not self.try_lock():
+            return False
+        try:
+            self._rebuild_if_needed(self.capacity // 4)
+        finally:
+            self.__exit__()
+        return True
+
+    def reap_dead_owners(self) -> int:
+        # 落ちたワーカーが持っていたセッションを回収する。走査と生存確認はロックの外で行い、
+        # ロック中は候補の位置の owner が変わっていないかを確かめて消すだけにする
+        dead: Dict[int, bool] = {}
+        cand = []
+        for i in range(self.capacity):
+            off = self._slot_off(i)
+            if self._buf[off] != _USED:
+                continue
+            owner = struct.unpack_from("<i", self._buf, off + 4)[0]
+            if owner not in dead:
+                dead[owner] = not _alive(owner)
+            if dead[owner]:
+                cand.append((off, owner))
+        if not cand or not self.try_lock():
+            return 0
+        reaped = 0
+        try:
+            hd = self._hdr()
+            for off, owner in cand:
+                if self._buf[off] == _USED and struct.unpack_from("<i", self._buf, off + 4)[0] == owner:
+                    self._buf[off] = _TOMB
+                    hd[4] = max(0, hd[4] - 1); hd[6] -= 1; hd[7] += 1
+                    reaped += 1
+            self._set_hdr(hd)
+        finally:
+            self.__exit__()
+        return reaped
+
+    # --- ワーカーごとのカウンタ行 ---
+    def claim_row(self, pid: int) -> int:
+        with self:
+            for i in range(MAX_WORKERS):
+                off = self._rows_off + i * _ROW.size
+                owner = struct.unpack_from("<q", self._buf, off)[0]
+                if owner == pid or owner == 0 or not _alive(owner):
+                    if owner != pid:
+                        _ROW.pack_into(self._buf, off, pid, *([0] * ROW_COUNTERS))
+                    self._row = i
+                    return i
+        raise RuntimeError("no free worker row in shared session table")
+
+    def add(self, idx: int, d: int):
+        if self._row < 0 or idx >= ROW_COUNTERS:
+            return
+        off = self._rows_off + self._row * _ROW.size + 8 + idx * 8
+        v = struct.unpack_from("<q", self._buf, off)[0]
+        struct.pack_into("<q", self._buf, off, v + d)
+
+    def sum_counters(self, n: int) -> Tuple[List[int], int]:
+        tot = [0] * n
+        workers = 0
+        for i in range(MAX_WORKERS):
+            rec = _ROW.unpack_from(self._buf, self._rows_off + i * _ROW.size)
+            if rec[0] == 0:
+                continue
+            workers += 1
+            for k in range(min(n, ROW_COUNTERS)):
+                tot[k] += rec[1 + k]
+        return tot, workers
+
+    def stats(self) -> dict:
+        hd = self._hdr()
+        return {
+            "shared_session_count": hd[4],
+            "shared_live_entries": hd[6],
+            "shared_tombstones": hd[7],
+            "shared_capacity": self.capacity,
+            "shared_lock_waits": self.lock_waits,
+            "shared_lock_wait_max_ms": round(self.lock_wait_max_s * 1000, 3),
+        }
+
+    def close(self, owner: Optional[int] = None) -> bool:
+        """表から抜ける。owner のセッションと自分の行を消し、他に生きているワーカーがいなければ
+        共有メモリと lock ファイルを unlink する。unlink したら True。"""
+        owner = os.getpid() if owner is None else owner
+        last = False
+        with self:
+            hd = self._hdr()
+            for i in range(self.capacity):
+                off = self._slot_off(i)
+                if self._buf[off] == _USED and struct.unpack_from("<i", self._buf, off + 4)[0] == owner:
+                    self._buf[off] = _TOMB
+                    hd[4] = max(0, hd[4] - 1); hd[6] -= 1; hd[7] += 1
+            self._set_hdr(hd)
+            if self._row >= 0:
+                _ROW.pack_into(self._buf, self._rows_off + self._row * _ROW.size, 0, *([0] * ROW_COUNTERS))
+                self._row = -1
+            others = [struct.unpack_from("<q", self._buf, self._rows_off + i * _ROW.size)[0] for i in range(MAX_WORKERS)]
+            last = not any(p and p != owner and _alive(p) for p in others)
+            self._buf = None
+            self._shm.close()
+            if last:
+                # lock を持ったまま消す。開き直し待ちのワーカーは _open_lock で新しいファイルを作り直す
+                # unlink() は resource_tracker の登録も外すので、外してある登録を戻してから呼ぶ
+                resource_tracker.register(self._tracked, "shared_memory")
+                try:
+                    self._shm.unlink()
+                except FileNotFoundError:
+                    resource_tracker.unregister(self._tracked, "shared_memory")
+                try:
+                    os.unlink(self._lock_path)
+                except FileNotFoundError:
+                    pass
+        os.close(self._lock_fd)
+        return last
@@ -0,0 +1,76 @@
+import time, asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+# === 重複コマンドの single-flight + 短命結果キャッシュ ===
+# 同じキー (command, vehicle_id) の呼び出しが同時に来たら下流呼び出しを1回にまとめ、
+# 完了直後の再要求は TTL 内ならキャッシュから返す。冪等なコマンドにだけ使うこと。
+# 下流呼び出しは独立したタスクで走らせるので、先頭の呼び出し元がキャンセルされても
+# 相乗りしている他の呼び出し元には影響しない。
+
+
+class SingleFlight:
+    def __init__(self, ttl_s: float = 1.0, max_entries: int = 10000):
+        self.ttl_s = max(0.0, ttl_s)
+        self.max_entries = max(0, max_entries)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._cache: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _cache_get(self, key: Hashable):
+        ent = self._cache.get(key)
+        if ent is None:
+            return False, None
+        exp, val = ent
+        if exp < time.monotonic():
+            del self._cache[key]
+            return False, None
+        self._cache.move_to_end(key)
+        return True, val
+
+    def _cache_put(self, key: Hashable, val: Any):
+        if self.ttl_s <= 0 or self.max_entries <= 0:
+            return
+        self._cache[key] = (time.monotonic() + self.ttl_s, val)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Awaitable[Any]:
+        """key の結果を返す awaitable。キャッシュ > 実行中の呼び出し > 新規実行 の順に使う。"""
+        ok, val = self._cache_get(key)
+        if ok:
+            self.hits += 1
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_result(val)
+            return fut
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+        return asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self._cache_put(key, task.result())
+
+    def stats(self) -> dict:
+        return {
+            "singleflight_hits": self.hits,
+            "singleflight_coalesced": self.coalesced,
+            "singleflight_misses": self.misses,
+            "singleflight_inflight": len(self._inflight),
+            "result_cache_size": len(self._cache),
+            "result_cache_evictions": self.evictions,
+            "result_cache_ttl_s": self.ttl_s,
+        }
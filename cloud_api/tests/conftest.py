@@ -0,0 +1,5 @@
+import os
+import sys
+
+# cloud_api のモジュールはフラットに import される (Dockerfile で /app 直下に置く) ので同じように読む
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+import types
+
+import pytest
+
+import admission
+from admission import AdmissionController
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_deadline_header_forms():
+    a = AdmissionController(60)
+    now = 1_700_000_000.0
+    assert a.deadline_from({"x-request-deadline": "30"}, now) == now + 30
+    assert a.deadline_from({"x-request-deadline": "1700000005.5"}, now) == 1700000005.5
+    assert a.deadline_from({"x-request-deadline": "soon"}, now) == now + 60
+    assert a.deadline_from({}, now) == now + 60
+
+
+def test_no_wait_when_session_known_or_free():
+    a = AdmissionController(60)
+    a.queued = 3
+    assert a.estimate_wait(True, 0) == 0.0
+    assert a.estimate_wait(False, 4) == 0.0
+
+
+def test_cold_start_uses_service_prior(clock):
+    a = AdmissionController(60, service_prior_s=0.2)
+    assert a.admit_rate() == 0.0
+    a.queued = 9
+    assert a.estimate_wait(False, 0) == pytest.approx(10 * 0.2)
+    # 実測が入ればそちらを使う
+    a.on_service(0.05)
+    assert a.service_s == pytest.approx(0.05)
+    assert a.estimate_wait(False, 0) == pytest.approx(10 * 0.05)
+
+
+def test_wait_from_observed_admit_rate(clock):
+    a = AdmissionController(60, alpha=1.0)
+    for _ in range(20):
+        a.on_admit()
+    clock[0] += 1
+    assert a.admit_rate() == pytest.approx(20.0)
+    a.queued = 10
+    assert a.estimate_wait(False, 0) == pytest.approx(11 / 20)
+    # アイドルの間にレートは減衰する
+    clock[0] += 5
+    assert a.admit_rate() < 20.0
+
+
+def test_check_sheds_requests_that_cannot_finish():
+    a = AdmissionController(60, margin_s=0.5, service_prior_s=1.0)
+    ok, remaining, retry = a.check(10.0, 0.0, 2.0)
+    assert ok and remaining == pytest.approx(9.5) and retry == 0
+    ok, _, retry = a.check(10.0, 0.0, 9.0)
+    assert not ok and retry == 9
+    ok, remaining, retry = a.check(10.0, 10.0, 0.0)
+    assert not ok and remaining < 0 and retry >= 1
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import audit_log
+from audit_log import GroupCommitLog
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_appends_share_fsyncs(tmp_path):
+    path = tmp_path / "audit.log"
+    log = GroupCommitLog(str(path), 0, max_batch=256, max_linger_s=0.02)
+    log.open()
+    try:
+        async def run():
+            await asyncio.gather(*[log.append(f"rec-{i}") for i in range(50)])
+        _run(run())
+        st = log.stats()
+    finally:
+        log.close()
+    assert st["audit_records"] == 50
+    assert st["audit_commits"] < 50
+    assert st["audit_failures"] == 0
+    assert st["audit_queue_depth"] == 0
+    assert sorted(path.read_text().split()) == sorted(f"rec-{i}" for i in range(50))
+
+
+def test_batches_are_capped_at_max_batch(tmp_path):
+    log = GroupCommitLog(str(tmp_path / "audit.log"), 0, max_batch=8, max_linger_s=0.02)
+    log.open()
+    try:
+        async def run():
+            await asyncio.gather(*[log.append(str(i)) for i in range(40)])
+        _run(run())
+        st = log.stats()
+    finally:
+        log.close()
+    assert st["audit_records"] == 40
+    assert st["audit_max_batch_seen"] <= 8
+    assert st["audit_commits"] >= 5
+
+
+def test_padding_is_appended_per_record(tmp_path):
+    path = tmp_path / "audit.log"
+    log = GroupCommitLog(str(path), 1, max_linger_s=0)
+    log.open()
+    try:
+        async def run():
+            await log.append("a")
+        _run(run())
+    finally:
+        log.close()
+    assert path.stat().st_size == 2 + 1024
+
+
+def test_fsync_failure_fails_the_whole_batch(tmp_path, monkeypatch):
+    def broken_fsync(fd):
+        raise OSError("disk gone")
+    monkeypatch.setattr(audit_log.os, "fsync", broken_fsync)
+    log = GroupCommitLog(str(tmp_path / "audit.log"), 0, max_linger_s=0.02)
+    log.open()
+    try:
+        async def run():
+            return await asyncio.gather(*[log.append(str(i)) for i in range(10)], return_exceptions=True)
+        res = _run(run())
+        st = log.stats()
+    finally:
+        log.close()
+    assert all(isinstance(r, OSError) for r in res)
+    assert st["audit_failures"] >= 1
+    assert st["audit_records"] == 0
+
+
+def test_append_requires_open_log(tmp_path):
+    log = GroupCommitLog(str(tmp_path / "audit.log"), 0)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            log.append("x")
+        log.open()
+        await log.append("y")
+        log.close()
+        with pytest.raises(RuntimeError):
+            log.append("z")
+    _run(run())
@@ -0,0 +1,89 @@
+import types
+
+import pytest
+
+import breaker
+from breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(breaker, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def _breaker(ratio, **kw):
+    opts = dict(ratio_threshold=0.5, min_requests=20, open_s=5.0, probes=1, close_after=2,
+                grace_s=0.0, eval_interval_s=0.0)
+    opts.update(kw)
+    return CircuitBreaker(lambda: ratio[0], **opts)
+
+
+def test_opens_on_high_timeout_ratio_with_enough_traffic(clock):
+    ratio = [(10, 0.9)]
+    b = _breaker(ratio)
+    assert b.allow() == (True, False)  # 件数が足りない
+    ratio[0] = (30, 0.4)
+    assert b.allow() == (True, False)  # 比率が足りない
+    ratio[0] = (30, 0.6)
+    assert b.allow() == (False, False)
+    assert b.state == OPEN
+    assert b.retry_after_s() == 5
+
+
+def test_grace_period_after_closing(clock):
+    ratio = [(30, 0.9)]
+    b = _breaker(ratio, grace_s=3.0)
+    assert b.allow() == (True, False)  # closed になってから grace_s 経つまでは開かない
+    clock[0] += 3.0
+    assert b.allow()[0] is False
+    assert b.state == OPEN
+
+
+def test_half_open_probe_closes_after_successes(clock):
+    ratio = [(30, 0.9)]
+    b = _breaker(ratio)
+    b.allow()
+    clock[0] += 4.9
+    assert b.allow() == (False, False)
+    clock[0] += 0.2
+    ratio[0] = (0, 0.0)
+    assert b.allow() == (True, True)
+    assert b.state == HALF_OPEN
+    assert b.allow() == (False, False)  # 試験は probes 件まで
+    b.on_success(False)  # 試験でないリクエストの成功では動かない
+    assert b.state == HALF_OPEN
+    b.on_success(True)
+    assert b.allow() == (True, True)
+    b.on_success(True)
+    assert b.state == CLOSED
+    assert b.transitions == {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1}
+
+
+def test_probe_timeout_reopens(clock):
+    b = _breaker([(30, 0.9)])
+    b.allow()
+    clock[0] += 5.0
+    assert b.allow() == (True, True)
+    b.on_timeout(True)
+    assert b.state == OPEN
+    assert b.allow() == (False, False)
+
+
+def test_aborted_probe_frees_its_slot(clock):
+    b = _breaker([(30, 0.9)])
+    b.allow()
+    clock[0] += 5.0
+    assert b.allow() == (True, True)
+    b.on_abort(True)
+    assert b.allow() == (True, True)
+
+
+def test_lost_probe_does_not_wedge_half_open(clock):
+    b = _breaker([(30, 0.9)])
+    b.allow()
+    clock[0] += 5.0
+    assert b.allow() == (True, True)
+    clock[0] += 5.1  # 結果が返ってこなかった
+    assert b.allow() == (True, True)
@@ -0,0 +1,44 @@
+import gzip
+import json
+
+from capture import TrafficCapture
+
+
+def _lines(path):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rt") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_records_are_written_on_close(tmp_path):
+    path = tmp_path / "cap" / "traffic.jsonl"
+    cap = TrafficCapture(str(path))
+    cap.open()
+    cap.record(1000.0, {"user_id": "u1", "vehicle_id": "v1"},
+               {"x-proxy-session": "s1", "x-request-id": "r1", "x-request-deadline": "1030.5"})
+    cap.record(1001.0, {"user_id": "u2", "vehicle_id": "v2"}, {"x-request-deadline": "12"})
+    cap.close()
+    recs = _lines(path)
+    assert recs[0] == {"t": 1000.0, "u": "u1", "v": "v1", "s": "s1",
+                       "h": {"X-Request-ID": "r1", "X-Request-Deadline": "1030.5"}}
+    assert recs[1]["h"] == {"X-Request-Deadline": "12"}
+    assert recs[1]["s"] is None
+
+
+def test_absolute_deadline_is_stored_as_remaining_seconds(tmp_path):
+    path = tmp_path / "traffic.jsonl.gz"
+    cap = TrafficCapture(str(path))
+    cap.open()
+    cap.record(1_700_000_000.0, {"user_id": "u", "vehicle_id": "v"}, {"x-request-deadline": "1700000002.5"})
+    cap.close()
+    assert _lines(path)[0]["h"]["X-Request-Deadline"] == "2.5"
+
+
+def test_pending_lines_are_bounded(tmp_path):
+    cap = TrafficCapture(str(tmp_path / "traffic.jsonl"), max_pending=2)
+    cap.open()
+    for i in range(5):
+        cap.record(float(i), {"user_id": "u", "vehicle_id": "v"}, {})
+    st = cap.stats()
+    cap.close()
+    assert st["capture_records"] == 2 and st["capture_dropped"] == 3 and st["capture_pending"] == 2
@@ -0,0 +1,81 @@
+import asyncio
+
+from concurrency import AdaptiveLimiter
+
+
+def test_permits_are_limited_and_handed_over_in_order():
+    async def run():
+        lim = AdaptiveLimiter(2, min_limit=1, max_limit=8)
+        await lim.acquire()
+        await lim.acquire()
+        order = []
+
+        async def waiter(i):
+            await lim.acquire()
+            order.append(i)
+
+        tasks = [asyncio.ensure_future(waiter(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert order == [] and lim.stats()["downstream_waiting"] == 3
+        lim.release()
+        await asyncio.sleep(0)
+        assert order == [0]
+        lim.release()
+        lim.release()
+        await asyncio.gather(*tasks)
+        return order, lim.inflight
+    assert asyncio.run(run()) == ([0, 1, 2], 2)
+
+
+def test_cancelled_waiter_does_not_leak_a_permit():
+    async def run():
+        lim = AdaptiveLimiter(1)
+        await lim.acquire()
+        t = asyncio.ensure_future(lim.acquire())
+        await asyncio.sleep(0)
+        t.cancel()
+        await asyncio.sleep(0)
+        lim.release()
+        return lim.inflight, lim.stats()["downstream_waiting"]
+    assert asyncio.run(run()) == (0, 0)
+
+
+def test_timeouts_back_off_multiplicatively():
+    async def run():
+        lim = AdaptiveLimiter(16, min_limit=2, max_limit=64, timeout_backoff=0.5)
+        for _ in range(4):
+            await lim.acquire()
+            lim.release(timed_out=True)
+        return lim.limit, lim.timeouts
+    limit, timeouts = asyncio.run(run())
+    assert limit == 2 and timeouts == 4
+
+
+def test_latency_inflation_shrinks_and_healthy_rtt_grows():
+    async def run():
+        lim = AdaptiveLimiter(4, max_limit=64, tolerance=2.0, backoff=0.5)
+        # 枠を使い切った状態で基準 RTT 程度の応答が続くと増える
+        for _ in range(40):
+            for _ in range(int(lim.limit)):
+                await lim.acquire()
+            for _ in range(int(lim.limit)):
+                lim.release(rtt=0.010)
+        grown = lim.limit
+        await lim.acquire()
+        lim.release(rtt=0.050)  # 基準の5倍
+        return grown, lim.limit
+    grown, shrunk = asyncio.run(run())
+    assert grown > 4
+    assert shrunk == grown * 0.5
+
+
+def test_set_limit_wakes_waiters_and_is_clamped():
+    async def run():
+        lim = AdaptiveLimiter(1, min_limit=1, max_limit=4)
+        await lim.acquire()
+        tasks = [asyncio.ensure_future(lim.acquire()) for _ in range(3)]
+        await asyncio.sleep(0)
+        lim.set_limit(100)
+        await asyncio.gather(*tasks)
+        return lim.limit, lim.inflight
+    assert asyncio.run(run()) == (4, 4)
@@ -0,0 +1,42 @@
+import pytest
+
+from hdr_histogram import LatencyHistogram
+from metrics import prometheus_text
+
+
+def test_percentiles_within_relative_error():
+    h = LatencyHistogram()
+    for i in range(1, 10001):
+        h.record(i / 10000)  # 0.1ms .. 1s
+    for p, v in zip((50, 90, 99, 99.9), h.percentiles([50, 90, 99, 99.9])):
+        assert v == pytest.approx(p / 100, rel=0.02)
+    s = h.summary((50, 99))
+    assert set(s) == {"p50_ms", "p99_ms", "max_ms", "avg_ms", "count"}
+    assert s["count"] == 10000
+
+
+def test_small_and_huge_values_are_clamped():
+    h = LatencyHistogram()
+    h.record(-1)
+    h.record(1e9)
+    assert h.count == 2
+    lo, hi = h.percentiles([0, 100])
+    assert lo == 0.0
+    assert 1e6 < hi <= 1e9  # 最大のバケットに入る
+    assert h.max_s == 1e9
+
+
+def test_empty_histogram():
+    h = LatencyHistogram()
+    assert h.percentiles([50]) == [0.0]
+    assert h.summary()["avg_ms"] == 0.0
+
+
+def test_prometheus_text_has_quantiles():
+    h = LatencyHistogram()
+    h.record(0.01)
+    text = prometheus_text("cloud_api", {"pending": 3, "name": "x", "ok": True}, {"total": h})
+    assert "cloud_api_pending 3" in text
+    assert "cloud_api_ok 1" in text
+    assert "cloud_api_name" not in text
+    assert 'cloud_api_stage_latency_seconds_count{stage="total"} 1' in text
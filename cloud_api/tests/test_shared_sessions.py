@@ -0,0 +1,136 @@
+import os
+import sys
+import uuid
+import threading
+import subprocess
+from multiprocessing import shared_memory
+
+import pytest
+
+fcntl = pytest.importorskip("fcntl")
+from shared_sessions import SharedSessionTable
+
+
+@pytest.fixture
+def name():
+    n = f"test_sessions_{uuid.uuid4().hex[:8]}"
+    yield n
+    try:
+        t = shared_memory.SharedMemory(name=n)
+    except FileNotFoundError:
+        return
+    t.close()
+    t.unlink()
+
+
+def _dead_pid() -> int:
+    p = subprocess.Popen([sys.executable, "-c", "pass"])
+    p.wait()
+    return p.pid
+
+
+def test_reserve_never_exceeds_max_sessions(name):
+    t = SharedSessionTable(name, 4, boot=1)
+    assert t.try_reserve(3) == 3
+    assert t.try_reserve(3) == 1
+    assert t.count == 4
+    t.unreserve(2)
+    assert t.count == 2
+    t.close()
+
+
+def test_insert_reserved_and_remove(name):
+    t = SharedSessionTable(name, 4, boot=1)
+    assert t.try_reserve(1) == 1
+    assert t.insert_reserved("s1", 100.0, os.getpid())
+    assert t.times("s1") == (100.0, 0.0)
+    # 登録済みの sid には予約を返す
+    assert t.try_reserve(1) == 1
+    assert not t.insert_reserved("s1", 101.0, os.getpid())
+    assert t.count == 1
+    t.mark_sticky("s1", 105.0)
+    assert t.times("s1") == (100.0, 105.0)
+    assert t.remove("s1")
+    assert not t.remove("s1")
+    assert t.count == 0
+    assert t.times("s1") is None
+    t.close()
+
+
+def test_tables_share_state_across_instances(name):
+    a = SharedSessionTable(name, 4, boot=1)
+    b = SharedSessionTable(name, 4, boot=1)
+    assert a.try_insert("s1", 1.0, os.getpid())
+    assert b.times("s1") == (1.0, 0.0)
+    assert b.try_reserve(10) == 3
+    b.close()
+    a.close()
+
+
+def test_reap_dead_owners(name):
+    t = SharedSessionTable(name, 8, boot=1)
+    dead = _dead_pid()
+    for i in range(3):
+        assert t.try_insert(f"d{i}", 1.0, dead)
+    assert t.try_insert("live", 1.0, os.getpid())
+    assert t.reap_dead_owners() == 3
+    assert t.count == 1
+    assert t.times("live") is not None
+    assert t.times("d0") is None
+    t.close()
+
+
+def test_compact_clears_tombstones(name):
+    t = SharedSessionTable(name, 8, boot=1)  # capacity 16 -> compact は tombstone 5 件から
+    for i in range(6):
+        assert t.try_insert(f"s{i}", 1.0, os.getpid())
+    for i in range(5):
+        t.remove(f"s{i}")
+    assert t.stats()["shared_tombstones"] == 5
+    assert t.compact()
+    st = t.stats()
+    assert st["shared_tombstones"] == 0
+    assert st["shared_live_entries"] == 1
+    assert t.times("s5") == (1.0, 0.0)
+    assert not t.compact()
+    t.close()
+
+
+def test_lock_contention_backs_off(name):
+    t = SharedSessionTable(name, 4, boot=1)
+    dead = _dead_pid()
+    assert t.try_insert("d", 1.0, dead)
+    fd = os.open(t._lock_path, os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        # 保守処理はロックが取れなければその周期は諦める
+        assert not t.try_lock()
+        assert t.reap_dead_owners() == 0
+        # 通常の操作は再試行して、解放されたら取れる
+        threading.Timer(0.05, fcntl.flock, (fd, fcntl.LOCK_UN)).start()
+        assert t.try_insert("x", 1.0, os.getpid())
+    finally:
+        os.close(fd)
+    st = t.stats()
+    assert st["shared_lock_waits"] == 1
+    assert st["shared_lock_wait_max_ms"] >= 40
+    assert t.reap_dead_owners() == 1
+    t.close()
+
+
+def test_close_unlinks_only_when_last(name):
+    a = SharedSessionTable(name, 4, boot=1)
+    a.claim_row(os.getpid())
+    b = SharedSessionTable(name, 4, boot=1)
+    b.claim_row(os.getppid())  # 生きている別プロセスとして登録
+    assert b.try_insert("mine", 1.0, os.getppid())
+    assert a.try_insert("other", 1.0, os.getpid())
+    assert not a.close()
+    # a のセッションは消え、b のものは残る
+    assert b.times("other") is None
+    assert b.times("mine") is not None
+    lock_path = b._lock_path
+    assert b.close(owner=os.getppid())
+    assert not os.path.exists(lock_path)
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def run():
+        sf = SingleFlight(ttl_s=0)
+        res = await asyncio.gather(*[sf.do("k", fetch) for _ in range(5)])
+        return res, sf.stats()
+    res, st = asyncio.run(run())
+    assert res == ["ok"] * 5
+    assert len(calls) == 1
+    assert st["singleflight_misses"] == 1 and st["singleflight_coalesced"] == 4
+    assert st["singleflight_inflight"] == 0
+
+
+def test_result_cache_expires_after_ttl():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        sf = SingleFlight(ttl_s=0.05)
+        a = await sf.do("k", fetch)
+        b = await sf.do("k", fetch)
+        other = await sf.do("other", fetch)
+        await asyncio.sleep(0.06)
+        c = await sf.do("k", fetch)
+        return a, b, other, c, sf.stats()
+    a, b, other, c, st = asyncio.run(run())
+    assert (a, b, other, c) == (1, 1, 2, 3)
+    assert st["singleflight_hits"] == 1
+
+
+def test_failures_are_shared_but_not_cached():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        sf = SingleFlight(ttl_s=10)
+        res = await asyncio.gather(sf.do("k", fetch), sf.do("k", fetch), return_exceptions=True)
+        with pytest.raises(ValueError):
+            await sf.do("k", fetch)
+        return res, sf.stats()
+    res, st = asyncio.run(run())
+    assert all(isinstance(r, ValueError) for r in res)
+    assert len(calls) == 2
+    assert st["result_cache_size"] == 0
+
+
+def test_cancelling_one_caller_does_not_cancel_the_others():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        sf = SingleFlight(ttl_s=0)
+        first = asyncio.ensure_future(sf.do("k", fetch))
+        second = asyncio.ensure_future(sf.do("k", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second, first.cancelled()
+    assert asyncio.run(run()) == ("done", True)
+
+
+def test_cache_is_bounded():
+    async def run():
+        sf = SingleFlight(ttl_s=10, max_entries=2)
+        for k in "abc":
+            await sf.do(k, lambda k=k: asyncio.sleep(0, k))
+        return sf.stats()
+    st = asyncio.run(run())
+    assert st["result_cache_size"] == 2
+    assert st["result_cache_evictions"] == 1
@@ -0,0 +1,63 @@
+import os
+
+from tracing import REC, TraceRing, read_spans, sampled, stage_breakdown
+
+
+def test_sampling_is_deterministic_by_request_id():
+    ids = [f"req-{i}" for i in range(2000)]
+    picked = [r for r in ids if sampled(r, 0.1)]
+    assert picked == [r for r in ids if sampled(r, 0.1)]
+    assert 100 < len(picked) < 300
+    assert not sampled("x", 0) and sampled("x", 1)
+
+
+def test_spans_round_trip_through_the_file(tmp_path):
+    path = str(tmp_path / "t" / "trace.bin")
+    ring = TraceRing(path, 1, 1.0, capacity=8)
+    ring.open()
+    ring.span("rid-1", "admission", 10.0, 0.001)
+    ring.span("rid-1", "total", 10.0, 0.25, 200)
+    ring.span("rid-2", "fsync", 11.0, 0.002)
+    ring.close()
+    by_rid = read_spans([path])
+    assert [s["stage"] for s in by_rid["rid-1"]] == ["admission", "total"]
+    assert by_rid["rid-1"][1]["status"] == 200
+    assert by_rid["rid-2"][0]["service"] == "cloud_api"
+    bd = stage_breakdown(by_rid)
+    assert bd["cloud_api.total"]["count"] == 1
+    assert bd["cloud_api.total"]["max_ms"] == 250.0
+
+
+def test_ring_wraps_and_drops_when_full(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    ring = TraceRing(path, 1, 1.0, capacity=3)
+    ring.open()
+    for i in range(2):
+        ring.span(f"a{i}", "fsync", 1.0, 0.1)
+    ring._write(ring._take())
+    for i in range(4):  # 3件目でリングを一周し、4件目は溢れる
+        ring.span(f"b{i}", "fsync", 1.0, 0.1)
+    ring.close()
+    assert ring.dropped == 1
+    assert sorted(read_spans([path])) == ["a0", "a1", "b0", "b1", "b2"]
+    assert os.path.getsize(path) == 5 * REC.size
+
+
+def test_file_size_cap(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    ring = TraceRing(path, 1, 1.0, capacity=16, max_bytes=2 * REC.size)
+    ring.open()
+    for i in range(3):
+        ring.span(f"r{i}", "total", 1.0, 0.1)
+    ring.close()
+    assert ring.dropped == 3
+    assert os.path.getsize(path) == 0
+
+
+def test_disabled_ring_creates_no_file(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    ring = TraceRing(path, 1, 0.0)
+    assert not ring.enabled and not ring.want("x")
+    ring.open()
+    ring.close()
+    assert not os.path.exists(path)
@@ -0,0 +1,89 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from wait_queue import SlotWaitQueue, parse_weights, PRIO_PROBE, PRIO_REFRESH, PRIO_NEW
+
+
+def test_parse_weights_fills_defaults():
+    assert parse_weights("probe:16,new:2") == {PRIO_PROBE: 16, PRIO_NEW: 2, PRIO_REFRESH: 1}
+    assert parse_weights("refresh:0")[PRIO_REFRESH] == 1
+
+
+def _granted_classes(futs):
+    return Counter(c for c, f in futs if f.done() and not f.cancelled())
+
+
+def test_weighted_round_robin_between_classes():
+    async def run():
+        q = SlotWaitQueue({PRIO_PROBE: 4, PRIO_REFRESH: 2, PRIO_NEW: 1})
+        futs = [(c, q.enqueue(c, f"{c}{i}")) for c in (PRIO_PROBE, PRIO_REFRESH, PRIO_NEW) for i in range(20)]
+        assert len(q) == 60
+        assert q.wake(14) == 14
+        assert len(q) == 46
+        return _granted_classes(futs)
+    got = asyncio.run(run())
+    assert got == {PRIO_PROBE: 8, PRIO_REFRESH: 4, PRIO_NEW: 2}
+
+
+def test_low_priority_is_not_starved():
+    async def run():
+        q = SlotWaitQueue({PRIO_PROBE: 16, PRIO_REFRESH: 1, PRIO_NEW: 1})
+        new = q.enqueue(PRIO_NEW, "n")
+        probes = [q.enqueue(PRIO_PROBE, f"p{i}") for i in range(100)]
+        q.wake(17)
+        return new.done(), sum(f.done() for f in probes)
+    assert asyncio.run(run()) == (True, 16)
+
+
+def test_callers_take_turns_within_a_class():
+    async def run():
+        q = SlotWaitQueue(parse_weights(""))
+        heavy = [q.enqueue(PRIO_NEW, "heavy") for _ in range(10)]
+        light = [q.enqueue(PRIO_NEW, "light") for _ in range(2)]
+        q.wake(4)
+        return sum(f.done() for f in heavy), sum(f.done() for f in light)
+    assert asyncio.run(run()) == (2, 2)
+
+
+def test_abandon_removes_the_waiter():
+    async def run():
+        q = SlotWaitQueue(parse_weights(""))
+        a = q.enqueue(PRIO_NEW, "u")
+        b = q.enqueue(PRIO_NEW, "u")
+        c = q.enqueue(PRIO_REFRESH, "v")
+        a.cancel()
+        assert q.abandon(PRIO_NEW, "u", a)
+        c.cancel()
+        assert q.abandon(PRIO_REFRESH, "v", c)
+        assert len(q) == 1
+        # 実体も消えている (キャンセル済みの分でキューが伸び続けない)
+        assert sum(len(dq) for callers in q._q.values() for dq in callers.values()) == 1
+        assert "v" not in q._q[PRIO_REFRESH]
+        assert q.wake(5) == 1
+        assert b.result() is True
+        # 既に起こされた待機者は外せない
+        assert not q.abandon(PRIO_NEW, "u", b)
+        st = q.stats()
+        return st, len(q)
+    st, n = asyncio.run(run())
+    assert n == 0
+    assert st["waitq_new_abandoned"] == 1 and st["waitq_refresh_abandoned"] == 1
+    assert st["waitq_new_granted"] == 1 and st["waitq_new_depth"] == 0
+
+
+def test_many_timeouts_do_not_grow_the_queue():
+    async def run():
+        q = SlotWaitQueue(parse_weights(""))
+
+        async def waiter(i):
+            fut = q.enqueue(PRIO_NEW, f"u{i % 3}")
+            try:
+                await asyncio.wait_for(fut, timeout=0.01)
+            except asyncio.TimeoutError:
+                assert q.abandon(PRIO_NEW, f"u{i % 3}", fut)
+
+        await asyncio.gather(*[waiter(i) for i in range(300)])
+        return len(q), sum(len(dq) for callers in q._q.values() for dq in callers.values())
+    assert asyncio.run(run()) == (0, 0)
@@ -0,0 +1,232 @@
+import os, re, sys, glob, json, time, struct, asyncio, hashlib, argparse
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# === リクエスト単位のトレース ===
+# X-Request-ID ごとに「どの段階で何秒かかったか」を固定長レコードでバイナリファイルに追記する。
+#   - 記録対象は request id のハッシュで決める (TRACE_SAMPLE の割合)。どのサービスでも同じ id が選ばれる
+#   - レコードはまずメモリ上のリングに詰め、flusher がまとめてファイルに追記する (イベントループ内で完結するのでロック不要)
+#   - リングが一周して flusher に追いついた分は捨てて dropped に数える (リクエスト処理を待たせない)
+# nginx の区間 (rt / urt) はアクセスログの rid= / ms= から CLI 側で結合する。
+#
+# vehicle_simulator は単一ファイルで配布しているため、同じレコード形式の書き込み側を simulator.py にも持つ。
+#
+#   python tracing.py stages    logs/trace-*.bin
+#   python tracing.py waterfall logs/trace-*.bin --nginx logs/app.log --top 5
+#   python tracing.py waterfall logs/trace-*.bin --rid MONITOR-xxxx
+
+REC = struct.Struct("<48sBBHdf")  # request id, service, stage, status, 開始 (epoch 秒), 所要秒
+SERVICES = {1: "cloud_api", 2: "vehicle", 3: "nginx"}
+STAGES = {1: "admission", 2: "fsync", 3: "downstream", 4: "total", 5: "vehicle", 6: "upstream", 7: "nginx"}
+STAGE_IDS = {v: k for k, v in STAGES.items()}
+
+
+def sampled(rid: str, rate: float) -> bool:
+    if rate <= 0:
+        return False
+    if rate >= 1:
+        return True
+    h = int.from_bytes(hashlib.blake2b(rid.encode(), digest_size=8).digest(), "little")
+    return h < rate * (1 << 64)
+
+
+class TraceRing:
+    def __init__(self, path: str, service: int, sample: float, capacity: int = 65536,
+                 flush_s: float = 0.5, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.service = service
+        self.sample = sample
+        self.capacity = max(1, capacity)
+        self.flush_s = flush_s
+        self.max_bytes = max_bytes
+        self._buf = bytearray(REC.size * self.capacity)
+        self._w = 0          # 書き込んだレコード数 (累計)
+        self._f = 0          # ファイルへ渡したレコード数 (累計)
+        self._fd: Optional[int] = None
+        self._file_bytes = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample > 0 and bool(self.path)
+
+    def want(self, rid: str) -> bool:
+        return self.enabled and sampled(rid, self.sample)
+
+    def span(self, rid: str, stage: str, start_epoch: float, dur_s: float, status: int = 0):
+        if self._w - self._f >= self.capacity:
+            self.dropped += 1
+            return
+        off = (self._w % self.capacity) * REC.size
+        REC.pack_into(self._buf, off, rid.encode()[:48], self.service, STAGE_IDS[stage],
+                      status & 0xFFFF, start_epoch, dur_s)
+        self._w += 1
+
+    def span_since(self, rid: str, stage: str, t0_mono: float, status: int = 0):
+        # monotonic の開始時刻から epoch の開始時刻を逆算して記録する
+        dur = time.monotonic() - t0_mono
+        self.span(rid, stage, time.time() - dur, dur, status)
+
+    # --- ファイルへの追記 ---
+    def open(self):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._file_bytes = os.fstat(self._fd).st_size
+
+    def _take(self) -> bytes:
+        n = self._w - self._f
+        if n <= 0:
+            return b""
+        a = (self._f % self.capacity) * REC.size
+        b = a + n * REC.size
+        if b <= len(self._buf):
+            data = bytes(self._buf[a:b])
+        else:
+            data = bytes(self._buf[a:]) + bytes(self._buf[:b - len(self._buf)])
+        self._f = self._w
+        return data
+
+    def _write(self, data: bytes):
+        if self._fd is None or not data:
+            return
+        if self._file_bytes + len(data) > self.max_bytes:
+            self.dropped += len(data) // REC.size
+            return
+        os.write(self._fd, data)
+        self._file_bytes += len(data)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_s)
+            data = self._take()
+            if data:
+                await loop.run_in_executor(None, self._write, data)
+
+    def close(self):
+        self._write(self._take())
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def stats(self) -> dict:
+        return {
+            "trace_sample": self.sample,
+            "trace_spans": self._w,
+            "trace_dropped": self.dropped,
+            "trace_file_bytes": self._file_bytes,
+        }
+
+
+# === CLI: トレースファイルの結合 ===
+_NGINX_RE = re.compile(r" st=(\d{3}) rt=([\d.]+) urt=(\S+) .*rid=(\S+) ms=([\d.]+)")
+
+
+def read_spans(paths: List[str]) -> Dict[str, List[dict]]:
+    by_rid: Dict[str, List[dict]] = {}
+    for p in paths:
+        with open(p, "rb") as f:
+            data = f.read()
+        for i in range(0, len(data) - REC.size + 1, REC.size):
+            rid, svc, stage, status, start, dur = REC.unpack_from(data, i)
+            rid = rid.rstrip(b"\0").decode("utf-8", "ignore")
+            by_rid.setdefault(rid, []).append({
+                "service": SERVICES.get(svc, str(svc)), "stage": STAGES.get(stage, str(stage)),
+                "status": status, "start": start, "dur": dur,
+            })
+    return by_rid
+
+
+def join_nginx(by_rid: Dict[str, List[dict]], log_path: str):
+    # nginx の ms= は応答を書いた時刻なので、開始は ms - rt
+    with open(log_path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            m = _NGINX_RE.search(line)
+            if not m or m.group(4) not in by_rid:
+                continue
+            st, rt, urt, rid, ms = int(m.group(1)), float(m.group(2)), m.group(3), m.group(4), float(m.group(5))
+            by_rid[rid].append({"service": "nginx", "stage": "nginx", "status": st, "start": ms - rt, "dur": rt})
+            try:
+                u = float(urt.split(",")[-1].strip())
+                by_rid[rid].append({"service": "nginx", "stage": "upstream", "status": st, "start": ms - u, "dur": u})
+            except ValueError:
+                pass
+
+
+def _total(spans: List[dict]) -> float:
+    return max(s["start"] + s["dur"] for s in spans) - min(s["start"] for s in spans)
+
+
+def waterfall(rid: str, spans: List[dict], width: int = 60) -> str:
+    t0 = min(s["start"] for s in spans)
+    total = max(_total(spans), 1e-9)
+    lines = [f"{rid}  total={total * 1000:.1f}ms  start={datetime.fromtimestamp(t0).isoformat(timespec='milliseconds')}"]
+    for s in sorted(spans, key=lambda s: (s["start"], -s["dur"])):
+        a = int((s["start"] - t0) / total * width)
+        b = max(a + 1, int((s["start"] - t0 + s["dur"]) / total * width))
+        bar = " " * a + "#" * (b - a)
+        lines.append(f"  {s['service'] + '.' + s['stage']:<22} {bar:<{width}} "
+                     f"+{(s['start'] - t0) * 1000:8.1f}ms {s['dur'] * 1000:9.1f}ms"
+                     + (f"  [{s['status']}]" if s["status"] else ""))
+    return "\n".join(lines)
+
+
+def _pct(values: List[float], p: float) -> float:
+    v = sorted(values)
+    return v[min(len(v) - 1, max(0, -(-len(v) * p // 100) - 1))] if v else 0.0
+
+
+def stage_breakdown(by_rid: Dict[str, List[dict]]) -> dict:
+    per: Dict[str, List[float]] = {}
+    for spans in by_rid.values():
+        for s in spans:
+            per.setdefault(f"{s['service']}.{s['stage']}", []).append(s["dur"])
+    out = {}
+    for k, v in sorted(per.items()):
+        out[k] = {"count": len(v), "p50_ms": round(_pct(v, 50) * 1000, 3), "p90_ms": round(_pct(v, 90) * 1000, 3),
+                  "p99_ms": round(_pct(v, 99) * 1000, 3), "max_ms": round(max(v) * 1000, 3),
+                  "sum_s": round(sum(v), 3)}
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="trace file viewer")
+    ap.add_argument("command", choices=("waterfall", "stages"))
+    ap.add_argument("files", nargs="+", help="trace-*.bin (glob 可)")
+    ap.add_argument("--nginx", help="rid= / ms= 付きの nginx アクセスログ (app.log など)")
+    ap.add_argument("--rid", help="この request id だけ表示")
+    ap.add_argument("--top", type=int, default=5, help="waterfall: 合計時間の長い順に何件出すか")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args(argv)
+
+    paths = sorted({p for pat in args.files for p in glob.glob(pat)})
+    by_rid = read_spans(paths)
+    if args.nginx:
+        join_nginx(by_rid, args.nginx)
+
+    if args.command == "stages":
+        res = stage_breakdown(by_rid)
+        if args.json:
+            print(json.dumps(res, indent=1))
+        else:
+            print(f"{len(by_rid)} requests from {len(paths)} files")
+            for k, v in res.items():
+                print(f"  {k:<22} n={v['count']:<7} p50={v['p50_ms']:>9}ms p90={v['p90_ms']:>9}ms "
+                      f"p99={v['p99_ms']:>9}ms max={v['max_ms']:>9}ms")
+        return 0
+
+    if args.rid:
+        rids = [args.rid] if args.rid in by_rid else []
+    else:
+        rids = sorted(by_rid, key=lambda r: _total(by_rid[r]), reverse=True)[:args.top]
+    if args.json:
+        print(json.dumps({r: sorted(by_rid[r], key=lambda s: s["start"]) for r in rids}, indent=1))
+    else:
+        print("\n\n".join(waterfall(r, by_rid[r]) for r in rids) or "no matching request")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Callable, Dict, NamedTuple
+
+# === 実行中のチューニング値の差し替え ===
+# 値ごとに (読み出し, 適用, 範囲) を登録しておき、/admin/tunables から複数の値をまとめて変更する。
+#   - 全項目を検証してから適用するので、1つでも不正なら何も変わらない
+#   - 適用はイベントループ上の同期処理 (await しない) なので、他のリクエストからは一度に切り替わって見える
+#   - 変更ごとに時刻と (旧値, 新値) を履歴に残し、/metrics に載せる (負荷試験中の前後比較用)
+# 実行中のリクエストを旧設定のまま終わらせる責任は各 setter 側にある (main.py 参照)。
+
+
+class Tunable(NamedTuple):
+    get: Callable[[], object]
+    set: Callable[[object], None]
+    cast: Callable[[object], object]
+    lo: float
+    hi: float
+
+
+class TuningRegistry:
+    def __init__(self, history: int = 100):
+        self._items: Dict[str, Tunable] = {}
+        self._history: deque = deque(maxlen=max(1, history))
+        self.generation = 0
+        self.rejected = 0
+
+    def register(self, name: str, get: Callable[[], object], set: Callable[[object], None],
+                 lo: float, hi: float, cast: Callable[[object], object] = int):
+        self._items[name] = Tunable(get, set, cast, lo, hi)
+
+    def values(self) -> dict:
+        return {k: t.get() for k, t in self._items.items()}
+
+    def limits(self) -> dict:
+        return {k: [t.lo, t.hi] for k, t in self._items.items()}
+
+    def _validate(self, changes: dict) -> dict:
+        out = {}
+        for k, v in changes.items():
+            t = self._items.get(k)
+            if t is None:
+                raise ValueError(f"unknown tunable: {k}")
+            if isinstance(v, bool):
+                raise ValueError(f"{k}: expected a number")
+            try:
+                v = t.cast(v)
+            except (TypeError, ValueError):
+                raise ValueError(f"{k}: expected a number")
+            if not t.lo <= v <= t.hi:
+                raise ValueError(f"{k}: {v} is out of range [{t.lo}, {t.hi}]")
+            out[k] = v
+        return out
+
+    def apply(self, changes: dict, source: str = "") -> dict:
+        """changes を検証して適用し、実際に変わった項目の {名前: [旧値, 新値]} を返す。"""
+        try:
+            new = self._validate(changes)
+        except ValueError:
+            self.rejected += 1
+            raise
+        diff = {}
+        for k, v in new.items():
+            old = self._items[k].get()
+            if old != v:
+                self._items[k].set(v)
+                diff[k] = [old, v]
+        if diff:
+            self.generation += 1
+            now = time.time()
+            self._history.append({
+                "generation": self.generation,
+                "timestamp_epoch": now,
+                "timestamp_iso": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+                "source": source,
+                "changes": diff,
+            })
+        return diff
+
+    def stats(self) -> dict:
+        return {
+            "tuning_generation": self.generation,
+            "tuning_rejected": self.rejected,
+            "tuning_history": list(self._history),
+        }
@@ -0,0 +1,136 @@
+import time, asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+# === セッション空き待ちキュー ===
+# notify_all で全員を起こして取り合わせる代わりに、空いた枠の数だけ待機者を選んで起こす。
+#   - 優先度クラス間: 重み付きラウンドロビン (smooth WRR)。低優先度も重みに応じて必ず進む
+#   - クラス内: 呼び出し元 (caller) ごとの FIFO をラウンドロビンし、1人の大量要求が他を塞がない
+# 起こされた待機者には枠が1つ予約された状態で Future が True で解決される。
+# タイムアウト/キャンセルした待機者は abandon でキューから取り除くので、深さ (len) は生きている待機者の数と一致する。
+
+PRIO_PROBE = "probe"      # 監視プローブ (X-Request-ID: MONITOR-...)
+PRIO_REFRESH = "refresh"  # 直前までセッションを持っていた利用者の再来
+PRIO_NEW = "new"          # 新規セッション
+
+_Waiter = Tuple[asyncio.Future, float]
+
+
+def parse_weights(spec: str) -> Dict[str, int]:
+    """"probe:16,refresh:4,new:1" -> {"probe": 16, "refresh": 4, "new": 1}"""
+    out: Dict[str, int] = {}
+    for part in spec.split(","):
+        name, _, w = part.strip().partition(":")
+        if name:
+            out[name] = max(1, int(w or 1))
+    for c in (PRIO_PROBE, PRIO_REFRESH, PRIO_NEW):
+        out.setdefault(c, 1)
+    return out
+
+
+class SlotWaitQueue:
+    def __init__(self, weights: Dict[str, int]):
+        self.weights = dict(weights)
+        self._q: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {c: OrderedDict() for c in self.weights}
+        self._depth = {c: 0 for c in self.weights}
+        self._cur = {c: 0 for c in self.weights}
+        self._st = {c: {"enqueued": 0, "granted": 0, "abandoned": 0, "wait_sum_s": 0.0, "wait_max_s": 0.0}
+                    for c in self.weights}
+
+    def __len__(self) -> int:
+        return sum(self._depth.values())
+
+    def enqueue(self, cls: str, caller: str) -> asyncio.Future:
+        if cls not in self._q:
+            cls = PRIO_NEW
+        fut = asyncio.get_running_loop().create_future()
+        callers = self._q[cls]
+        dq = callers.get(caller)
+        if dq is None:
+            dq = callers[caller] = deque()
+        dq.append((fut, time.monotonic()))
+        self._depth[cls] += 1
+        self._st[cls]["enqueued"] += 1
+        return fut
+
+    def abandon(self, cls: str, caller: str, fut: asyncio.Future) -> bool:
+        """タイムアウト/キャンセルした待機者をキューから外す。既に起こされていた (見つからない) なら False。"""
+        # 探すのはその caller の列だけ。諦めるのは待ちの長い先頭側が多いので、ほぼ先頭で見つかる
+        if cls not in self._q:
+            cls = PRIO_NEW
+        callers = self._q[cls]
+        dq = callers.get(caller)
+        if dq is None:
+            return False
+        for i, w in enumerate(dq):
+            if w[0] is fut:
+                del dq[i]
+                break
+        else:
+            return False
+        if not dq:
+            del callers[caller]
+        self._depth[cls] -= 1
+        self._st[cls]["abandoned"] += 1
+        return True
+
+    def _pick(self) -> Optional[str]:
+        best, total = None, 0
+        for c, w in self.weights.items():
+            if self._depth[c] <= 0:
+                continue
+            total += w
+            self._cur[c] += w
+            if best is None or self._cur[c] > self._cur[best]:
+                best = c
+        if best is not None:
+            self._cur[best] -= total
+        return best
+
+    def _pop(self, cls: str) -> Optional[_Waiter]:
+        callers = self._q[cls]
+        while callers:
+            caller, dq = callers.popitem(last=False)
+            while dq:
+                w = dq.popleft()
+                if not w[0].done():
+                    if dq:
+                        callers[caller] = dq  # 末尾へ回してラウンドロビン
+                    return w
+        return None
+
+    def wake(self, n: int) -> int:
+        """最大 n 人の待機者に枠を渡し、実際に渡した数を返す。"""
+        granted = 0
+        now = time.monotonic()
+        while granted < n:
+            cls = self._pick()
+            if cls is None:
+                break
+            w = self._pop(cls)
+            if w is None:  # depth と実体がずれた場合の保険
+                self._depth[cls] = 0
+                continue
+            fut, t0 = w
+            fut.set_result(True)
+            self._depth[cls] -= 1
+            st = self._st[cls]
+            st["granted"] += 1
+            dt = now - t0
+            st["wait_sum_s"] += dt
+            if dt > st["wait_max_s"]:
+                st["wait_max_s"] = dt
+            granted += 1
+        return granted
+
+    def stats(self) -> dict:
+        out = {}
+        for c, st in self._st.items():
+            g = st["granted"]
+            out[f"waitq_{c}_depth"] = self._depth[c]
+            out[f"waitq_{c}_enqueued"] = st["enqueued"]
+            out[f"waitq_{c}_granted"] = g
+            out[f"waitq_{c}_abandoned"] = st["abandoned"]
+            out[f"waitq_{c}_wait_avg_s"] = round(st["wait_sum_s"] / g, 4) if g else 0.0
+            out[f"waitq_{c}_wait_max_s"] = round(st["wait_max_s"], 4)
+        return out
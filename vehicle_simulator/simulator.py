@@ -1,28 +1,320 @@
-from fastapi import FastAPI
+import os, re, sys, math, time, random, struct, fnmatch, hashlib, asyncio, resource
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 
 app = FastAPI()
 
-# vehicle_id -> state をメモリ上で保持
-vehicle_state = {}
+# === Tunables (env) ===
+VEHICLE_CAPACITY = int(os.getenv("VEHICLE_CAPACITY", "36000"))   # 初期確保する車両数 (足りなければ伸ばす)
+OVERFLOW_MAX = int(os.getenv("OVERFLOW_MAX", "10000"))           # vin-NNNNNN 形式以外の車両の保持上限 (LRU)
+SIM_LOG_SAMPLE = int(os.getenv("SIM_LOG_SAMPLE", "1"))           # N件に1件だけログを出す (0で出さない)
+SIM_LOG_FLUSH_S = float(os.getenv("SIM_LOG_FLUSH_S", "0.5"))     # ログのまとめ書き間隔
+SIM_TRACE_PATH = os.getenv("SIM_TRACE_PATH", "")                 # request id 単位のスパン出力先 (空で無効)
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0.01"))          # cloud_api と同じ値にすると同じリクエストが選ばれる
 
-@app.post("/command")
-def execute_command(command_data: dict):
+# 応答遅延・障害注入 (起動時の既定値。/admin/profile で実行中に差し替え可能)
+#   SIM_LATENCY: none | fixed:<ms> | exp:<mean_ms> | lognormal:<median_ms>:<sigma> | bimodal:<fast_ms>:<slow_ms>:<p_slow>
+#   SIM_VEHICLE_LATENCY: 車両ごとの上書き "vin-0001*=fixed:3000,monitor-*=none" (fnmatch パターン, 先勝ち)
+SIM_DEFAULT_PROFILE = {
+    "latency": os.getenv("SIM_LATENCY", "none"),
+    "vehicle_latency": os.getenv("SIM_VEHICLE_LATENCY", ""),
+    "error_rate": float(os.getenv("SIM_ERROR_RATE", "0")),        # 500 を返す確率
+    "stall_rate": float(os.getenv("SIM_STALL_RATE", "0")),        # 応答を stall_s 秒止める確率
+    "stall_s": float(os.getenv("SIM_STALL_S", "120")),
+    "max_concurrent": int(os.getenv("SIM_MAX_CONCURRENT", "0")),  # 同時処理数の上限 (0で無制限)
+    "over_capacity": os.getenv("SIM_OVER_CAPACITY", "queue"),     # 上限超過時: queue (待たせる) | reject (503)
+    "seed": int(os.getenv("SIM_SEED", "0")),                      # 乱数シード (到着順が同じなら同じ結果)
+}
+
+# === 車両状態 ===
+# vin-000123 のような ID は番号をそのまま添字にして bytearray のビットで持つ。
+# それ以外の ID は上限付きの dict (古いものから捨てる) に入れる。
+_VIN_RE = re.compile(r"^vin-(\d{1,9})$")
+
+class VehicleStore:
+    def __init__(self, capacity: int, overflow_max: int):
+        self._known = bytearray((capacity + 7) // 8)
+        self._climate = bytearray((capacity + 7) // 8)
+        self._overflow: "OrderedDict[str, bool]" = OrderedDict()
+        self.overflow_max = overflow_max
+        self.index_max = max(capacity * 16, 1 << 20)  # 異常に大きい番号でビット列を伸ばさない
+        self.vehicle_count = 0
+        self.climate_on_count = 0
+
+    def _grow(self, idx: int):
+        need = idx // 8 + 1
+        if need > len(self._known):
+            n = max(need, len(self._known) * 2)
+            self._known.extend(bytes(n - len(self._known)))
+            self._climate.extend(bytes(n - len(self._climate)))
+
+    def turn_climate_on(self, vehicle_id: str) -> bool:
+        """climate を ON にし、既に ON だったかを返す。"""
+        m = _VIN_RE.match(vehicle_id)
+        i = int(m.group(1)) if m else -1
+        if 0 <= i < self.index_max:
+            self._grow(i)
+            byte, bit = i >> 3, 1 << (i & 7)
+            if not self._known[byte] & bit:
+                self._known[byte] |= bit
+                self.vehicle_count += 1
+            if self._climate[byte] & bit:
+                return True
+            self._climate[byte] |= bit
+            self.climate_on_count += 1
+            return False
+
+        on = self._overflow.get(vehicle_id)
+        if on is None:
+            self.vehicle_count += 1
+            if len(self._overflow) >= self.overflow_max:
+                _, old_on = self._overflow.popitem(last=False)
+                self.vehicle_count -= 1
+                self.climate_on_count -= old_on
+        else:
+            self._overflow.move_to_end(vehicle_id)
+        if on:
+            return True
+        self._overflow[vehicle_id] = True
+        self.climate_on_count += 1
+        return False
+
+    def memory_bytes(self) -> int:
+        return len(self._known) + len(self._climate) + sys.getsizeof(self._overflow)
+
+vehicle_state = VehicleStore(VEHICLE_CAPACITY, OVERFLOW_MAX)
+
+# === ログ: まとめ書き + サンプリング ===
+_log_buf = []
+_log_seq = 0
+
+def _log(msg: str):
+    global _log_seq
+    if SIM_LOG_SAMPLE <= 0:
+        return
+    _log_seq += 1
+    if _log_seq % SIM_LOG_SAMPLE == 0:
+        _log_buf.append(msg)
+        if len(_log_buf) >= 1000:
+            _flush_log()
+
+def _flush_log():
+    if _log_buf:
+        sys.stdout.write("\n".join(_log_buf) + "\n")
+        sys.stdout.flush()
+        _log_buf.clear()
+
+async def _log_flusher():
+    while True:
+        await asyncio.sleep(SIM_LOG_FLUSH_S)
+        _flush_log()
+        _flush_trace()
+
+# === トレース: cloud_api/tracing.py と同じレコード形式で vehicle 区間を追記 ===
+# 単一ファイルで配布しているので書き込み側だけここに持つ。読み出しは tracing.py の CLI で行う
+_TRACE_REC = struct.Struct("<48sBBHdf")  # request id, service(2=vehicle), stage(5=vehicle), status, 開始, 所要秒
+_TRACE_MAX_BUF = _TRACE_REC.size * 65536
+_trace_buf = bytearray()
+_trace_fd: Optional[int] = None
+_trace_stats = {"trace_spans": 0, "trace_dropped": 0}
+
+def _trace_want(rid) -> bool:
+    if _trace_fd is None or not isinstance(rid, str) or TRACE_SAMPLE <= 0:
+        return False
+    if TRACE_SAMPLE >= 1:
+        return True
+    h = int.from_bytes(hashlib.blake2b(rid.encode(), digest_size=8).digest(), "little")
+    return h < TRACE_SAMPLE * (1 << 64)
+
+def _trace_span(rid: str, t0: float, status: int):
+    dur = time.monotonic() - t0
+    if len(_trace_buf) >= _TRACE_MAX_BUF:
+        _trace_stats["trace_dropped"] += 1
+        return
+    _trace_buf.extend(_TRACE_REC.pack(rid.encode()[:48], 2, 5, status, time.time() - dur, dur))
+    _trace_stats["trace_spans"] += 1
+
+def _flush_trace():
+    if _trace_fd is not None and _trace_buf:
+        os.write(_trace_fd, _trace_buf)
+        _trace_buf.clear()
+
+# === 応答遅延・障害注入プロファイル ===
+LatencyFn = Callable[[random.Random], float]
+
+def parse_latency(spec: str) -> LatencyFn:
+    """遅延指定文字列を「乱数生成器 -> 秒」の関数に変換する。"""
+    parts = (spec or "none").strip().split(":")
+    kind, args = parts[0], [float(x) for x in parts[1:]]
+    if kind in ("", "none"):
+        return lambda rng: 0.0
+    if kind == "fixed":
+        ms = args[0]
+        return lambda rng: ms / 1000.0
+    if kind == "exp":
+        mean = args[0] / 1000.0
+        return lambda rng: rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+    if kind == "lognormal":
+        mu, sigma = math.log(max(args[0], 1e-3) / 1000.0), (args[1] if len(args) > 1 else 0.5)
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    if kind == "bimodal":
+        fast, slow, p = args[0] / 1000.0, args[1] / 1000.0, args[2]
+        return lambda rng: slow if rng.random() < p else fast
+    raise ValueError(f"unknown latency spec: {spec}")
+
+class InjectedError(Exception):
+    pass
+
+class FaultProfile:
+    def __init__(self, cfg: dict):
+        cfg = {**SIM_DEFAULT_PROFILE, **cfg}
+        if cfg["over_capacity"] not in ("queue", "reject"):
+            raise ValueError("over_capacity must be queue or reject")
+        self.cfg = cfg
+        self.rng = random.Random(cfg["seed"])
+        self.latency = parse_latency(cfg["latency"])
+        self.rules: List[Tuple[str, LatencyFn]] = []
+        for item in filter(None, (x.strip() for x in cfg["vehicle_latency"].split(","))):
+            pat, _, spec = item.partition("=")
+            self.rules.append((pat, parse_latency(spec)))
+        n = cfg["max_concurrent"]
+        self.sem = asyncio.Semaphore(n) if n > 0 else None
+        self.inflight = 0
+
+    def service_time(self, vehicle_id: str) -> float:
+        for pat, fn in self.rules:
+            if fnmatch.fnmatchcase(vehicle_id, pat):
+                return fn(self.rng)
+        return self.latency(self.rng)
+
+    def draw_fault(self) -> Optional[str]:
+        r = self.rng.random()
+        if r < self.cfg["stall_rate"]:
+            return "stall"
+        if r < self.cfg["stall_rate"] + self.cfg["error_rate"]:
+            return "error"
+        return None
+
+_profile = FaultProfile({})
+_fault_stats = {"injected_errors": 0, "stalls": 0, "rejected": 0}
+
+async def _serve(prof: FaultProfile, command_data: dict) -> dict:
+    vehicle_id = str(command_data.get("vehicle_id", "unknown"))
+    fault = prof.draw_fault()
+    delay = prof.service_time(vehicle_id)
+    prof.inflight += 1
+    try:
+        if fault == "stall":
+            _fault_stats["stalls"] += 1
+            await asyncio.sleep(prof.cfg["stall_s"])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if fault == "error":
+            _fault_stats["injected_errors"] += 1
+            raise InjectedError(vehicle_id)
+        return _execute(command_data)
+    finally:
+        prof.inflight -= 1
+
+async def _run(command_data: dict) -> dict:
+    rid = command_data.get("request_id")
+    if not _trace_want(rid):
+        return await _run_profile(command_data)
+    t0 = time.monotonic()
+    status = 500
+    try:
+        res = await _run_profile(command_data)
+        status = 200
+        return res
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        _trace_span(rid, t0, status)
+
+async def _run_profile(command_data: dict) -> dict:
+    # 実行中のリクエストは受け付け時点のプロファイルのまま最後まで処理する
+    prof = _profile
+    if prof.sem is None:
+        return await _serve(prof, command_data)
+    if prof.cfg["over_capacity"] == "reject" and prof.sem.locked():
+        _fault_stats["rejected"] += 1
+        raise HTTPException(503, "vehicle gateway over capacity")
+    async with prof.sem:
+        return await _serve(prof, command_data)
+
+# === Commands ===
+def _execute(command_data: dict) -> dict:
     command = command_data.get("command")
-    vehicle_id = command_data.get("vehicle_id", "unknown")
+    vehicle_id = str(command_data.get("vehicle_id", "unknown"))
 
     if command == "START_CLIMATE":
-        state = vehicle_state.setdefault(vehicle_id, {"is_climate_on": False})
-
-        if not state["is_climate_on"]:
-            print(f"VehicleSimulator[{vehicle_id}]: Command received. Turning climate ON.")
-            state["is_climate_on"] = True
+        if not vehicle_state.turn_climate_on(vehicle_id):
+            _log(f"VehicleSimulator[{vehicle_id}]: Command received. Turning climate ON.")
             return {"status": "Climate turned ON", "vehicle_id": vehicle_id}
         else:
-            print(f"VehicleSimulator[{vehicle_id}]: Climate is already ON.")
+            _log(f"VehicleSimulator[{vehicle_id}]: Climate is already ON.")
             return {"status": "Climate was already ON", "vehicle_id": vehicle_id}
 
     return {"status": "Unknown command", "vehicle_id": vehicle_id}
 
+def _error_result(command_data: dict, e: BaseException) -> dict:
+    return {"status": "error", "error": f"{type(e).__name__}: {e}", "vehicle_id": str(command_data.get("vehicle_id", "unknown"))}
+
+@app.post("/command")
+async def execute_command(command_data: dict):
+    try:
+        return await _run(command_data)
+    except InjectedError as e:
+        return JSONResponse(_error_result(command_data, e), status_code=500)
+
+@app.post("/command/batch")
+async def execute_command_batch(batch: dict):
+    # {"commands": [{...}, ...]} -> {"results": [{...}, ...]} (順序は入力と同じ)
+    # 個別の失敗は {"status": "error", "error": ...} として該当位置に入る
+    commands = batch.get("commands") or []
+    results = await asyncio.gather(*[_run(c) for c in commands], return_exceptions=True)
+    return {"results": [_error_result(c, r) if isinstance(r, BaseException) else r for c, r in zip(commands, results)]}
+
+@app.get("/admin/profile")
+async def get_profile():
+    return {**_profile.cfg, "inflight": _profile.inflight, **_fault_stats}
+
+@app.put("/admin/profile")
+async def put_profile(cfg: dict):
+    # 指定されなかった項目は起動時の既定値に戻る。差し替えは参照の付け替えだけなので原子的
+    global _profile
+    try:
+        _profile = FaultProfile(cfg)
+    except (ValueError, TypeError, IndexError, KeyError) as e:
+        raise HTTPException(400, f"invalid profile: {e}")
+    return _profile.cfg
+
 @app.get("/status")
-def get_status():
-    return {"vehicle_count": len(vehicle_state)}
+async def get_status():
+    return {
+        "vehicle_count": vehicle_state.vehicle_count,
+        "climate_on_count": vehicle_state.climate_on_count,
+        "state_bytes": vehicle_state.memory_bytes(),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "log_pending": len(_log_buf),
+        "inflight": _profile.inflight,
+        "latency": _profile.cfg["latency"],
+        **_fault_stats,
+        **_trace_stats,
+    }
+
+@app.on_event("startup")
+async def _startup():
+    global _trace_fd
+    if SIM_TRACE_PATH and TRACE_SAMPLE > 0:
+        os.makedirs(os.path.dirname(SIM_TRACE_PATH) or ".", exist_ok=True)
+        _trace_fd = os.open(SIM_TRACE_PATH.format(pid=os.getpid()), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    asyncio.create_task(_log_flusher())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    _flush_log()
+    _flush_trace()